@@ -0,0 +1,180 @@
+"""
+Per-model admission control for upstream calls
+
+Each model in settings.MODEL_URLS gets a gate that lets a limited number of
+calls run at once. Further calls wait in a bounded FIFO queue for at most
+UPSTREAM_QUEUE_TIMEOUT seconds. A call that finds the queue full, or waits
+too long, is rejected with 429 and a Retry-After estimated from how long
+recent calls to the model took, so overload shows up as fast failures
+instead of slow ones.
+"""
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, Optional
+
+from fastapi import HTTPException
+
+from app.config import parse_key_values, settings
+from app.metrics import registry
+
+queue_depth = registry.gauge(
+    "upstream_queue_depth",
+    "Upstream calls waiting for a free slot",
+    ("model",)
+)
+in_flight = registry.gauge(
+    "upstream_in_flight",
+    "Upstream calls currently running",
+    ("model",)
+)
+queue_wait = registry.histogram(
+    "upstream_queue_wait_seconds",
+    "Time upstream calls waited for a free slot",
+    ("model",)
+)
+rejected = registry.counter(
+    "upstream_admission_rejected_total",
+    "Upstream calls rejected because the queue was full or the wait timed out",
+    ("model", "reason")
+)
+
+# Weight of the newest call in the moving average of service time
+SERVICE_TIME_SMOOTHING = 0.2
+
+
+class AdmissionGate:
+    """Concurrency limit with a bounded wait queue for one model"""
+
+    def __init__(self, model: str, limit: int, queue_size: int, queue_timeout: float):
+        self.model = model
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.service_time: Optional[float] = None
+        self._active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely to be free for one more caller"""
+        per_call = self.service_time or 1.0
+        rounds = (self.waiting + 1) / max(self.limit, 1)
+        return max(1, math.ceil(rounds * per_call))
+
+    def _reject(self, reason: str):
+        rejected.inc(model=self.model, reason=reason)
+        raise HTTPException(
+            status_code=429,
+            detail=f"Too many requests for {self.model}, try again later",
+            headers={"Retry-After": str(self.retry_after())}
+        )
+
+    async def acquire(self):
+        """
+        Take a slot, waiting in the queue if all slots are in use
+
+        Raises:
+            HTTPException: 429 if the queue is full or the wait times out
+        """
+        if self._active < self.limit and not self._waiters:
+            self._active += 1
+            queue_wait.observe(0, model=self.model)
+            return
+        if len(self._waiters) >= self.queue_size:
+            self._reject("queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        queue_depth.set(self.waiting, model=self.model)
+        started = time.monotonic()
+        try:
+            await asyncio.wait((waiter,), timeout=self.queue_timeout)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+        finally:
+            queue_wait.observe(time.monotonic() - started, model=self.model)
+        if not waiter.done():
+            self._abandon(waiter)
+            self._reject("timeout")
+
+    def _abandon(self, waiter: asyncio.Future):
+        """Leave the queue, passing on a slot that was handed over meanwhile"""
+        if waiter.done() and not waiter.cancelled():
+            self.release()
+        else:
+            waiter.cancel()
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        queue_depth.set(self.waiting, model=self.model)
+
+    def release(self):
+        """Hand the slot to the first waiter, or free it"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                queue_depth.set(self.waiting, model=self.model)
+                return
+        self._active -= 1
+
+    def observe_service_time(self, seconds: float):
+        if self.service_time is None:
+            self.service_time = seconds
+        else:
+            self.service_time += SERVICE_TIME_SMOOTHING * (seconds - self.service_time)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Hold a slot for the duration of the block"""
+        await self.acquire()
+        in_flight.inc(model=self.model)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe_service_time(time.monotonic() - started)
+            in_flight.dec(model=self.model)
+            self.release()
+
+
+class AdmissionController:
+    """Gates of every model, created from settings on first use"""
+
+    def __init__(self):
+        self._gates: Dict[str, AdmissionGate] = {}
+
+    def gate(self, model: str) -> AdmissionGate:
+        gate = self._gates.get(model)
+        if gate is None:
+            limits = parse_key_values(settings.UPSTREAM_MODEL_CONCURRENCY_OVERRIDES)
+            gate = AdmissionGate(
+                model,
+                limit=limits.get(model, settings.UPSTREAM_MODEL_CONCURRENCY),
+                queue_size=settings.UPSTREAM_MODEL_QUEUE_SIZE,
+                queue_timeout=settings.UPSTREAM_QUEUE_TIMEOUT
+            )
+            self._gates[model] = gate
+        return gate
+
+    def slot(self, model: str):
+        """Hold a slot of the model's gate for the duration of the block"""
+        return self.gate(model).slot()
+
+    def reset(self):
+        """Forget every gate so they are created again from settings"""
+        self._gates.clear()
+
+
+# Global admission controller for upstream model calls
+admission = AdmissionController()
@@ -0,0 +1,129 @@
+"""
+Cache of verified tokens for the authentication dependency
+
+get_current_user verifies the JWT and looks the user up in Mongo. The
+result is remembered per token in a bounded LRU for AUTH_CACHE_TTL_SECONDS
+(never past the token's own expiry), so a warm request needs neither.
+Deleting a user or revoking their tokens drops every cached token of that
+user. Other replicas only notice after the TTL, which bounds staleness.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+from app.config import settings
+from app.metrics import registry
+
+auth_cache_requests = registry.counter(
+    "auth_cache_requests_total",
+    "Token lookups in the authentication cache by outcome",
+    ("result",)
+)
+auth_cache_hit_ratio = registry.gauge(
+    "auth_cache_hit_ratio",
+    "Share of token lookups answered by the authentication cache"
+)
+
+
+def _token_key(token: str) -> str:
+    """Tokens are kept hashed so the cache holds no usable credentials"""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class AuthCache:
+    """Bounded TTL cache from verified tokens to usernames"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # token key -> (username, monotonic expiry)
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._tokens_by_user: Dict[str, Set[str]] = {}
+        # Bumped on invalidation so lookups that started before it are not stored
+        self._generations: Dict[str, int] = {}
+        self._hits = 0
+        self._lookups = 0
+        self._lock = threading.Lock()
+
+    def _count(self, hit: bool):
+        self._lookups += 1
+        self._hits += hit
+        auth_cache_requests.inc(result="hit" if hit else "miss")
+        auth_cache_hit_ratio.set(self._hits / self._lookups)
+
+    def hit_ratio(self) -> float:
+        with self._lock:
+            return self._hits / self._lookups if self._lookups else 0.0
+
+    def _drop(self, key: str):
+        username, _ = self._entries.pop(key)
+        tokens = self._tokens_by_user.get(username)
+        if tokens is not None:
+            tokens.discard(key)
+            if not tokens:
+                del self._tokens_by_user[username]
+
+    def get(self, token: str) -> Optional[str]:
+        """Return the username of a cached token, or None on a miss"""
+        key = _token_key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                self._drop(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+            self._count(entry is not None)
+        return entry[0] if entry else None
+
+    def generation(self, username: str) -> int:
+        """Take before verifying a token and hand to put()"""
+        with self._lock:
+            return self._generations.get(username, 0)
+
+    def put(self, token: str, username: str, token_expires_at: float, generation: int):
+        """
+        Remember a verified token
+
+        Args:
+            token: the bearer token
+            username: user the token belongs to
+            token_expires_at: exp claim of the token, in epoch seconds
+            generation: generation(username) from before the token was verified
+        """
+        ttl = min(self.ttl_seconds, token_expires_at - time.time())
+        if ttl <= 0:
+            return
+        key = _token_key(token)
+        with self._lock:
+            if self._generations.get(username, 0) != generation:
+                # The user was invalidated while the token was being verified
+                return
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (username, time.monotonic() + ttl)
+            self._tokens_by_user.setdefault(username, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate_user(self, username: str):
+        """Forget every cached token of a user, e.g. on deletion or revocation"""
+        with self._lock:
+            self._generations[username] = self._generations.get(username, 0) + 1
+            for key in list(self._tokens_by_user.get(username, ())):
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+            self._generations.clear()
+
+
+# Global authentication cache used by get_current_user
+auth_cache = AuthCache(
+    max_entries=settings.AUTH_CACHE_MAX_ENTRIES,
+    ttl_seconds=settings.AUTH_CACHE_TTL_SECONDS
+)
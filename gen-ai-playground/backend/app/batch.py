@@ -0,0 +1,160 @@
+"""
+Batch generation: many images from one request
+
+/images/generate/batch takes a list of prompts and models, or one prompt
+and model with several seeds. The items run concurrently, each through the
+same result cache, single-flight and admission gate as /images/generate.
+A batch holds at most as many calls to a model as the model's concurrency
+limit, so its own items wait for each other instead of filling the model's
+wait queue and being rejected with 429. Results are handed out as each item
+finishes, and once all are done the images are saved to the history
+together with one insert_many. Until then a batch keeps only what it needs
+to save each image, not the results already handed out.
+
+A batch runs in a task of its own, so it still finishes and saves its
+images when the client disconnects.
+"""
+import asyncio
+import logging
+import random
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from fastapi import HTTPException
+
+from app.admission import admission
+from app.config import settings
+from app.metrics import registry
+from app.models import BatchItem, BatchRequestBody
+from app.routing import model_router
+
+logger = logging.getLogger(__name__)
+
+# Largest seed drawn for count, within what every model accepts
+MAX_SEED = 2 ** 31 - 1
+
+batch_items = registry.counter(
+    "generation_batch_items_total",
+    "Items of batch generation requests by outcome",
+    ("status",)
+)
+batch_size = registry.histogram(
+    "generation_batch_size",
+    "Images asked for per batch generation request",
+    buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+
+# Generates one item with the model chosen for it and returns its result to
+# hand out and what to keep for the finish handler
+ItemHandler = Callable[[BatchItem, str], Awaitable[Tuple[Any, Any]]]
+# Saves what was kept of the items that completed and returns summary fields
+FinishHandler = Callable[[List[Any]], Awaitable[dict]]
+
+
+def expand_batch(batch: BatchRequestBody) -> List[BatchItem]:
+    """
+    The items a batch request asks for
+
+    Raises:
+        HTTPException: 400 if the request is ambiguous, empty, too large or
+        names an unknown model
+    """
+    if batch.items is not None:
+        if batch.prompt is not None or batch.seeds is not None or batch.count is not None:
+            raise HTTPException(status_code=400, detail="Give either items or a prompt with seeds, not both")
+        items = batch.items
+    else:
+        if batch.prompt is None or batch.model is None:
+            raise HTTPException(status_code=400, detail="A batch needs items, or a prompt and a model")
+        if (batch.seeds is None) == (batch.count is None):
+            raise HTTPException(status_code=400, detail="Give either seeds or count")
+        seeds = batch.seeds
+        if seeds is None:
+            seeds = [random.randint(0, MAX_SEED) for _ in range(max(batch.count, 0))]
+        items = [
+            BatchItem(prompt=batch.prompt, model=batch.model, seed=seed,
+                      latency_budget_ms=batch.latency_budget_ms)
+            for seed in seeds
+        ]
+    if not items:
+        raise HTTPException(status_code=400, detail="A batch needs at least one image")
+    if len(items) > settings.GENERATION_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A batch may ask for at most {settings.GENERATION_BATCH_MAX_ITEMS} images"
+        )
+    for item in items:
+        if not model_router.is_known(item.model):
+            raise HTTPException(status_code=400, detail=f"Unsupported model: {item.model}")
+    return items
+
+
+def item_error(error: Exception) -> dict:
+    """status_code and detail of a failed item, as jobs report them"""
+    if isinstance(error, HTTPException):
+        return {"status_code": error.status_code, "detail": error.detail}
+    return {"status_code": 500, "detail": f"Generation failed: {str(error)}"}
+
+
+class BatchRunner:
+    """Runs batches in tasks of their own and keeps track of them"""
+
+    def __init__(self):
+        self._tasks: Set[asyncio.Task] = set()
+
+    def start(self, items: List[BatchItem], generate: ItemHandler,
+              finish: FinishHandler) -> asyncio.Queue:
+        """
+        Start generating the items of a batch
+
+        Args:
+            items: the images to generate
+            generate: generates one item with the model chosen for it
+            finish: saves what was kept of the completed items, in item order
+
+        Returns:
+            asyncio.Queue: (index, result, None) or (index, None, error) for
+            each item as it finishes, then (None, summary, None)
+        """
+        batch_size.observe(len(items))
+        events: asyncio.Queue = asyncio.Queue()
+        task = asyncio.create_task(self._run(items, generate, finish, events))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return events
+
+    async def _run(self, items: List[BatchItem], generate: ItemHandler,
+                   finish: FinishHandler, events: asyncio.Queue):
+        limits: Dict[str, asyncio.Semaphore] = {}
+        kept: List[Optional[Any]] = [None] * len(items)
+
+        async def run_item(index: int, item: BatchItem):
+            try:
+                model = model_router.choose(item.model, item.latency_budget_ms)
+                if model not in limits:
+                    limits[model] = asyncio.Semaphore(admission.gate(model).limit)
+                async with limits[model]:
+                    result, kept[index] = await generate(item, model)
+            except Exception as e:
+                batch_items.inc(status="failed")
+                events.put_nowait((index, None, e))
+                return
+            batch_items.inc(status="completed")
+            events.put_nowait((index, result, None))
+
+        summary = {}
+        try:
+            await asyncio.gather(*(run_item(index, item) for index, item in enumerate(items)))
+            summary = await finish([item for item in kept if item is not None])
+        except Exception as e:
+            logger.exception(f"Batch generation failed to finish: {e}")
+            summary = {"error": item_error(e)}
+        finally:
+            events.put_nowait((None, summary, None))
+
+    async def stop(self):
+        """Wait for the running batches, so their images are saved"""
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+# Global batch runner, drained by the app lifespan
+batch_runner = BatchRunner()
@@ -0,0 +1,150 @@
+"""
+Content-addressed, reference-counted image blobs
+
+Every stored image is kept once per distinct content in the image_blobs
+collection, keyed by the SHA-256 of its decoded bytes. Image records refer
+to their blob with a content_hash field, and the blob counts how many
+records refer to it. The bytes themselves live in a storage backend.
+"""
+import asyncio
+import hashlib
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app.imaging import sniff_content_type
+from app.storage import ImageStorage, get_storage, storage_for_record
+
+# How long put_blob waits between looks at a blob that is being deleted
+BLOB_DELETION_POLL_INTERVAL = 0.05
+# After this many seconds a deletion counts as abandoned, its process having stopped
+BLOB_DELETION_TIMEOUT = 60
+
+
+def content_hash(image_bytes: bytes) -> str:
+    """Return the key a blob with these bytes is stored under"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+async def put_blob(db: AsyncIOMotorDatabase, image_bytes: bytes,
+             storage: Optional[ImageStorage] = None,
+             digest: Optional[str] = None) -> Tuple[str, bool]:
+    """
+    Add a reference to the blob holding these bytes, storing them if new
+
+    A blob whose last reference was just released is left to be deleted,
+    and the bytes are stored again once it is gone, so they never end up
+    referenced by a blob whose files are being removed.
+
+    Args:
+        db: Database instance
+        image_bytes: decoded image
+        storage: backend for new blobs, defaults to the configured one
+        digest: content_hash of image_bytes if the caller already has it
+
+    Returns:
+        Tuple[str, bool]: the content hash and whether the blob was created
+    """
+    digest = digest or content_hash(image_bytes)
+    storage = storage or get_storage()
+    while True:
+        existing = await db.image_blobs.find_one_and_update(
+            {"_id": digest, "deleting_at": {"$exists": False}},
+            {"$inc": {"refcount": 1}}
+        )
+        if existing:
+            return digest, False
+        if await _wait_for_deletion(db, digest):
+            continue
+
+        reference = await storage.save(db, image_bytes)
+        try:
+            await db.image_blobs.insert_one({
+                "_id": digest,
+                "refcount": 1,
+                "size": len(image_bytes),
+                "content_type": sniff_content_type(image_bytes),
+                "created_at": datetime.now(timezone.utc),
+                **reference
+            })
+            return digest, True
+        except DuplicateKeyError:
+            # Another request stored the same bytes first, or the blob is being
+            # deleted: drop this copy unless it is the other blob's file, and retry
+            winner = await db.image_blobs.find_one({"_id": digest}, {"storage_ref": 1})
+            if winner is None or winner.get("storage_ref") != reference.get("storage_ref"):
+                await storage.delete(db, reference)
+
+
+async def _wait_for_deletion(db: AsyncIOMotorDatabase, digest: str) -> bool:
+    """
+    Wait a moment if the blob is being deleted
+
+    A deletion that did not finish within BLOB_DELETION_TIMEOUT seconds
+    is given up on and its blob document removed.
+
+    Returns:
+        bool: whether the blob document existed
+    """
+    blob = await db.image_blobs.find_one({"_id": digest}, {"deleting_at": 1})
+    if blob is None:
+        return False
+    stale = datetime.now(timezone.utc) - timedelta(seconds=BLOB_DELETION_TIMEOUT)
+    result = await db.image_blobs.delete_one({"_id": digest, "deleting_at": {"$lt": stale}})
+    if not result.deleted_count:
+        await asyncio.sleep(BLOB_DELETION_POLL_INTERVAL)
+    return True
+
+
+async def release_blob(db: AsyncIOMotorDatabase, digest: str):
+    """
+    Drop a reference to a blob, deleting it once nothing refers to it
+
+    The blob is marked as being deleted while its files are removed and
+    only then deleted itself, see put_blob.
+
+    Args:
+        db: Database instance
+        digest: content hash of the blob
+    """
+    blob = await db.image_blobs.find_one_and_update(
+        {"_id": digest},
+        {"$inc": {"refcount": -1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not blob or blob["refcount"] > 0:
+        return
+    # Only delete if no new reference arrived in the meantime
+    blob = await db.image_blobs.find_one_and_update(
+        {"_id": digest, "refcount": {"$lte": 0}, "deleting_at": {"$exists": False}},
+        {"$set": {"deleting_at": datetime.now(timezone.utc)}},
+        return_document=ReturnDocument.AFTER
+    )
+    if blob is None:
+        return
+    await storage_for_record(blob).delete(db, blob)
+    if blob.get("thumbnail"):
+        await storage_for_record(blob["thumbnail"]).delete(db, blob["thumbnail"])
+    for variant in blob.get("variants", {}).values():
+        await storage_for_record(variant).delete(db, variant)
+    await db.image_blobs.delete_one({"_id": digest})
+
+
+async def image_source(db: AsyncIOMotorDatabase, record: dict) -> dict:
+    """
+    Return the document that holds the storage reference of an image record
+
+    Records saved before deduplication keep the reference themselves.
+
+    Raises:
+        LookupError: If the record points at a missing blob
+    """
+    if "content_hash" not in record:
+        return record
+    blob = await db.image_blobs.find_one({"_id": record["content_hash"]})
+    if blob is None:
+        raise LookupError(f"Missing image blob {record['content_hash']}")
+    return blob
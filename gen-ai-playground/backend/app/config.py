@@ -2,38 +2,167 @@
 Application configuration and environment variables
 """
 import os
+from typing import Any, Callable, Dict, Optional
 from dotenv import load_dotenv
 
 # Load environment variables from .env.local
 load_dotenv('.env.local')
 
 
+def parse_key_values(value: Optional[str], cast: Callable[[str], Any] = int) -> Dict[str, Any]:
+    """Parse a setting written as KEY=value,KEY=value, such as per-model overrides"""
+    values = {}
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        key, _, setting = item.partition("=")
+        values[key.strip()] = cast(setting.strip())
+    return values
+
+
 class Settings:
     """Application settings loaded from environment variables"""
     
     # MongoDB
     MONGO_DB_URL: str = os.getenv("MONGO_DB_URL")
-    
+    MONGO_DB_NAME: str = os.getenv("MONGO_DB_NAME", "gen_ai_playground")
+    # Connection pool of the async client, per process
+    MONGO_MAX_POOL_SIZE: int = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+    MONGO_MIN_POOL_SIZE: int = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+    MONGO_MAX_IDLE_TIME_MS: int = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000"))
+    MONGO_WAIT_QUEUE_TIMEOUT_MS: int = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "10000"))
+    MONGO_SERVER_SELECTION_TIMEOUT_MS: int = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "30000"))
+
     # API Keys
     VERDA_API_KEY: str = os.getenv("VERDA_API_KEY")
+    # Host of the model APIs, changed to run against a fake one (benchmarks/fake_verda.py)
+    VERDA_BASE_URL: str = os.getenv("VERDA_BASE_URL", "https://inference.datacrunch.io").rstrip("/")
     
     # JWT
     JWT_SECRET_KEY: str = os.getenv("JWT_SECRET_KEY")
     JWT_EXPIRY_HOURS: int = 24
     
+    # Cache of verified tokens used by get_current_user
+    AUTH_CACHE_ENABLED: bool = os.getenv("AUTH_CACHE_ENABLED", "true").lower() == "true"
+    AUTH_CACHE_MAX_ENTRIES: int = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
+    AUTH_CACHE_TTL_SECONDS: float = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "60"))
+    
     # CORS
     ALLOWED_ORIGINS: str = os.getenv("ALLOWED_ORIGINS")
     
     # Authentication
     INVITATION_CODE: str = os.getenv("INVITATION_CODE")
     
+    # Password hashing: bcrypt cost factor and its dedicated thread pool
+    BCRYPT_ROUNDS: int = int(os.getenv("BCRYPT_ROUNDS", "12"))
+    PASSWORD_HASH_WORKERS: int = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+    PASSWORD_HASH_QUEUE_SIZE: int = int(os.getenv("PASSWORD_HASH_QUEUE_SIZE", "64"))
+    
+    # Structured logging: level of the app's loggers, per-logger levels such as
+    # "app.persistence=DEBUG" and the share of request summaries logged per
+    # route, such as "/images/blobs/{digest}=0.1"
+    LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
+    LOG_LEVEL_OVERRIDES: str = os.getenv("LOG_LEVEL_OVERRIDES", "")
+    LOG_SAMPLE_RATES: str = os.getenv("LOG_SAMPLE_RATES", "")
+    LOG_QUEUE_SIZE: int = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+    # Tracing: "none", "file" (OTLP/JSON lines appended to TRACE_FILE) or "otlp"
+    # (POSTed to an OTLP/HTTP collector); the share of new traces recorded
+    TRACE_EXPORTER: str = os.getenv("TRACE_EXPORTER", "none")
+    TRACE_FILE: str = os.getenv("TRACE_FILE", "traces.jsonl")
+    TRACE_OTLP_ENDPOINT: str = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+    TRACE_SAMPLE_RATE: float = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+    TRACE_QUEUE_SIZE: int = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+    
+    # Largest image /images/edit-image accepts, checked while the upload streams in
+    EDIT_IMAGE_MAX_BYTES: int = int(os.getenv("EDIT_IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+    
+    # Image storage: "inline", "gridfs" or "filesystem"
+    IMAGE_STORAGE_BACKEND: str = os.getenv("IMAGE_STORAGE_BACKEND", "inline")
+    IMAGE_STORAGE_PATH: str = os.getenv("IMAGE_STORAGE_PATH", "/data/images")
+    
+    # Thumbnails and placeholders created after an image is saved
+    THUMBNAIL_SIZE: int = int(os.getenv("THUMBNAIL_SIZE", "256"))
+    THUMBNAIL_QUALITY: int = int(os.getenv("THUMBNAIL_QUALITY", "75"))
+    THUMBNAIL_WORKERS: int = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+    PLACEHOLDER_SIZE: int = int(os.getenv("PLACEHOLDER_SIZE", "16"))
+    
+    # WebP/AVIF variants of returned images, negotiated with Accept or ?format=
+    IMAGE_FORMAT_PREFERENCE: str = os.getenv("IMAGE_FORMAT_PREFERENCE", "webp,avif")
+    IMAGE_WEBP_QUALITY: int = int(os.getenv("IMAGE_WEBP_QUALITY", "80"))
+    IMAGE_AVIF_QUALITY: int = int(os.getenv("IMAGE_AVIF_QUALITY", "60"))
+    TRANSCODE_WORKERS: int = int(os.getenv("TRANSCODE_WORKERS", "2"))
+    
+    # Write-behind saving of generated images to the history
+    HISTORY_WRITE_QUEUE_SIZE: int = int(os.getenv("HISTORY_WRITE_QUEUE_SIZE", "256"))
+    HISTORY_WRITE_BATCH_SIZE: int = int(os.getenv("HISTORY_WRITE_BATCH_SIZE", "32"))
+    HISTORY_WRITE_RETRIES: int = int(os.getenv("HISTORY_WRITE_RETRIES", "3"))
+    HISTORY_WRITE_RETRY_DELAY: float = float(os.getenv("HISTORY_WRITE_RETRY_DELAY", "0.5"))
+    
+    # Result cache for requests with an explicit seed
+    RESULT_CACHE_ENABLED: bool = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+    RESULT_CACHE_MAX_ENTRIES: int = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "64"))
+    RESULT_CACHE_MAX_BYTES: int = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    RESULT_CACHE_TTL_SECONDS: int = int(os.getenv("RESULT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+    
+    # Share one upstream call between identical concurrent requests
+    SINGLE_FLIGHT_ENABLED: bool = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+
+    # Most images one /images/generate/batch request may ask for
+    GENERATION_BATCH_MAX_ITEMS: int = int(os.getenv("GENERATION_BATCH_MAX_ITEMS", "16"))
+
+    # Background generation jobs (?mode=async)
+    JOB_WORKERS: int = int(os.getenv("JOB_WORKERS", "4"))
+    JOB_QUEUE_SIZE: int = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+    JOB_EVENTS_KEEPALIVE_SECONDS: float = float(os.getenv("JOB_EVENTS_KEEPALIVE_SECONDS", "15"))
+    # A running job is owned by one replica while it renews its lease; another
+    # replica takes it over once the lease has expired
+    JOB_LEASE_SECONDS: float = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+    # Finished jobs are removed by a TTL index this long after finishing
+    JOB_RETENTION_SECONDS: int = int(os.getenv("JOB_RETENTION_SECONDS", str(7 * 24 * 3600)))
+    
+    # Admission control: concurrent upstream calls per model and how many may wait
+    UPSTREAM_MODEL_CONCURRENCY: int = int(os.getenv("UPSTREAM_MODEL_CONCURRENCY", "4"))
+    # Per-model limits, e.g. "FLUX2_KLEIN_9B=2,FLUX2_KLEIN_4B=8"
+    UPSTREAM_MODEL_CONCURRENCY_OVERRIDES: str = os.getenv("UPSTREAM_MODEL_CONCURRENCY_OVERRIDES", "")
+    UPSTREAM_MODEL_QUEUE_SIZE: int = int(os.getenv("UPSTREAM_MODEL_QUEUE_SIZE", "16"))
+    UPSTREAM_QUEUE_TIMEOUT: float = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "30"))
+    
+    # Retries and circuit breaker for upstream calls
+    UPSTREAM_RETRY_ATTEMPTS: int = int(os.getenv("UPSTREAM_RETRY_ATTEMPTS", "3"))
+    UPSTREAM_RETRY_BASE_DELAY: float = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", "0.5"))
+    UPSTREAM_RETRY_MAX_DELAY: float = float(os.getenv("UPSTREAM_RETRY_MAX_DELAY", "8"))
+    UPSTREAM_BREAKER_FAILURE_THRESHOLD: int = int(os.getenv("UPSTREAM_BREAKER_FAILURE_THRESHOLD", "5"))
+    UPSTREAM_BREAKER_RESET_SECONDS: float = float(os.getenv("UPSTREAM_BREAKER_RESET_SECONDS", "30"))
+    # Per-model read deadlines, e.g. "FLUX1_KREA_DEV=180"
+    UPSTREAM_MODEL_READ_TIMEOUT_OVERRIDES: str = os.getenv("UPSTREAM_MODEL_READ_TIMEOUT_OVERRIDES", "")
+
     # API URLs
     MODEL_URLS ={
-        "FLUX1_KONTEXT_DEV": "https://inference.datacrunch.io/flux-kontext-dev/predict",
-        "FLUX1_KREA_DEV": "https://inference.datacrunch.io/flux-krea-dev/runsync",
-        "FLUX2_KLEIN_9B": "https://inference.datacrunch.io/flux2-klein-9b/generate",
-        "FLUX2_KLEIN_4B": "https://inference.datacrunch.io/flux2-klein-4b/generate"
+        "FLUX1_KONTEXT_DEV": f"{VERDA_BASE_URL}/flux-kontext-dev/predict",
+        "FLUX1_KREA_DEV": f"{VERDA_BASE_URL}/flux-krea-dev/runsync",
+        "FLUX2_KLEIN_9B": f"{VERDA_BASE_URL}/flux2-klein-9b/generate",
+        "FLUX2_KLEIN_4B": f"{VERDA_BASE_URL}/flux2-klein-4b/generate"
+    }
+    
+    # Model families a request may name instead of a model, in order of preference
+    MODEL_FAMILIES = {
+        "FLUX2_KLEIN": ["FLUX2_KLEIN_9B", "FLUX2_KLEIN_4B"]
     }
+    
+    # Latency-aware routing: calls remembered per model and the percentile used to predict latency
+    ROUTING_WINDOW_SIZE: int = int(os.getenv("ROUTING_WINDOW_SIZE", "200"))
+    ROUTING_PERCENTILE: float = float(os.getenv("ROUTING_PERCENTILE", "90"))
+    
+    # Upstream HTTP client (connection pool per model host)
+    UPSTREAM_MAX_CONNECTIONS: int = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+    UPSTREAM_MAX_KEEPALIVE_CONNECTIONS: int = int(os.getenv("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+    UPSTREAM_KEEPALIVE_EXPIRY: float = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+    UPSTREAM_CONNECT_TIMEOUT: float = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "10"))
+    UPSTREAM_READ_TIMEOUT: float = float(os.getenv("UPSTREAM_READ_TIMEOUT", "120"))
+    UPSTREAM_WRITE_TIMEOUT: float = float(os.getenv("UPSTREAM_WRITE_TIMEOUT", "30"))
+    UPSTREAM_POOL_TIMEOUT: float = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "30"))
+    UPSTREAM_HTTP2: bool = os.getenv("UPSTREAM_HTTP2", "true").lower() == "true"
 
 
 settings = Settings()
@@ -1,53 +1,90 @@
 """
 Database connection and utilities
+
+The application talks to MongoDB through Motor, so database calls are
+awaited on the event loop instead of blocking it or a threadpool slot.
 """
-from pymongo import MongoClient
-from pymongo.database import Database
-from typing import Optional
+import logging
+import time
+from contextlib import contextmanager
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from typing import Iterator, Optional
 from app.config import settings
+from app.indexes import ensure_indexes
+from app.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+operation_duration = registry.histogram(
+    "mongo_operation_seconds",
+    "Time taken by database operations on request paths",
+    ("operation",)
+)
+
+
+@contextmanager
+def timed(operation: str) -> Iterator[None]:
+    """Observe how long the database calls in the block take"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        operation_duration.observe(time.monotonic() - started, operation=operation)
 
 
 class DatabaseManager:
     """Manages MongoDB connection"""
-    
+
     def __init__(self):
-        self.client: Optional[MongoClient] = None
-        self.db: Optional[Database] = None
-        self._connect()
-    
-    def _connect(self):
-        """Establish MongoDB connection"""
+        self.client: Optional[AsyncIOMotorClient] = None
+        self.db: Optional[AsyncIOMotorDatabase] = None
+
+    async def connect(self):
+        """Establish MongoDB connection, called by the app lifespan"""
         if not settings.MONGO_DB_URL:
-            print("MONGO_DB_URL not set, continuing without database support...")
+            logger.warning("MONGO_DB_URL not set, continuing without database support...")
             return
-        
+
         try:
-            self.client = MongoClient(settings.MONGO_DB_URL)
-            self.db = self.client["gen_ai_playground"]
+            self.client = AsyncIOMotorClient(
+                settings.MONGO_DB_URL,
+                maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+                minPoolSize=settings.MONGO_MIN_POOL_SIZE,
+                maxIdleTimeMS=settings.MONGO_MAX_IDLE_TIME_MS,
+                waitQueueTimeoutMS=settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+                serverSelectionTimeoutMS=settings.MONGO_SERVER_SELECTION_TIMEOUT_MS
+            )
+            self.db = self.client[settings.MONGO_DB_NAME]
             # Test connection
-            self.client.admin.command('ping')
-            print("Successfully connected to MongoDB!")
+            await self.client.admin.command('ping')
+            logger.info("Successfully connected to MongoDB!")
+            await ensure_indexes(self.db)
         except Exception as e:
-            print(f"Failed to connect to MongoDB: {e}")
-            print("Continuing without database support...")
-            self.client = None
-            self.db = None
-    
-    def get_db(self) -> Optional[Database]:
+            logger.error(f"Failed to connect to MongoDB: {e}, continuing without database support...")
+            self.close()
+
+    def close(self):
+        """Close the connection pool"""
+        if self.client is not None:
+            self.client.close()
+        self.client = None
+        self.db = None
+
+    def get_db(self) -> Optional[AsyncIOMotorDatabase]:
         """Get database instance"""
         return self.db
-    
+
     def is_available(self) -> bool:
         """Check if database is available"""
         return self.db is not None
 
 
-# Global database manager instance
+# Global database manager instance, connected by the app lifespan
 db_manager = DatabaseManager()
 
 
-def get_database() -> Database:
-    """Dependency to get database instance"""
+async def get_database() -> AsyncIOMotorDatabase:
+    """Dependency to get database instance, async so it is not run in the threadpool"""
     db = db_manager.get_db()
     if db is None:
         from fastapi import HTTPException
@@ -0,0 +1,131 @@
+"""
+Conditional and ranged delivery of stored images
+
+Stored images never change: a blob is named by the SHA-256 of its bytes and
+a record always points at the same blob. Responses therefore carry a strong
+ETag derived from the content hash and may be cached forever. A request whose
+If-None-Match names the ETag is answered with 304 and no body, and a single
+byte range (Range: bytes=start-end, honoured when If-Range still matches)
+is answered with 206 and just those bytes.
+"""
+import re
+from typing import AsyncIterator, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+
+# Only the user who owns an image may fetch it, so shared caches must not keep it
+IMMUTABLE = "private, max-age=31536000, immutable"
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def make_etag(key: str) -> str:
+    """A strong entity tag for content named by key"""
+    return f'"{key}"'
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """
+    Whether an If-None-Match header names the entity tag
+
+    Uses the weak comparison RFC 9110 prescribes for If-None-Match, so
+    W/"x" matches "x".
+    """
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    The inclusive byte range a Range header asks for
+
+    Headers this module does not serve (other units, several ranges) are
+    ignored and the whole image is sent.
+
+    Returns:
+        Optional[Tuple[int, int]]: first and last byte, None for the whole image
+
+    Raises:
+        HTTPException: 416 if the range lies outside the image
+    """
+    if not header:
+        return None
+    match = _RANGE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            return None
+    else:
+        # Suffix range: the last n bytes
+        start = max(size - int(last), 0)
+        end = size - 1
+    if start >= size or end < start:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+
+async def slice_chunks(chunks: AsyncIterator[bytes], start: int, end: int) -> AsyncIterator[bytes]:
+    """Yield only bytes start to end (inclusive) of a chunked stream"""
+    position = 0
+    async for chunk in chunks:
+        chunk_end = position + len(chunk)
+        if chunk_end > start:
+            yield chunk[max(start - position, 0):end + 1 - position]
+        position = chunk_end
+        if position > end:
+            break
+
+
+def deliver(request: Request, chunks: AsyncIterator[bytes], etag: str,
+            content_type: str, size: Optional[int] = None, vary: Optional[str] = None) -> Response:
+    """
+    Answer a GET for a stored image, honouring If-None-Match and Range
+
+    Args:
+        request: the incoming request
+        chunks: the image bytes in order, only consumed when sent
+        etag: strong entity tag of the image
+        content_type: media type of the image
+        size: length of the image; ranges are only served when it is known
+        vary: request headers that chose the representation, e.g. Accept
+
+    Returns:
+        Response: 304 without a body, 206 with a range or 200 with the image
+    """
+    headers = {"ETag": etag, "Cache-Control": IMMUTABLE, "Content-Disposition": "inline"}
+    if vary:
+        headers["Vary"] = vary
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    if size is None:
+        return StreamingResponse(chunks, media_type=content_type, headers=headers)
+
+    headers["Accept-Ranges"] = "bytes"
+    if_range = request.headers.get("if-range")
+    byte_range = None
+    if if_range is None or if_range.strip() == etag:
+        byte_range = parse_range(request.headers.get("range"), size)
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(chunks, media_type=content_type, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        slice_chunks(chunks, start, end),
+        status_code=206,
+        media_type=content_type,
+        headers=headers
+    )
@@ -2,19 +2,24 @@
 FastAPI dependencies for authentication and authorization
 """
 from fastapi import HTTPException, Header, Depends
-from pymongo.database import Database
+from motor.motor_asyncio import AsyncIOMotorDatabase
 import jwt
+from app.auth_cache import auth_cache
 from app.config import settings
-from app.database import get_database
+from app.database import get_database, timed
+from app.logs import phase
 from app.models import UserInfo
+from app.tracing import tracer
 
 
-def get_current_user(
+async def get_current_user(
     authorization: str = Header(...),
-    db: Database = Depends(get_database)
+    db: AsyncIOMotorDatabase = Depends(get_database)
 ) -> UserInfo:
     """
-    Dependency to verify JWT token and extract user information
+    Dependency to verify JWT token and extract user information.
+    Verified tokens are cached, so a repeated token costs no database call.
+    The time taken is logged as the request's auth phase.
     
     Args:
         authorization: Bearer token from Authorization header
@@ -26,42 +31,72 @@ def get_current_user(
     Raises:
         HTTPException: If authentication fails
     """
-    try:
-        # Extract token from Bearer header
-        if not authorization.startswith("Bearer "):
-            raise HTTPException(
-                status_code=401,
-                detail="Invalid authorization header"
-            )
+    with phase("auth"), tracer.span("get_current_user"):
+        try:
+            # Extract token from Bearer header
+            if not authorization.startswith("Bearer "):
+                raise HTTPException(
+                    status_code=401,
+                    detail="Invalid authorization header"
+                )
         
-        token = authorization.replace("Bearer ", "")
+            token = authorization.replace("Bearer ", "")
         
-        # Decode and verify token
-        payload = jwt.decode(
-            token,
-            settings.JWT_SECRET_KEY,
-            algorithms=["HS256"]
-        )
-        username = payload.get("username")
+            if settings.AUTH_CACHE_ENABLED:
+                cached_username = auth_cache.get(token)
+                if cached_username:
+                    return UserInfo(username=cached_username)
         
-        if not username:
-            raise HTTPException(status_code=401, detail="Invalid token")
+            # Decode and verify token
+            payload = jwt.decode(
+                token,
+                settings.JWT_SECRET_KEY,
+                algorithms=["HS256"]
+            )
+            username = payload.get("username")
         
-        # Verify user exists in database
-        user = db.users.find_one({"username": username})
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
+            if not username:
+                raise HTTPException(status_code=401, detail="Invalid token")
         
-        return UserInfo(username=username)
+            generation = auth_cache.generation(username)
+        
+            # Verify user exists in database
+            with timed("auth_user_lookup"):
+                user = await db.users.find_one({"username": username}, {"username": 1, "token_version": 1})
+            if not user:
+                raise HTTPException(status_code=401, detail="User not found")
+            if is_revoked(payload, user):
+                raise HTTPException(status_code=401, detail="Token has been revoked")
+        
+            if settings.AUTH_CACHE_ENABLED and "exp" in payload:
+                auth_cache.put(token, username, payload["exp"], generation)
+            return UserInfo(username=username)
+    
+        except jwt.ExpiredSignatureError:
+            raise HTTPException(status_code=401, detail="Token has expired")
+        except jwt.InvalidTokenError:
+            raise HTTPException(status_code=401, detail="Invalid token")
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(
+                status_code=401,
+                detail=f"Authentication failed: {str(e)}"
+            )
+
+
+def is_revoked(payload: dict, user: dict) -> bool:
+    """
+    Check whether the user's tokens were revoked after this one was issued
     
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token has expired")
-    except jwt.InvalidTokenError:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(
-            status_code=401,
-            detail=f"Authentication failed: {str(e)}"
-        )
+    Each user has a token_version that is stamped into their tokens and
+    increased when their tokens are revoked.
+    
+    Args:
+        payload: decoded token
+        user: user document with the optional token_version field
+        
+    Returns:
+        bool: True if the token must no longer be accepted
+    """
+    return payload.get("ver", 0) != user.get("token_version", 0)
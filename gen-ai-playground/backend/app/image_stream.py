@@ -0,0 +1,279 @@
+"""
+Incremental extraction of the generated image from a model response
+
+A model answers with a JSON document holding the image as one large base64
+string. Parsing it with resp.json() keeps the raw body, the parsed string
+and the decoded image in memory at once. ImageFieldDecoder instead scans
+the body as it arrives: the image string is base64-decoded chunk by chunk
+into a single buffer, a few small fields such as "status" are kept, and
+every other value is skipped without being stored.
+"""
+import binascii
+import io
+import json
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+PathElement = Union[str, int]
+Path = Tuple[PathElement, ...]
+
+# Longest small field that is kept, longer ones are dropped
+MAX_FIELD_LENGTH = 1024
+# A data URL prefix such as "data:image/png;base64," ends within this many bytes
+MAX_PREFIX_LENGTH = 256
+_WHITESPACE = b" \t\r\n"
+# Escapes that can appear in a base64 string: "\/" and line breaks
+_BASE64_ESCAPES = {ord("/"): b"/", ord("n"): b"", ord("r"): b"", ord("t"): b""}
+
+# Container frames on the parser stack
+_OBJECT = "object"
+_ARRAY = "array"
+
+# What the parser expects next
+_VALUE = "value"
+_KEY = "key"
+_COLON = "colon"
+_AFTER_VALUE = "after value"
+
+
+def image_path(model: str) -> Path:
+    """Where a model's response keeps the image"""
+    if "KLEIN" in model:
+        return ("image",)
+    return ("output", "outputs", 0)
+
+
+class ImageFieldDecoder:
+    """
+    Scans a JSON response fed in chunks and decodes the image field
+
+    Args:
+        image_path: keys and array indexes leading to the base64 image string
+        fields: paths of small string values to keep, e.g. ("status",)
+    """
+
+    def __init__(self, image_path: Path, fields: Sequence[Path] = ()):
+        self.image_path = tuple(image_path)
+        self.fields: Dict[Path, str] = {}
+        self._wanted_fields = {tuple(path) for path in fields}
+        self._image: Optional[io.BytesIO] = None
+        self._pending = b""  # base64 characters not yet forming a whole quantum
+        self._prefix: Optional[bytearray] = None  # start of the image, until any data URL prefix is gone
+        # Parser state
+        self._stack: List[list] = []  # [kind, key or index]
+        self._expect = _VALUE
+        self._string: Optional[str] = None  # None, "key", "image", "field" or "skip"
+        self._string_parts: List[bytes] = []
+        self._string_length = 0
+        self._escape = b""  # an escape sequence split across chunks
+        self._literal = False
+        self._done = False
+
+    # Paths
+
+    def _path(self) -> Path:
+        return tuple(frame[1] for frame in self._stack)
+
+    # Feeding
+
+    def feed(self, chunk: bytes):
+        """Consume the next piece of the response body"""
+        position = 0
+        length = len(chunk)
+        while position < length:
+            if self._string is not None:
+                position = self._feed_string(chunk, position)
+                continue
+            byte = chunk[position]
+            if self._literal:
+                # Numbers, true, false and null end at a delimiter
+                if byte in b",]}" or byte in _WHITESPACE:
+                    self._literal = False
+                    self._end_value()
+                    continue
+                position += 1
+                continue
+            position += 1
+            if byte in _WHITESPACE:
+                continue
+            self._feed_structure(byte)
+
+    def _feed_structure(self, byte: int):
+        if self._done:
+            raise ValueError("Unexpected data after the JSON document")
+        if self._expect == _KEY:
+            if byte == ord('"'):
+                self._start_string("key")
+            elif byte == ord("}") and self._stack[-1][1] is None:
+                self._close(_OBJECT)
+            else:
+                raise ValueError("Expected an object key")
+        elif self._expect == _COLON:
+            if byte != ord(":"):
+                raise ValueError("Expected ':' after an object key")
+            self._expect = _VALUE
+        elif self._expect == _AFTER_VALUE:
+            if byte == ord(","):
+                frame = self._stack[-1]
+                if frame[0] == _ARRAY:
+                    frame[1] += 1
+                    self._expect = _VALUE
+                else:
+                    frame[1] = None
+                    self._expect = _KEY
+            elif byte == ord("}"):
+                self._close(_OBJECT)
+            elif byte == ord("]"):
+                self._close(_ARRAY)
+            else:
+                raise ValueError("Expected ',' or the end of a container")
+        else:
+            if byte == ord("{"):
+                self._stack.append([_OBJECT, None])
+                self._expect = _KEY
+            elif byte == ord("["):
+                self._stack.append([_ARRAY, 0])
+                self._expect = _VALUE
+            elif byte == ord("]") and self._stack and self._stack[-1] == [_ARRAY, 0]:
+                # Empty array
+                self._close(_ARRAY)
+            elif byte == ord('"'):
+                path = self._path()
+                if path == self.image_path:
+                    self._start_image()
+                elif path in self._wanted_fields:
+                    self._start_string("field")
+                else:
+                    self._start_string("skip")
+            else:
+                self._literal = True
+
+    def _close(self, kind: str):
+        if not self._stack or self._stack[-1][0] != kind:
+            raise ValueError(f"Unbalanced {kind} in JSON document")
+        self._stack.pop()
+        self._end_value()
+
+    def _end_value(self):
+        if not self._stack:
+            self._done = True
+        self._expect = _AFTER_VALUE
+
+    # Strings
+
+    def _start_string(self, kind: str):
+        self._string = kind
+        self._string_parts = []
+        self._string_length = 0
+
+    def _start_image(self):
+        if self._image is not None:
+            raise ValueError("The image field appears twice")
+        self._image = io.BytesIO()
+        self._prefix = bytearray()
+        self._start_string("image")
+
+    def _feed_string(self, chunk: bytes, position: int) -> int:
+        """Consume string content from position, returns where to continue"""
+        if self._escape:
+            # Finish an escape split across chunks; \uXXXX needs four more bytes
+            needed = 6 if self._escape[1:2] == b"u" else 2
+            take = min(needed - len(self._escape), len(chunk) - position)
+            self._escape += chunk[position:position + take]
+            position += take
+            if len(self._escape) == 2 and self._escape[1:2] == b"u":
+                return position
+            if len(self._escape) == needed:
+                escape, self._escape = self._escape, b""
+                self._string_content(escape, escaped=True)
+            return position
+
+        end = len(chunk)
+        quote = chunk.find(b'"', position)
+        backslash = chunk.find(b"\\", position)
+        if quote != -1:
+            end = quote
+        if backslash != -1 and backslash < end:
+            if backslash > position:
+                self._string_content(chunk[position:backslash])
+            self._escape = b"\\"
+            return backslash + 1
+        if end > position:
+            self._string_content(chunk[position:end])
+        if quote == -1:
+            return len(chunk)
+        self._end_string()
+        return quote + 1
+
+    def _string_content(self, data: bytes, escaped: bool = False):
+        if self._string == "skip":
+            return
+        if self._string == "image":
+            if escaped:
+                data = self._unescape_base64(data)
+            self._image_content(data)
+            return
+        self._string_length += len(data)
+        if self._string_length <= MAX_FIELD_LENGTH:
+            self._string_parts.append(data)
+
+    @staticmethod
+    def _unescape_base64(escape: bytes) -> bytes:
+        try:
+            return _BASE64_ESCAPES[escape[1]]
+        except KeyError:
+            raise ValueError("Unexpected escape in the base64 image")
+
+    def _end_string(self):
+        kind = self._string
+        self._string = None
+        if kind == "key":
+            self._stack[-1][1] = self._decode_string()
+            self._expect = _COLON
+            return
+        if kind == "field" and self._string_length <= MAX_FIELD_LENGTH:
+            self.fields[self._path()] = self._decode_string()
+        elif kind == "image":
+            self._finish_image()
+        self._end_value()
+
+    def _decode_string(self) -> str:
+        return json.loads(b'"' + b"".join(self._string_parts) + b'"')
+
+    # Base64
+
+    def _image_content(self, data: bytes):
+        if self._prefix is not None:
+            self._prefix += data
+            comma = self._prefix.find(b",")
+            if comma == -1 and len(self._prefix) < MAX_PREFIX_LENGTH:
+                return
+            # Drop a data URL prefix such as data:image/png;base64,
+            data = bytes(self._prefix[comma + 1:])
+            self._prefix = None
+        data = self._pending + data
+        usable = len(data) - len(data) % 4
+        if usable:
+            self._image.write(binascii.a2b_base64(data[:usable]))
+        self._pending = data[usable:]
+
+    def _finish_image(self):
+        if self._prefix is not None:
+            data = bytes(self._prefix)
+            comma = data.find(b",")
+            self._prefix = None
+            self._image_content(data[comma + 1:])
+        if self._pending:
+            # Unpadded tail, a2b_base64 rejects it unless completed
+            self._image.write(binascii.a2b_base64(self._pending + b"=" * (-len(self._pending) % 4)))
+            self._pending = b""
+
+    # Result
+
+    def image(self) -> Optional[bytes]:
+        """The decoded image once the document is complete, None if it had no image"""
+        if not self._done:
+            raise ValueError("Incomplete JSON document")
+        if self._image is None:
+            return None
+        # getvalue hands over the buffer without copying it
+        return self._image.getvalue() or None
@@ -0,0 +1,32 @@
+"""
+Helpers for working with image bytes
+"""
+
+# Leading bytes of the formats the models and users send us
+_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+
+def sniff_content_type(data: bytes, default: str = "image/png") -> str:
+    """
+    Guess the MIME type of an image from its first bytes
+
+    Args:
+        data: the image, or at least its first 16 bytes
+        default: type to return when the format is not recognised
+
+    Returns:
+        str: MIME type such as image/png
+    """
+    for signature, content_type in _SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:12] in (b"ftypavif", b"ftypavis"):
+        return "image/avif"
+    return default
@@ -0,0 +1,163 @@
+"""
+Declarative MongoDB indexes and query-plan checks
+
+INDEXES lists every index the application relies on, per collection. They
+are created when DatabaseManager connects; creating an index that already
+exists is a no-op. HOT_QUERIES lists the queries on the request path, and
+check_query_plans runs explain() on each to confirm it uses an index:
+
+    $ python -m app.indexes --explain
+"""
+import argparse
+import asyncio
+import logging
+import sys
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        # Login, authentication and the duplicate check in register
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+    ],
+    "images": [
+        # History pages: newest first with _id as tie breaker for the cursor
+        IndexModel(
+            [("username", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)],
+            name="username_timestamp"
+        ),
+        # Reusing a user's uploaded original with the same content, serving /images/blobs/{hash}
+        IndexModel(
+            [("username", ASCENDING), ("content_hash", ASCENDING)],
+            name="username_content_hash"
+        ),
+        # Records saved before deduplication sharing a filesystem file
+        IndexModel([("storage_ref", ASCENDING)], name="storage_ref", sparse=True),
+    ],
+    "jobs": [
+        # Requeuing unfinished jobs on startup
+        IndexModel([("status", ASCENDING), ("created_at", ASCENDING)], name="status_created_at"),
+        # Mongo removes finished jobs JOB_RETENTION_SECONDS after they finished
+        IndexModel(
+            [("finished_at", ASCENDING)],
+            name="finished_at_ttl",
+            expireAfterSeconds=settings.JOB_RETENTION_SECONDS
+        ),
+    ],
+    "generation_cache": [
+        # Mongo removes result cache entries once they expire
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+}
+
+# name -> (collection, filter, sort) of the queries on the request path
+HOT_QUERIES: Dict[str, Tuple[str, dict, Optional[list]]] = {
+    "user_by_username": ("users", {"username": "explain"}, None),
+    "history_first_page": (
+        "images", {"username": "explain"}, [("timestamp", -1), ("_id", -1)]
+    ),
+    "original_by_content": (
+        "images",
+        {"username": "explain", "image_type": "original", "content_hash": "explain"},
+        None
+    ),
+    "unfinished_jobs": ("jobs", {"status": "queued"}, [("created_at", 1)]),
+}
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase):
+    """
+    Create every index in INDEXES
+
+    A failing index (e.g. duplicate usernames left from before the unique
+    index) is reported and the others are still created.
+
+    Args:
+        db: Database instance
+    """
+    for collection, indexes in INDEXES.items():
+        try:
+            await db[collection].create_indexes(indexes)
+        except Exception as e:
+            logger.error(f"Failed to create indexes on {collection}: {e}")
+
+
+def plan_stages(plan: dict) -> Iterator[str]:
+    """Every stage of an explain() winning plan, outermost first"""
+    stack = [plan]
+    while stack:
+        stage = stack.pop()
+        if "stage" in stage:
+            yield stage["stage"]
+        if "inputStage" in stage:
+            stack.append(stage["inputStage"])
+        stack.extend(stage.get("inputStages", []))
+        # Slot based engine wraps the classic plan in queryPlan
+        if "queryPlan" in stage:
+            stack.append(stage["queryPlan"])
+
+
+def winning_plan(explain: dict) -> dict:
+    return explain.get("queryPlanner", {}).get("winningPlan", {})
+
+
+def uses_index(explain: dict) -> bool:
+    """Whether an explain() result reads through an index instead of scanning"""
+    stages = set(plan_stages(winning_plan(explain)))
+    return "COLLSCAN" not in stages and bool(stages & {"IXSCAN", "IDHACK", "EXPRESS_IXSCAN"})
+
+
+async def check_query_plans(db: AsyncIOMotorDatabase) -> Dict[str, bool]:
+    """
+    Explain every query in HOT_QUERIES
+
+    Args:
+        db: Database instance
+
+    Returns:
+        Dict[str, bool]: for each query, whether it uses an index
+    """
+    results = {}
+    for name, (collection, query, sort) in HOT_QUERIES.items():
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        results[name] = uses_index(await cursor.explain())
+    return results
+
+
+async def run(explain: bool):
+    from app.database import db_manager
+    # Connecting creates the indexes
+    await db_manager.connect()
+    db = db_manager.get_db()
+    if db is None:
+        sys.exit("Database not available")
+
+    try:
+        if explain:
+            results = await check_query_plans(db)
+            for name, indexed in results.items():
+                print(f"{name}: {'index' if indexed else 'COLLECTION SCAN'}")
+            if not all(results.values()):
+                sys.exit(1)
+    finally:
+        db_manager.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create the application's MongoDB indexes")
+    parser.add_argument("--explain", action="store_true",
+                        help="also check that the hot queries use an index")
+    args = parser.parse_args()
+    asyncio.run(run(args.explain))
+
+
+if __name__ == "__main__":
+    main()
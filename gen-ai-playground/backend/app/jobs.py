@@ -0,0 +1,338 @@
+"""
+Background generation jobs
+
+In async mode a generation request is stored as a job document in the jobs
+collection and answered right away with the job id. A bounded pool of
+worker tasks runs the queued jobs and records their outcome on the job
+document, where clients poll it or follow it as server-sent events.
+
+A running job is owned by the replica that took it and carries a lease
+that the replica renews while it works; a replica that finds its lease
+taken over stops running the job. Queued jobs and running jobs whose
+lease expired, because their replica stopped, are queued again on startup
+and by a periodic sweep; jobs still leased by a live replica are left
+alone. Finished jobs get finished_at, from which a TTL index removes them
+after JOB_RETENTION_SECONDS.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set
+
+from bson import ObjectId
+from fastapi import HTTPException
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument
+
+from app.config import settings
+from app.metrics import registry
+from app.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+FINISHED_STATES = (COMPLETED, FAILED)
+
+jobs_total = registry.counter(
+    "generation_jobs_total",
+    "Generation jobs by final state",
+    ("status",)
+)
+job_queue_depth = registry.gauge(
+    "generation_job_queue_depth",
+    "Generation jobs waiting for a worker"
+)
+
+# Runs a job and returns the fields describing its result
+JobHandler = Callable[[AsyncIOMotorDatabase, dict], Awaitable[dict]]
+
+
+def job_view(job: dict) -> dict:
+    """Public representation of a job document"""
+    job_id = str(job["_id"])
+    view = {
+        "job_id": job_id,
+        "status": job["status"],
+        "created_at": job["created_at"].isoformat(),
+        "updated_at": job["updated_at"].isoformat(),
+        "status_url": f"/images/jobs/{job_id}",
+        "events_url": f"/images/jobs/{job_id}/events"
+    }
+    if job.get("result"):
+        view["image_id"] = job["result"]["image_id"]
+        view["image_url"] = f"/images/{job['result']['image_id']}"
+        if "model" in job["result"]:
+            view["model"] = job["result"]["model"]
+    if job.get("error"):
+        view["error"] = job["error"]
+    return view
+
+
+class JobManager:
+    """Queue and worker pool for generation jobs"""
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._sweeper: Optional[asyncio.Task] = None
+        self._handler: Optional[JobHandler] = None
+        self._changes: Dict[str, asyncio.Event] = {}
+        self._queued: Set[ObjectId] = set()  # ids in the queue, so a sweep does not add them twice
+        # Identifies this replica as the owner of the jobs it runs
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    async def start(self, handler: JobHandler, db: Optional[AsyncIOMotorDatabase] = None):
+        """
+        Start the worker pool and queue jobs left over from a previous run
+
+        Args:
+            handler: runs a job document and returns its result fields
+            db: database to recover unfinished jobs from
+        """
+        self._handler = handler
+        self._queue = asyncio.Queue(maxsize=settings.JOB_QUEUE_SIZE)
+        self._workers = [
+            asyncio.create_task(self._worker())
+            for _ in range(settings.JOB_WORKERS)
+        ]
+        if db is not None:
+            await self.recover(db)
+            self._sweeper = asyncio.create_task(self._sweep(db))
+
+    async def stop(self):
+        """Stop the workers, their running jobs are taken over once their leases expire"""
+        tasks = self._workers + ([self._sweeper] if self._sweeper else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._sweeper = None
+        self._queued.clear()
+        self._queue = None
+        job_queue_depth.set(0)
+
+    async def recover(self, db: AsyncIOMotorDatabase) -> int:
+        """
+        Queue the unfinished jobs no live replica is working on
+
+        Running jobs count only once their lease has expired (or, from
+        before leases, when they have none). Queued jobs may also sit in
+        another replica's queue; taking them is safe, as only one replica
+        can move a job from queued to running.
+
+        Returns:
+            int: how many jobs were queued
+        """
+        await self._release_expired(db)
+        recovered = 0
+        unfinished = db.jobs.find({"status": QUEUED}, {"_id": 1}).sort("created_at", 1)
+        async for job in unfinished:
+            if job["_id"] in self._queued:
+                continue
+            if self._queue.full():
+                logger.warning("Job queue full, leaving remaining unfinished jobs for a later sweep")
+                break
+            self._enqueue(db, job["_id"])
+            recovered += 1
+        job_queue_depth.set(self._queue.qsize())
+        if recovered:
+            logger.info(f"Requeued {recovered} unfinished generation job(s)")
+        return recovered
+
+    async def _release_expired(self, db: AsyncIOMotorDatabase):
+        """Put running jobs whose owner stopped renewing the lease back in the queue"""
+        now = datetime.now(timezone.utc)
+        result = await db.jobs.update_many(
+            {"status": RUNNING, "$or": [
+                {"lease_expires_at": {"$lt": now}},
+                {"lease_expires_at": {"$exists": False}}
+            ]},
+            {"$set": {"status": QUEUED, "updated_at": now}, "$unset": {"owner": "", "lease_expires_at": ""}}
+        )
+        if result.modified_count:
+            logger.warning(f"Took over {result.modified_count} job(s) whose lease expired")
+
+    async def _sweep(self, db: AsyncIOMotorDatabase):
+        """Periodically pick up jobs of replicas that stopped"""
+        while True:
+            await asyncio.sleep(settings.JOB_LEASE_SECONDS)
+            try:
+                await self.recover(db)
+            except Exception as e:
+                logger.warning(f"Failed to sweep unfinished jobs: {e}")
+
+    def _lease(self) -> datetime:
+        return datetime.now(timezone.utc) + timedelta(seconds=settings.JOB_LEASE_SECONDS)
+
+    async def _renew(self, db: AsyncIOMotorDatabase, job_id: ObjectId, handler: asyncio.Task):
+        """Extend the lease of a running job until cancelled, or cancel the handler once the lease is lost"""
+        while True:
+            await asyncio.sleep(settings.JOB_LEASE_SECONDS / 3)
+            try:
+                result = await db.jobs.update_one(
+                    {"_id": job_id, "owner": self.owner, "status": RUNNING},
+                    {"$set": {"lease_expires_at": self._lease()}}
+                )
+            except Exception as e:
+                logger.warning(f"Failed to renew the lease of job {job_id}: {e}")
+                continue
+            if not result.matched_count:
+                handler.cancel()
+                return
+
+    async def submit(self, db: AsyncIOMotorDatabase, job: dict) -> dict:
+        """
+        Store a new job and queue it
+
+        Args:
+            db: Database instance
+            job: job fields, such as username, kind, prompt and model
+
+        Returns:
+            dict: the stored job document
+
+        Raises:
+            HTTPException: If the workers are not running or the queue is full
+        """
+        if self._queue is None:
+            raise HTTPException(status_code=503, detail="Job workers are not running")
+        self._reject_if_full()
+        now = datetime.now(timezone.utc)
+        job = {**job, "status": QUEUED, "created_at": now, "updated_at": now}
+        job["_id"] = (await db.jobs.insert_one(job)).inserted_id
+        try:
+            # Other requests may have filled the queue while the job was stored
+            self._reject_if_full()
+        except HTTPException:
+            await db.jobs.delete_one({"_id": job["_id"]})
+            raise
+        self._enqueue(db, job["_id"])
+        job_queue_depth.set(self._queue.qsize())
+        return job
+
+    def _enqueue(self, db: AsyncIOMotorDatabase, job_id: ObjectId):
+        self._queue.put_nowait((db, job_id))
+        self._queued.add(job_id)
+
+    def _reject_if_full(self):
+        if self._queue.full():
+            raise HTTPException(
+                status_code=429,
+                detail="Too many queued jobs, try again later",
+                headers={"Retry-After": "5"}
+            )
+
+    async def _worker(self):
+        while True:
+            db, job_id = await self._queue.get()
+            self._queued.discard(job_id)
+            job_queue_depth.set(self._queue.qsize())
+            try:
+                await self._run(db, job_id)
+            except Exception as e:
+                logger.exception(f"Job {job_id} crashed: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, db: AsyncIOMotorDatabase, job_id: ObjectId):
+        job = await db.jobs.find_one_and_update(
+            {"_id": job_id, "status": QUEUED},
+            {"$set": {
+                "status": RUNNING,
+                "owner": self.owner,
+                "lease_expires_at": self._lease(),
+                "updated_at": datetime.now(timezone.utc)
+            }},
+            return_document=ReturnDocument.AFTER
+        )
+        if job is None:
+            # Already taken or finished
+            return
+        self._notify(job_id)
+
+        update = {"updated_at": datetime.now(timezone.utc)}
+        renewal = None
+        try:
+            with tracer.span("generation_job", {"job_id": str(job_id)}, root=True):
+                handler = asyncio.create_task(self._handler(db, job))
+                renewal = asyncio.create_task(self._renew(db, job_id, handler))
+                update["result"] = await handler
+            update["status"] = COMPLETED
+        except asyncio.CancelledError:
+            if renewal is None or not renewal.done():
+                raise
+            # The renewal cancelled the handler: another replica runs the job now
+            logger.warning(f"Job {job_id} was taken over by another replica, stopped running it")
+            return
+        except HTTPException as e:
+            update["status"] = FAILED
+            update["error"] = {"status_code": e.status_code, "detail": e.detail}
+        except Exception as e:
+            update["status"] = FAILED
+            update["error"] = {"status_code": 500, "detail": f"Job failed: {str(e)}"}
+        finally:
+            if renewal is not None:
+                renewal.cancel()
+        update["updated_at"] = update["finished_at"] = datetime.now(timezone.utc)
+
+        # Only while still the owner: a lost lease means another replica took the job over
+        result = await db.jobs.update_one(
+            {"_id": job_id, "owner": self.owner},
+            {"$set": update, "$unset": {"owner": "", "lease_expires_at": ""}}
+        )
+        if not result.modified_count:
+            logger.warning(f"Job {job_id} was taken over by another replica, dropping its result")
+            return
+        jobs_total.inc(status=update["status"])
+        self._notify(job_id)
+
+    def _notify(self, job_id: ObjectId):
+        """Wake up event streams following this job"""
+        event = self._changes.pop(str(job_id), None)
+        if event is not None:
+            event.set()
+
+    async def _wait_for_change(self, job_id: ObjectId, timeout: float):
+        event = self._changes.setdefault(str(job_id), asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def events(self, db: AsyncIOMotorDatabase, job: dict) -> AsyncIterator[str]:
+        """
+        Follow a job as server-sent events until it finishes
+
+        A status event is sent on every state change. Between changes a
+        comment line keeps proxies from closing the idle connection.
+        """
+        job_id = job["_id"]
+        last_status = None
+        while True:
+            if job["status"] != last_status:
+                last_status = job["status"]
+                yield f"event: status\ndata: {json.dumps(job_view(job))}\n\n"
+            if job["status"] in FINISHED_STATES:
+                return
+            await self._wait_for_change(job_id, settings.JOB_EVENTS_KEEPALIVE_SECONDS)
+            refreshed = await db.jobs.find_one({"_id": job_id})
+            if refreshed is None:
+                return
+            if refreshed["status"] == last_status:
+                yield ": keepalive\n\n"
+            job = refreshed
+
+
+# Global job manager instance, started and stopped by the app lifespan
+job_manager = JobManager()
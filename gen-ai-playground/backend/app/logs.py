@@ -0,0 +1,222 @@
+"""
+Structured JSON logging that never blocks the event loop
+
+Log calls only put the record on a bounded queue. A QueueListener thread
+formats each record as one JSON object per line and writes it to stdout, so
+a slow terminal or log collector cannot stall request handling. When the
+queue is full, records are dropped and counted instead of making the caller
+wait.
+
+Every HTTP request gets a request ID. It is taken from the X-Request-ID
+header when the client sent a usable one, and generated otherwise. The ID is
+returned in the response, passed on to the model API and attached to every
+record logged while the request is handled. When the request ends, one
+summary line is logged with its status, its duration and the time spent in
+each phase: auth, upstream, decode and persist. Summaries of busy routes can
+be sampled with LOG_SAMPLE_RATES; failed requests are always logged.
+"""
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Dict, Iterator, Optional
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.config import parse_key_values, settings
+from app.metrics import registry
+from app.request_metrics import route_template
+
+REQUEST_ID_HEADER = "X-Request-ID"
+# Client-supplied IDs are only used when short and free of anything that needs escaping
+_USABLE_REQUEST_ID = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+records_dropped = registry.counter(
+    "log_records_dropped_total",
+    "Log records dropped because the log queue was full"
+)
+
+request_log = logging.getLogger("app.requests")
+_plain = logging.Formatter()
+
+
+class RequestContext:
+    """The request being handled: its ID and the time spent per phase"""
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.phases: Dict[str, float] = {}
+
+
+_current: ContextVar[Optional[RequestContext]] = ContextVar("request_context", default=None)
+
+
+def current_request_id() -> Optional[str]:
+    context = _current.get()
+    return context.request_id if context else None
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Add the time spent in the block to a phase of the current request"""
+    context = _current.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        # Concurrent work of one request (batch items) adds up
+        if context is not None:
+            context.phases[name] = context.phases.get(name, 0.0) + time.perf_counter() - started
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the fields passed as extra={"fields": {...}}"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            entry["request_id"] = request_id
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread, dropping them when the queue is full"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Everything that depends on the caller is resolved here, formatting happens in the thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _plain.formatException(record.exc_info)
+            record.exc_info = None
+        record.request_id = current_request_id()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            records_dropped.inc()
+
+
+class StructuredLogging:
+    """Routes the app's loggers through the queue to a JSON stream"""
+
+    def __init__(self):
+        self._handler: Optional[logging.Handler] = None
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self._sample_rates: Dict[str, float] = {}
+
+    def start(self, stream=None):
+        """Configure the app loggers from settings and start the writer thread"""
+        if self._listener is not None:
+            return
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(JsonFormatter())
+        records: queue.Queue = queue.Queue(maxsize=settings.LOG_QUEUE_SIZE)
+        self._handler = _NonBlockingQueueHandler(records)
+        self._listener = logging.handlers.QueueListener(records, output)
+
+        app_logger = logging.getLogger("app")
+        app_logger.setLevel(settings.LOG_LEVEL.upper())
+        app_logger.addHandler(self._handler)
+        app_logger.propagate = False
+        for name, level in parse_key_values(settings.LOG_LEVEL_OVERRIDES, str).items():
+            logging.getLogger(name).setLevel(level.upper())
+        self._sample_rates = parse_key_values(settings.LOG_SAMPLE_RATES, float)
+        self._listener.start()
+
+    def stop(self):
+        """Write out what is queued and stop the writer thread"""
+        if self._listener is None:
+            return
+        self._listener.stop()
+        app_logger = logging.getLogger("app")
+        app_logger.removeHandler(self._handler)
+        app_logger.propagate = True
+        self._listener = None
+        self._handler = None
+
+    def sample_rate(self, route: str) -> float:
+        """Share of the route's request summaries that are logged"""
+        return self._sample_rates.get(route, 1.0)
+
+
+def usable_request_id(value: Optional[str]) -> Optional[str]:
+    return value if value and _USABLE_REQUEST_ID.match(value) else None
+
+
+class RequestLogMiddleware:
+    """Gives every request an ID and logs a summary line when it ends"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        incoming = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                incoming = value.decode("latin-1")
+        context = RequestContext(usable_request_id(incoming) or uuid.uuid4().hex)
+        status: Optional[int] = None
+
+        async def send_with_id(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                MutableHeaders(scope=message)[REQUEST_ID_HEADER] = context.request_id
+            await send(message)
+
+        token = _current.set(context)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            log_request(scope, status or 500, time.perf_counter() - started, context)
+            _current.reset(token)
+
+
+def log_request(scope: Scope, status: int, duration: float, context: RequestContext):
+    """Log the summary line of a request, unless it is sampled out"""
+    if not request_log.isEnabledFor(logging.INFO):
+        return
+    route = route_template(scope)
+    if status < 500 and random.random() >= structured_logging.sample_rate(route):
+        return
+    request_log.info("request", extra={"fields": {
+        "method": scope["method"],
+        "route": route,
+        "path": scope["path"],
+        "status": status,
+        "duration_ms": round(duration * 1000, 1),
+        "phases_ms": {name: round(seconds * 1000, 1) for name, seconds in context.phases.items()}
+    }})
+
+
+# Global logging setup, started and stopped by the app lifespan
+structured_logging = StructuredLogging()
@@ -0,0 +1,121 @@
+"""
+Move stored images to content-addressed blobs in a storage backend
+
+Records saved before deduplication are converted to blobs, which collapses
+identical images into one stored copy, and existing blobs held by another
+backend are moved over.
+
+Usage:
+    python -m app.migrate_storage --to filesystem
+    python -m app.migrate_storage --to gridfs --dry-run
+"""
+import argparse
+import asyncio
+import sys
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from app.blobs import put_blob
+from app.storage import InlineStorage, get_backend, storage_for_record
+from app.thumbnails import process_thumbnail
+
+# Fields that held the image, or its previews, on records saved before blobs
+LEGACY_FIELDS = ["storage", "storage_ref", "image_data", "width", "height", "placeholder", "thumbnail"]
+
+
+def _not_in_backend(name: str) -> dict:
+    """Query for storage references that are not in the named backend"""
+    if name == InlineStorage.name:
+        return {"storage": {"$nin": [None, name]}}
+    return {"$or": [{"storage": {"$ne": name}}, {"storage": None}]}
+
+
+async def migrate_images(db: AsyncIOMotorDatabase, target_name: str, dry_run: bool = False) -> int:
+    """
+    Store every image as a blob in the target backend
+
+    Args:
+        db: Database instance
+        target_name: name of the backend to move images to
+        dry_run: only count the records and blobs that would be moved
+
+    Returns:
+        int: number of migrated records and blobs
+    """
+    target = get_backend(target_name)
+    migrated = 0
+
+    # Records that still hold their own image
+    async for record in db.images.find({"content_hash": {"$exists": False}}):
+        migrated += 1
+        if dry_run:
+            continue
+
+        source = storage_for_record(record)
+        image_bytes = await source.load(db, record)
+        digest, created = await put_blob(db, image_bytes, storage=target)
+        await db.images.update_one(
+            {"_id": record["_id"]},
+            {
+                "$set": {"content_hash": digest},
+                "$unset": {field: "" for field in LEGACY_FIELDS}
+            }
+        )
+        blob = await db.image_blobs.find_one({"_id": digest}, {"storage": 1, "storage_ref": 1})
+        shares_file = (blob.get("storage") == record.get("storage")
+                       and blob.get("storage_ref") == record.get("storage_ref"))
+        if not shares_file:
+            await source.delete(db, record)
+        if record.get("thumbnail"):
+            await storage_for_record(record["thumbnail"]).delete(db, record["thumbnail"])
+        if created:
+            await process_thumbnail(db, digest, image_bytes)
+
+    # Blobs held by another backend
+    async for blob in db.image_blobs.find(_not_in_backend(target_name)):
+        migrated += 1
+        if dry_run:
+            continue
+
+        source = storage_for_record(blob)
+        update = {"$set": await target.save(db, await source.load(db, blob))}
+        if target_name == InlineStorage.name:
+            update["$unset"] = {"storage_ref": ""}
+        else:
+            update["$unset"] = {"image_data": ""}
+        await db.image_blobs.update_one({"_id": blob["_id"]}, update)
+        await source.delete(db, blob)
+
+    return migrated
+
+
+async def run(target: str, dry_run: bool) -> int:
+    from app.database import db_manager
+    await db_manager.connect()
+    db = db_manager.get_db()
+    if db is None:
+        print("Database not available")
+        return 1
+
+    try:
+        count = await migrate_images(db, target, dry_run)
+    finally:
+        db_manager.close()
+    action = "Would migrate" if dry_run else "Migrated"
+    print(f"{action} {count} image(s) to {target} storage")
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Move stored images to another storage backend")
+    parser.add_argument("--to", dest="target", required=True,
+                        choices=["inline", "gridfs", "filesystem"],
+                        help="backend to move images to")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only report how many images would be moved")
+    args = parser.parse_args(argv)
+    return asyncio.run(run(args.target, args.dry_run))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,6 +11,26 @@ class ImageRequestBody(BaseModel):
     prompt: str
     model: str
     image: Optional[str] = None  
+    seed: Optional[int] = None  # set to make the result reproducible and cacheable
+    latency_budget_ms: Optional[int] = None  # allow falling back to a faster variant of the model
+
+
+class BatchItem(BaseModel):
+    """One image of a batch generation request"""
+    prompt: str
+    model: str
+    seed: Optional[int] = None
+    latency_budget_ms: Optional[int] = None
+
+
+class BatchRequestBody(BaseModel):
+    """Request model for batch generation: a list of items, or one prompt and model with several seeds"""
+    items: Optional[List[BatchItem]] = None
+    prompt: Optional[str] = None
+    model: Optional[str] = None
+    seeds: Optional[List[int]] = None
+    count: Optional[int] = None  # images with random seeds, instead of seeds
+    latency_budget_ms: Optional[int] = None
 
 
 class RegisterRequest(BaseModel):
@@ -40,18 +60,39 @@ class RegisterResponse(BaseModel):
 
 
 class HistoryItem(BaseModel):
-    """Model for a single history item"""
+    """Model for a single history item, the image itself is at image_url"""
+    id: str
     prompt: str
     model: str
     timestamp: datetime
     image_size: int
-    image_data: str
     image_type: str
+    parent_image_id: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    placeholder: Optional[str] = None
+    image_url: Optional[str] = None
+    thumbnail_url: Optional[str] = None
 
 
 class HistoryResponse(BaseModel):
     """Response model for history endpoint"""
     history: List[HistoryItem]
+    next_cursor: Optional[str] = None
+
+
+class JobResponse(BaseModel):
+    """Status of a background generation job"""
+    job_id: str
+    status: str  # queued, running, completed or failed
+    created_at: datetime
+    updated_at: datetime
+    status_url: str
+    events_url: str
+    image_id: Optional[str] = None  # set once completed
+    model: Optional[str] = None  # model that generated the image
+    image_url: Optional[str] = None
+    error: Optional[dict] = None  # status_code and detail, set once failed
 
 
 class UserInfo(BaseModel):
@@ -0,0 +1,108 @@
+"""
+Password hashing off the event loop
+
+bcrypt is deliberately slow, so hashing and checking run in a dedicated
+thread pool of PASSWORD_HASH_WORKERS threads instead of the default
+threadpool shared by every sync endpoint. At most PASSWORD_HASH_QUEUE_SIZE
+operations wait for a thread; beyond that a login storm is answered with
+503 instead of piling up. The cost factor is BCRYPT_ROUNDS, and hashes with
+another cost are replaced on the next successful login.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+import bcrypt
+from fastapi import HTTPException
+
+from app.config import settings
+from app.metrics import registry
+
+T = TypeVar("T")
+
+hash_queue_depth = registry.gauge(
+    "password_hash_pending",
+    "Password hash operations running or waiting for a thread"
+)
+hash_duration = registry.histogram(
+    "password_hash_seconds",
+    "Time from queuing a password hash operation until it finished",
+    ("operation",)
+)
+hash_rejected = registry.counter(
+    "password_hash_rejected_total",
+    "Password hash operations rejected because the queue was full"
+)
+
+
+def hash_cost(hashed: bytes) -> Optional[int]:
+    """Cost factor of a bcrypt hash such as $2b$12$..., None if it is not one"""
+    try:
+        return int(hashed.split(b"$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def hash_password(password: str, rounds: int) -> bytes:
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds=rounds))
+
+
+def check_password(password: str, hashed: bytes) -> bool:
+    return bcrypt.checkpw(password.encode("utf-8"), hashed)
+
+
+class PasswordHasher:
+    """Runs bcrypt in its own bounded thread pool"""
+
+    def __init__(self):
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending = 0
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=settings.PASSWORD_HASH_WORKERS,
+                thread_name_prefix="bcrypt"
+            )
+        return self._executor
+
+    async def _run(self, operation: str, fn: Callable[..., T], *args) -> T:
+        if self._pending >= settings.PASSWORD_HASH_WORKERS + settings.PASSWORD_HASH_QUEUE_SIZE:
+            hash_rejected.inc()
+            raise HTTPException(
+                status_code=503,
+                detail="Too many logins in progress, try again shortly",
+                headers={"Retry-After": "1"}
+            )
+        self._pending += 1
+        hash_queue_depth.set(self._pending)
+        started = time.monotonic()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self._pending -= 1
+            hash_queue_depth.set(self._pending)
+            hash_duration.observe(time.monotonic() - started, operation=operation)
+
+    async def hash(self, password: str) -> bytes:
+        """Hash a password with the configured cost"""
+        return await self._run("hash", hash_password, password, settings.BCRYPT_ROUNDS)
+
+    async def verify(self, password: str, hashed: bytes) -> bool:
+        """Check a password against a stored hash"""
+        return await self._run("verify", check_password, password, hashed)
+
+    def needs_rehash(self, hashed: bytes) -> bool:
+        """Whether a stored hash was made with another cost than configured"""
+        return hash_cost(hashed) != settings.BCRYPT_ROUNDS
+
+    def stop(self):
+        """Release the threads"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+# Global password hasher, stopped by the app lifespan
+password_hasher = PasswordHasher()
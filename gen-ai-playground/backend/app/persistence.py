@@ -0,0 +1,367 @@
+"""
+Write-behind persistence of generated images
+
+A generation request answers with the image as soon as it is decoded and
+leaves saving it to the history to a background writer. The writer takes
+everything that is queued, up to HISTORY_WRITE_BATCH_SIZE images, and
+stores the records with a single insert_many. An edit's original and the
+edited result are written in the same call, the ids being assigned up front
+so the result can already point at its parent. Transient errors are
+retried; the queue is written out when the app shuts down.
+"""
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from functools import cached_property
+from typing import Dict, List, Optional, Set, Tuple
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import BulkWriteError, ConnectionFailure, PyMongoError
+
+from app.blobs import content_hash, put_blob, release_blob
+from app.config import settings
+from app.database import timed
+from app.imaging import sniff_content_type
+from app.logs import phase
+from app.metrics import registry
+from app.tracing import SpanContext, current_context, tracer
+from app.thumbnails import thumbnail_pipeline
+from app.variants import store_variant
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+write_queue_depth = registry.gauge(
+    "history_write_queue_depth",
+    "Generated images waiting to be saved to the history"
+)
+write_batch_size = registry.histogram(
+    "history_write_batch_size",
+    "Images saved per history write",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+write_retries = registry.counter(
+    "history_write_retries_total",
+    "History writes retried after a transient database error"
+)
+write_failures = registry.counter(
+    "history_write_failures_total",
+    "Generated images that could not be saved to the history"
+)
+
+
+@dataclass
+class ImageSave:
+    """A generated image to be saved to a user's history"""
+    prompt: str
+    model: str
+    image_bytes: bytes
+    username: str
+    image_type: str
+    user_image_bytes: Optional[bytes] = None  # image the user edited
+    image_id: ObjectId = field(default_factory=ObjectId)
+    variants: Dict[str, bytes] = field(default_factory=dict)  # media type -> converted image already sent
+    trace_context: Optional[SpanContext] = field(default_factory=current_context)  # span that produced it
+
+    @cached_property
+    def original_hash(self) -> Optional[str]:
+        return content_hash(self.user_image_bytes) if self.user_image_bytes else None
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether a database error may go away when the write is repeated"""
+    return isinstance(error, ConnectionFailure) or (
+        isinstance(error, PyMongoError) and error.has_error_label("RetryableWriteError")
+    )
+
+
+def image_record(save: ImageSave, image_type: str, image_bytes: bytes, digest: str) -> dict:
+    return {
+        "prompt": save.prompt,
+        "model": save.model,
+        "timestamp": datetime.now(timezone.utc),
+        "image_size": len(image_bytes),
+        "username": save.username,
+        "image_type": image_type,
+        "content_type": sniff_content_type(image_bytes),
+        "content_hash": digest
+    }
+
+
+async def find_originals(db: AsyncIOMotorDatabase,
+                         saves: List[ImageSave]) -> Dict[Tuple[str, str], ObjectId]:
+    """Ids of the stored originals the edits in a batch can reuse, in one query"""
+    pairs = {(save.username, save.original_hash) for save in saves if save.original_hash}
+    if not pairs:
+        return {}
+    cursor = db.images.find(
+        {
+            "image_type": "original",
+            "$or": [{"username": username, "content_hash": digest} for username, digest in pairs]
+        },
+        {"username": 1, "content_hash": 1}
+    )
+    return {(record["username"], record["content_hash"]): record["_id"] async for record in cursor}
+
+
+async def build_records(db: AsyncIOMotorDatabase, save: ImageSave,
+                        originals: Dict[Tuple[str, str], ObjectId],
+                        new_blobs: List[Tuple[str, bytes]]) -> List[dict]:
+    """
+    Take the blob references of one save and return its records
+
+    Every record holds one reference to the blob named by its content_hash.
+    A user's original with the same content is reused instead of saved
+    again, also within the batch.
+
+    Args:
+        db: Database instance
+        save: the image to save
+        originals: (username, content hash) -> id of originals, updated with new ones
+        new_blobs: (content hash, bytes) of created blobs, appended to
+
+    Returns:
+        List[dict]: the original record if one is needed, then the image record
+    """
+    records = []
+    created_blobs = []
+    try:
+        parent_id = None
+        if save.original_hash:
+            parent_id = originals.get((save.username, save.original_hash))
+            if parent_id is None:
+                _, created = await put_blob(db, save.user_image_bytes, digest=save.original_hash)
+                original = image_record(save, "original", save.user_image_bytes, save.original_hash)
+                original["_id"] = parent_id = ObjectId()
+                records.append(original)
+                if created:
+                    created_blobs.append((save.original_hash, save.user_image_bytes))
+
+        image_hash, created = await put_blob(db, save.image_bytes)
+        if created:
+            await keep_variants(db, image_hash, save.variants)
+        record = image_record(save, save.image_type, save.image_bytes, image_hash)
+        record["_id"] = save.image_id
+        if parent_id is not None:
+            record["parent_image_id"] = parent_id
+            record["parent_content_hash"] = save.original_hash
+        records.append(record)
+        if created:
+            created_blobs.append((image_hash, save.image_bytes))
+    except Exception:
+        for stored in records:
+            await release_blob(db, stored["content_hash"])
+        raise
+
+    if save.original_hash:
+        originals[(save.username, save.original_hash)] = parent_id
+    new_blobs.extend(created_blobs)
+    return records
+
+
+async def keep_variants(db: AsyncIOMotorDatabase, digest: str, variants: Dict[str, bytes]):
+    """Attach the converted images a request already made to a new blob"""
+    for media_type, data in variants.items():
+        try:
+            await store_variant(db, digest, media_type, data)
+        except Exception as e:
+            logger.warning(f"Failed to store {media_type} variant of image {digest}: {e}")
+
+
+async def insert_records(db: AsyncIOMotorDatabase, records: List[dict]) -> Set[int]:
+    """
+    insert_many with retries on transient errors
+
+    The records carry their ids, so a repeated write skips the ones the
+    failed attempt already stored.
+
+    Returns:
+        Set[int]: positions of the records that could not be stored
+    """
+    attempt = 0
+    while True:
+        try:
+            await db.images.insert_many(records, ordered=False)
+            return set()
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            failed = {error["index"] for error in errors if error["code"] != DUPLICATE_KEY}
+            if not failed and not e.details.get("writeConcernErrors"):
+                return set()
+            if attempt >= settings.HISTORY_WRITE_RETRIES or not is_transient(e):
+                return failed
+        except PyMongoError as e:
+            if attempt >= settings.HISTORY_WRITE_RETRIES or not is_transient(e):
+                raise
+        write_retries.inc()
+        await asyncio.sleep(settings.HISTORY_WRITE_RETRY_DELAY * 2 ** attempt)
+        attempt += 1
+
+
+async def drop_partial_edits(db: AsyncIOMotorDatabase, records: List[dict], failed: Set[int]) -> Set[int]:
+    """
+    Remove the stored half of an original and its edits that were not both stored
+
+    An edit whose new original failed would point at nothing, and a new
+    original none of whose edits were stored is not needed.
+
+    Returns:
+        Set[int]: positions of the stored records that were removed again
+    """
+    parent_ids = {record.get("parent_image_id") for record in records}
+    originals = {
+        index for index, record in enumerate(records)
+        if record["image_type"] == "original" and record["_id"] in parent_ids
+    }
+    lost = {records[index]["_id"] for index in originals & failed}
+    stored = [index for index in range(len(records)) if index not in failed and index not in originals]
+    orphans = {index for index in stored if records[index].get("parent_image_id") in lost}
+    used = {records[index].get("parent_image_id") for index in stored if index not in orphans}
+    unused = {index for index in originals - failed if records[index]["_id"] not in used}
+    drop = orphans | unused
+    if not drop:
+        return set()
+    try:
+        await db.images.delete_many({"_id": {"$in": [records[index]["_id"] for index in drop]}})
+    except Exception as e:
+        logger.error(f"Failed to remove {len(drop)} partly saved image record(s): {e}")
+        return set()
+    return drop
+
+
+async def write_images(db: AsyncIOMotorDatabase, saves: List[ImageSave]) -> List[Optional[str]]:
+    """
+    Save a batch of images to the history with one insert_many
+
+    An edit and the new original it points at are kept or dropped together.
+
+    Args:
+        db: Database instance
+        saves: images to save
+
+    Returns:
+        List[Optional[str]]: id of each image record, None where saving failed
+    """
+    write_batch_size.observe(len(saves))
+    # Written by the history writer outside any request, so linked to the requests instead
+    links = [save.trace_context for save in saves]
+    with timed("save_images"), tracer.span("save_image_to_db", {"images": len(saves)}, links=links):
+        return await _write_images(db, saves)
+
+
+async def _write_images(db: AsyncIOMotorDatabase, saves: List[ImageSave]) -> List[Optional[str]]:
+    ids: List[Optional[str]] = []
+    records: List[dict] = []
+    owners: List[int] = []  # position in saves of each record
+    new_blobs: List[Tuple[str, bytes]] = []
+    try:
+        originals = await find_originals(db, saves)
+    except Exception as e:
+        logger.warning(f"Failed to look up original images: {e}")
+        originals = {}
+
+    for position, save in enumerate(saves):
+        try:
+            save_records = await build_records(db, save, originals, new_blobs)
+        except Exception as e:
+            logger.error(f"Failed to store image blobs for user {save.username}: {e}")
+            write_failures.inc()
+            ids.append(None)
+            continue
+        records.extend(save_records)
+        owners.extend([position] * len(save_records))
+        ids.append(str(save.image_id))
+    if not records:
+        return ids
+
+    try:
+        failed = await insert_records(db, records)
+    except Exception as e:
+        logger.error(f"Failed to save to MongoDB: {e}")
+        failed = set(range(len(records)))
+    if failed:
+        failed |= await drop_partial_edits(db, records, failed)
+    for index in sorted(failed):
+        # Give back the blob reference the record would have held
+        try:
+            await release_blob(db, records[index]["content_hash"])
+        except Exception as e:
+            logger.warning(f"Failed to release blob {records[index]['content_hash']}: {e}")
+        if ids[owners[index]] is not None:
+            ids[owners[index]] = None
+            write_failures.inc()
+
+    failed_hashes = {records[index]["content_hash"] for index in failed}
+    for digest, image_bytes in new_blobs:
+        if digest not in failed_hashes:
+            thumbnail_pipeline.submit(db, digest, image_bytes)
+    logger.debug(f"Saved {len(records) - len(failed)} image record(s) to MongoDB")
+    return ids
+
+
+class HistoryWriter:
+    """Bounded queue of images waiting to be saved, written in batches"""
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._worker is not None
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=settings.HISTORY_WRITE_QUEUE_SIZE)
+        self._worker = asyncio.create_task(self._write_loop())
+
+    async def stop(self):
+        """Save everything still queued, then stop the writer"""
+        if self._worker is None:
+            return
+        await self._queue.join()
+        self._worker.cancel()
+        await asyncio.gather(self._worker, return_exceptions=True)
+        self._worker = None
+        self._queue = None
+        write_queue_depth.set(0)
+
+    async def submit(self, db: AsyncIOMotorDatabase, save: ImageSave) -> Optional[str]:
+        """
+        Queue an image to be saved and return the id its record will get
+
+        A full queue makes the caller wait for room. Without a running
+        writer the image is saved right away.
+        """
+        with phase("persist"):
+            if self._queue is None:
+                return (await write_images(db, [save]))[0]
+            await self._queue.put((db, save))
+        write_queue_depth.set(self._queue.qsize())
+        return str(save.image_id)
+
+    async def _write_loop(self):
+        while True:
+            batch = [await self._queue.get()]
+            # Whatever queued up during the previous write goes in this one
+            while len(batch) < settings.HISTORY_WRITE_BATCH_SIZE and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            write_queue_depth.set(self._queue.qsize())
+            try:
+                by_db: Dict[int, Tuple[AsyncIOMotorDatabase, List[ImageSave]]] = {}
+                for db, save in batch:
+                    by_db.setdefault(id(db), (db, []))[1].append(save)
+                for db, saves in by_db.values():
+                    await write_images(db, saves)
+            except Exception as e:
+                write_failures.inc(len(batch))
+                logger.exception(f"History write crashed: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+
+# Global history writer, started and drained by the app lifespan
+history_writer = HistoryWriter()
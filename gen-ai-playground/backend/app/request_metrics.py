@@ -0,0 +1,64 @@
+"""
+Latency and concurrency of HTTP requests per route
+
+A plain ASGI middleware, so streaming responses pass through untouched.
+Durations are labelled with the path template of the route the request
+matched (/images/{image_id}, not the id), which keeps the number of series
+bounded; paths no route matches share the label "unmatched". The route is
+only known once the router has run, so requests in flight are counted per
+method. The duration covers the whole response, so for streams (job events,
+batches) it is the time until the stream ended.
+"""
+import time
+from typing import Optional
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.metrics import registry
+
+request_duration = registry.histogram(
+    "http_request_duration_seconds",
+    "Time from receiving a request until its response was sent",
+    ("method", "route", "status")
+)
+requests_in_flight = registry.gauge(
+    "http_requests_in_flight",
+    "Requests currently being handled",
+    ("method",)
+)
+
+
+def route_template(scope: Scope) -> str:
+    """Path template of the route the router matched"""
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class RequestMetricsMiddleware:
+    """Observes the duration and status of every HTTP request"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        status: Optional[int] = None
+
+        async def send_with_status(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        requests_in_flight.inc(method=method)
+        started = time.monotonic()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            requests_in_flight.dec(method=method)
+            # An exception before the response started ends as a 500
+            request_duration.observe(time.monotonic() - started, method=method,
+                                     route=route_template(scope), status=str(status or 500))
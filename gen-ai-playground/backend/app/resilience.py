@@ -0,0 +1,231 @@
+"""
+Deadlines, retries and circuit breaking for upstream model calls
+
+Every call to a model gets the connect and read deadlines configured for it.
+Failures that are safe to repeat (429, 502, 503 and connections that could
+not be opened) are retried with jittered exponential backoff. Each model
+has a circuit breaker: after UPSTREAM_BREAKER_FAILURE_THRESHOLD consecutive
+failures calls fail fast with 503 for UPSTREAM_BREAKER_RESET_SECONDS, then a
+single trial call decides whether the breaker closes again.
+"""
+import asyncio
+import math
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+import httpx
+from fastapi import HTTPException
+
+from app.config import parse_key_values, settings
+from app.metrics import registry
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+BREAKER_STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+RETRYABLE_STATUS_CODES = (429, 502, 503)
+# Errors raised before the request was sent. Read and write errors and
+# protocol errors may come after the model got the request, and repeating it
+# could run (and bill) the same generation twice.
+RETRYABLE_ERRORS = (
+    httpx.ConnectError,
+    httpx.ConnectTimeout,
+    httpx.PoolTimeout
+)
+
+breaker_state = registry.gauge(
+    "upstream_breaker_state",
+    "Circuit breaker state per model (0 closed, 1 half open, 2 open)",
+    ("model",)
+)
+retries = registry.counter(
+    "upstream_retries_total",
+    "Upstream calls retried, by model and cause",
+    ("model", "reason")
+)
+short_circuited = registry.counter(
+    "upstream_short_circuited_total",
+    "Upstream calls failed fast because the model's breaker was open",
+    ("model",)
+)
+
+
+class CircuitBreaker:
+    """Tracks consecutive failures of one model and fails fast while it is unhealthy"""
+
+    def __init__(self, model: str, failure_threshold: int, reset_seconds: float):
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_running = False
+
+    def _set_state(self, state: str):
+        self.state = state
+        breaker_state.set(BREAKER_STATES[state], model=self.model)
+
+    def _refresh(self):
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+            self._set_state(HALF_OPEN)
+
+    def allow(self) -> bool:
+        """Whether a call may go out now; in half open state only one trial call may"""
+        self._refresh()
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self._trial_running:
+            self._trial_running = True
+            return True
+        return False
+
+    def available(self) -> bool:
+        """Whether calls are not being failed fast, without taking the trial call"""
+        self._refresh()
+        return self.state != OPEN
+
+    def retry_after(self) -> int:
+        """Seconds until the breaker lets a trial call through"""
+        if self.state != OPEN:
+            return 1
+        remaining = self.reset_seconds - (time.monotonic() - self.opened_at)
+        return max(1, math.ceil(remaining))
+
+    def record_success(self):
+        self._trial_running = False
+        self.consecutive_failures = 0
+        if self.state != CLOSED:
+            self._set_state(CLOSED)
+
+    def record_failure(self):
+        self._trial_running = False
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._set_state(OPEN)
+
+    def abandon(self):
+        """Forget a call that ended without an outcome, e.g. when it was cancelled"""
+        self._trial_running = False
+
+    def snapshot(self) -> dict:
+        self._refresh()
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "retry_after": self.retry_after() if self.state == OPEN else None
+        }
+
+
+def backoff_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """
+    Delay before retry number attempt + 1
+
+    Full jitter: a random delay up to base * 2^attempt, capped at
+    UPSTREAM_RETRY_MAX_DELAY. A numeric Retry-After from the model wins.
+    """
+    if retry_after:
+        try:
+            return min(float(retry_after), settings.UPSTREAM_RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    ceiling = min(settings.UPSTREAM_RETRY_MAX_DELAY, settings.UPSTREAM_RETRY_BASE_DELAY * 2 ** attempt)
+    return random.uniform(0, ceiling)
+
+
+class ResiliencePolicy:
+    """Deadlines, retries and a circuit breaker per model"""
+
+    def __init__(self):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                model,
+                failure_threshold=settings.UPSTREAM_BREAKER_FAILURE_THRESHOLD,
+                reset_seconds=settings.UPSTREAM_BREAKER_RESET_SECONDS
+            )
+            self._breakers[model] = breaker
+        return breaker
+
+    def timeout_for(self, model: str) -> httpx.Timeout:
+        """Deadlines of one call to the model"""
+        read_timeouts = parse_key_values(settings.UPSTREAM_MODEL_READ_TIMEOUT_OVERRIDES, float)
+        return httpx.Timeout(
+            connect=settings.UPSTREAM_CONNECT_TIMEOUT,
+            read=read_timeouts.get(model, settings.UPSTREAM_READ_TIMEOUT),
+            write=settings.UPSTREAM_WRITE_TIMEOUT,
+            pool=settings.UPSTREAM_POOL_TIMEOUT
+        )
+
+    async def call(self, model: str,
+                   send: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        """
+        Send a request to the model, retrying failures that are safe to repeat
+
+        Args:
+            model: model the request goes to, selects the breaker
+            send: sends the request once
+
+        Returns:
+            httpx.Response: the first response that is not retried
+
+        Raises:
+            HTTPException: 503 while the model's breaker is open
+            httpx.HTTPError: if the last attempt failed without a response
+        """
+        breaker = self.breaker(model)
+        attempts = max(1, settings.UPSTREAM_RETRY_ATTEMPTS)
+        for attempt in range(attempts):
+            last_attempt = attempt + 1 == attempts
+            if not breaker.allow():
+                short_circuited.inc(model=model)
+                raise HTTPException(
+                    status_code=503,
+                    detail=f"{model} is temporarily unavailable, try again later",
+                    headers={"Retry-After": str(breaker.retry_after())}
+                )
+            try:
+                response = await send()
+            except RETRYABLE_ERRORS as e:
+                breaker.record_failure()
+                if last_attempt:
+                    raise
+                retries.inc(model=model, reason=type(e).__name__)
+                await asyncio.sleep(backoff_delay(attempt))
+                continue
+            except httpx.HTTPError:
+                breaker.record_failure()
+                raise
+            except BaseException:
+                breaker.abandon()
+                raise
+
+            if response.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            if response.status_code in RETRYABLE_STATUS_CODES and not last_attempt:
+                retries.inc(model=model, reason=str(response.status_code))
+                # Give a streamed response's connection back to the pool
+                await response.aclose()
+                await asyncio.sleep(backoff_delay(attempt, response.headers.get("Retry-After")))
+                continue
+            return response
+
+    def status(self) -> Dict[str, dict]:
+        """Breaker state of every configured model"""
+        return {model: self.breaker(model).snapshot() for model in settings.MODEL_URLS}
+
+    def reset(self):
+        """Forget every breaker so they are created again from settings"""
+        self._breakers.clear()
+
+
+# Global resilience policy for upstream model calls
+upstream_policy = ResiliencePolicy()
@@ -0,0 +1,162 @@
+"""
+Cache of generated images for deterministic requests
+
+A request is cacheable when it names an explicit seed, since the model then
+returns the same image for the same (model, prompt, seed, input image).
+Results are kept in a bounded in-memory LRU and, behind it, in a Mongo
+collection whose entries expire after RESULT_CACHE_TTL_SECONDS through the
+TTL index in app.indexes. The Mongo entry only records the content hash;
+the bytes come from the image blobs.
+"""
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from app.blobs import image_source
+from app.config import settings
+from app.database import timed
+from app.metrics import registry
+from app.storage import storage_for_record
+
+logger = logging.getLogger(__name__)
+
+cache_requests = registry.counter(
+    "result_cache_requests_total",
+    "Result cache lookups by tier and outcome",
+    ("tier", "result")
+)
+cache_hit_ratio = registry.gauge(
+    "result_cache_hit_ratio",
+    "Share of result cache lookups answered by either tier"
+)
+
+
+def cache_key(model: str, prompt: str, seed: int, input_image_hash: Optional[str] = None) -> str:
+    """Return the cache key of a generation request"""
+    request = {"model": model, "prompt": prompt, "seed": seed, "input": input_image_hash}
+    encoded = json.dumps(request, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class ResultCache:
+    """Two-tier cache from request keys to generated image bytes"""
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self._hits = 0
+        self._lookups = 0
+        self._lock = threading.Lock()
+
+    def _count(self, hit: bool):
+        with self._lock:
+            self._lookups += 1
+            self._hits += hit
+            cache_hit_ratio.set(self._hits / self._lookups)
+
+    def hit_ratio(self) -> float:
+        with self._lock:
+            return self._hits / self._lookups if self._lookups else 0.0
+
+    def _remember(self, key: str, image_bytes: bytes):
+        """Put an entry in the memory tier, evicting the least recently used"""
+        if len(image_bytes) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= len(self._memory.pop(key))
+            self._memory[key] = image_bytes
+            self._memory_bytes += len(image_bytes)
+            while len(self._memory) > self.max_entries or self._memory_bytes > self.max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    async def get(self, db: AsyncIOMotorDatabase, key: str) -> Optional[bytes]:
+        """
+        Look up a cached result
+
+        Args:
+            db: Database instance
+            key: key from cache_key
+
+        Returns:
+            Optional[bytes]: the cached image, or None on a miss
+        """
+        with self._lock:
+            image_bytes = self._memory.get(key)
+            if image_bytes is not None:
+                self._memory.move_to_end(key)
+        if image_bytes is not None:
+            cache_requests.inc(tier="memory", result="hit")
+            self._count(True)
+            return image_bytes
+        cache_requests.inc(tier="memory", result="miss")
+
+        try:
+            with timed("result_cache_lookup"):
+                entry = await db.generation_cache.find_one({
+                    "_id": key,
+                    "expires_at": {"$gt": datetime.now(timezone.utc)}
+                })
+            if entry:
+                source = await image_source(db, {"content_hash": entry["content_hash"]})
+                image_bytes = await storage_for_record(source).load(db, source)
+        except Exception as e:
+            logger.warning(f"Result cache lookup failed: {e}")
+            image_bytes = None
+
+        if image_bytes is None:
+            cache_requests.inc(tier="mongo", result="miss")
+            self._count(False)
+            return None
+        cache_requests.inc(tier="mongo", result="hit")
+        self._count(True)
+        self._remember(key, image_bytes)
+        return image_bytes
+
+    async def put(self, db: AsyncIOMotorDatabase, key: str, image_bytes: bytes, content_hash: str):
+        """
+        Store a result in both tiers
+
+        Args:
+            db: Database instance
+            key: key from cache_key
+            image_bytes: the generated image
+            content_hash: hash of the blob the image is saved as
+        """
+        self._remember(key, image_bytes)
+        try:
+            await db.generation_cache.replace_one(
+                {"_id": key},
+                {
+                    "_id": key,
+                    "content_hash": content_hash,
+                    "expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.ttl_seconds)
+                },
+                upsert=True
+            )
+        except Exception as e:
+            logger.warning(f"Result cache store failed: {e}")
+
+    def clear(self):
+        """Empty the memory tier"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+
+# Global result cache instance
+result_cache = ResultCache(
+    max_entries=settings.RESULT_CACHE_MAX_ENTRIES,
+    max_bytes=settings.RESULT_CACHE_MAX_BYTES,
+    ttl_seconds=settings.RESULT_CACHE_TTL_SECONDS
+)
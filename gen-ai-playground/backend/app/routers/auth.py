@@ -2,14 +2,23 @@
 Authentication routes: registration and login
 """
 from fastapi import APIRouter, HTTPException, Depends
-from pymongo.database import Database
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import DuplicateKeyError
 from datetime import datetime, timedelta
-import bcrypt
 import jwt
+import logging
 
+from app.auth_cache import auth_cache
+from app.blobs import release_blob
 from app.config import settings
 from app.database import get_database
-from app.models import RegisterRequest, LoginRequest, RegisterResponse, LoginResponse
+from app.dependencies import get_current_user
+from app.models import RegisterRequest, LoginRequest, RegisterResponse, LoginResponse, UserInfo
+from app.passwords import password_hasher
+from app.routers.images import release_job_input
+from app.storage import storage_for_record
+
+logger = logging.getLogger(__name__)
 
 
 router = APIRouter(
@@ -18,12 +27,12 @@ router = APIRouter(
 
 
 @router.post("/register", response_model=RegisterResponse)
-def register(
+async def register(
     user_data: RegisterRequest,
-    db: Database = Depends(get_database)
+    db: AsyncIOMotorDatabase = Depends(get_database)
 ):
     """
-    Register a new user
+    Register a new user. The password is hashed in the bcrypt thread pool.
     
     Args:
         user_data: Registration details including username, password, and invitation code
@@ -44,7 +53,7 @@ def register(
             )
         
         # Check if user already exists
-        existing_user = db.users.find_one({"username": user_data.username})
+        existing_user = await db.users.find_one({"username": user_data.username})
         
         if existing_user:
             raise HTTPException(
@@ -53,10 +62,7 @@ def register(
             )
         
         # Hash the password
-        hashed_password = bcrypt.hashpw(
-            user_data.password.encode('utf-8'),
-            bcrypt.gensalt()
-        )
+        hashed_password = await password_hasher.hash(user_data.password)
         
         # Create user document
         user_doc = {
@@ -65,8 +71,14 @@ def register(
             "created_at": datetime.utcnow()
         }
         
-        # Insert user into database
-        db.users.insert_one(user_doc)
+        # Insert user into database, the unique index settles concurrent registrations
+        try:
+            await db.users.insert_one(user_doc)
+        except DuplicateKeyError:
+            raise HTTPException(
+                status_code=400,
+                detail="Username already exists"
+            )
         
         return RegisterResponse(
             message="User registered successfully",
@@ -82,12 +94,13 @@ def register(
 
 
 @router.post("/login", response_model=LoginResponse)
-def login(
+async def login(
     credentials: LoginRequest,
-    db: Database = Depends(get_database)
+    db: AsyncIOMotorDatabase = Depends(get_database)
 ):
     """
-    Authenticate user and return JWT token
+    Authenticate user and return JWT token. A stored hash made with another
+    cost than BCRYPT_ROUNDS is replaced once the password has been verified.
     
     Args:
         credentials: Login credentials (username and password)
@@ -101,7 +114,7 @@ def login(
     """
     try:
         # Find user by username
-        user = db.users.find_one({"username": credentials.username})
+        user = await db.users.find_one({"username": credentials.username})
         
         if not user:
             raise HTTPException(
@@ -110,20 +123,21 @@ def login(
             )
         
         # Verify password
-        if not bcrypt.checkpw(
-            credentials.password.encode('utf-8'),
-            user["password"]
-        ):
+        if not await password_hasher.verify(credentials.password, user["password"]):
             raise HTTPException(
                 status_code=401,
                 detail="Invalid username or password"
             )
         
+        if password_hasher.needs_rehash(user["password"]):
+            await rehash_password(db, user, credentials.password)
+        
         # Generate JWT token
         token_expiry = datetime.utcnow() + timedelta(hours=settings.JWT_EXPIRY_HOURS)
         
         token_payload = {
             "username": user["username"],
+            "ver": user.get("token_version", 0),
             "exp": token_expiry
         }
         
@@ -145,3 +159,90 @@ def login(
             status_code=500,
             detail=f"Login failed: {str(e)}"
         )
+
+
+async def rehash_password(db: AsyncIOMotorDatabase, user: dict, password: str):
+    """
+    Replace a user's password hash with one of the configured cost
+    
+    Failing to rehash does not fail the login, it is tried again next time.
+    
+    Args:
+        db: Database instance
+        user: user document with the current hash
+        password: the verified password
+    """
+    try:
+        new_hash = await password_hasher.hash(password)
+        # Only replace the hash that was verified, not a password changed meanwhile
+        await db.users.update_one(
+            {"_id": user["_id"], "password": user["password"]},
+            {"$set": {"password": new_hash}}
+        )
+    except Exception as e:
+        logger.warning(f"Failed to rehash password of {user['username']}: {e}")
+
+
+@router.post("/revoke-tokens")
+async def revoke_tokens(
+    current_user: UserInfo = Depends(get_current_user),
+    db: AsyncIOMotorDatabase = Depends(get_database)
+):
+    """
+    Sign out everywhere: reject every token issued to the user so far
+    
+    Args:
+        current_user: Authenticated user information
+        db: Database instance
+        
+    Returns:
+        dict: Success message
+    """
+    await db.users.update_one(
+        {"username": current_user.username},
+        {"$inc": {"token_version": 1}}
+    )
+    auth_cache.invalidate_user(current_user.username)
+    return {"message": "Tokens revoked"}
+
+
+@router.delete("/account")
+async def delete_account(
+    current_user: UserInfo = Depends(get_current_user),
+    db: AsyncIOMotorDatabase = Depends(get_database)
+):
+    """
+    Delete the authenticated user together with their history and jobs
+    
+    Args:
+        current_user: Authenticated user information
+        db: Database instance
+        
+    Returns:
+        dict: Success message
+        
+    Raises:
+        HTTPException: If deleting fails
+    """
+    username = current_user.username
+    try:
+        await db.users.delete_one({"username": username})
+        # Tokens stop working before the history is removed
+        auth_cache.invalidate_user(username)
+        async for record in db.images.find({"username": username}, {"image_data": 0}):
+            await db.images.delete_one({"_id": record["_id"]})
+            if record.get("content_hash"):
+                await release_blob(db, record["content_hash"])
+            else:
+                # Record saved before deduplication, it owns its storage
+                await storage_for_record(record).delete(db, record)
+        # Jobs still queued or running hold a reference on the image to edit
+        async for job in db.jobs.find({"username": username, "input_hash": {"$exists": True}}):
+            await release_job_input(db, job)
+        await db.jobs.delete_many({"username": username})
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Deleting account failed: {str(e)}"
+        )
+    return {"message": "Account deleted"}
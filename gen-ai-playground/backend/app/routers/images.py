@@ -1,21 +1,48 @@
 """
 Image generation and history routes
 """
-import traceback
-from typing import Optional
-from fastapi import APIRouter, HTTPException, Depends
-from fastapi.responses import Response
-from pymongo.database import Database
+import logging
+from contextlib import contextmanager
+from typing import AsyncIterator, Optional, Tuple
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from bson import ObjectId
 from datetime import datetime, timezone
+import asyncio
 import base64
+import json
 import time
-import requests
+import httpx
 
+from app.admission import admission
+from app.batch import batch_runner, expand_batch, item_error
 from app.config import settings
-from app.database import get_database
+from app.database import get_database, timed
 from app.dependencies import get_current_user
-from app.models import ImageRequestBody, HistoryResponse, UserInfo
+from app.blobs import content_hash, image_source, put_blob, release_blob
+from app.delivery import deliver, etag_matches, make_etag
+from app.image_stream import ImageFieldDecoder, image_path
+from app.imaging import sniff_content_type
+from app.jobs import job_manager, job_view
+from app.logs import REQUEST_ID_HEADER, current_request_id, phase
+from app.metrics import registry
+from app.models import (
+    BatchItem, BatchRequestBody, ImageRequestBody, HistoryItem, HistoryResponse, JobResponse, UserInfo
+)
+from app.persistence import ImageSave, history_writer, write_images
+from app.resilience import upstream_policy
+from app.result_cache import cache_key, result_cache
+from app.routing import model_router
+from app.singleflight import generation_flights
+from app.storage import storage_for_record
+from app.tracing import CLIENT, TRACEPARENT_HEADER, current_context, tracer
+from app.uploads import is_multipart, read_form, read_json, validate
+from app.variants import IMAGE_FORMAT, negotiate_format, transcoder, variant_key
+from app.upstream import upstream_client
+
 
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix="/images",
@@ -23,69 +50,361 @@ router = APIRouter(
 )
 
 
+upstream_latency = registry.histogram(
+    "upstream_request_duration_seconds",
+    "Duration of model calls by model and upstream status, or the error status without one",
+    ("model", "status")
+)
+decoded_image_size = registry.histogram(
+    "generated_image_bytes",
+    "Size of decoded images returned by the models",
+    ("model",),
+    buckets=(64 * 1024, 256 * 1024, 512 * 1024, 1024 ** 2, 2 * 1024 ** 2, 4 * 1024 ** 2,
+             8 * 1024 ** 2, 16 * 1024 ** 2, 32 * 1024 ** 2)
+)
+
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 100
+# "sync" answers with the image, "async" with a job to poll or follow
+GENERATION_MODE = Query("sync", pattern="^(sync|async)$")
+# /edit-image reads its body itself, so both formats are declared here for the docs
+EDIT_IMAGE_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {"schema": ImageRequestBody.model_json_schema()},
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["prompt", "model", "image"],
+                    "properties": {
+                        "prompt": {"type": "string"},
+                        "model": {"type": "string"},
+                        "seed": {"type": "integer"},
+                        "latency_budget_ms": {"type": "integer"},
+                        "image": {"type": "string", "format": "binary"}
+                    }
+                }
+            }
+        }
+    }
+}
+
+
 @router.get("/history", response_model=HistoryResponse)
-def get_history(
+async def get_history(
+    cursor: Optional[str] = None,
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
     current_user: UserInfo = Depends(get_current_user),
-    db: Database = Depends(get_database)
+    db: AsyncIOMotorDatabase = Depends(get_database)
 ):
     """
-    Get image generation history for authenticated user
+    Get image generation history for authenticated user, newest first.
+    Only metadata is returned, the images are fetched from their image_url,
+    a content-hash URL the browser may cache forever.
     
     Args:
+        cursor: next_cursor from the previous page, omitted for the first page
+        limit: maximum number of items on the page
         current_user: Authenticated user information
         db: Database instance
         
     Returns:
-        HistoryResponse: List of image generation history items
+        HistoryResponse: One page of history items and the cursor of the next page
         
     Raises:
-        HTTPException: If fetching history fails
+        HTTPException: If the cursor is invalid or fetching history fails
     """
+    query = {"username": current_user.username}
+    if cursor:
+        timestamp, last_id = decode_history_cursor(cursor)
+        # Keyset pagination: everything strictly after the last item of the previous page
+        query["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$lt": last_id}}
+        ]
+    
     try:
-        # Get last 50 image generations for this user, sorted by newest first
-        history = list(db.images.find(
-            {"username": current_user.username},
-            {
-                "_id": 0,
-                "prompt": 1,
-                "model": 1,
-                "timestamp": 1,
-                "image_size": 1,
-                "image_data": 1,
-                "image_type": 1
-            }
-        ).sort("timestamp", -1).limit(50))
-        
-        return HistoryResponse(history=history)
+        with timed("history_page"):
+            records = await db.images.find(
+                query,
+                {
+                    "_id": 1,
+                    "prompt": 1,
+                    "model": 1,
+                    "timestamp": 1,
+                    "image_size": 1,
+                    "image_type": 1,
+                    "parent_image_id": 1,
+                    "content_hash": 1,
+                    "width": 1,
+                    "height": 1,
+                    "placeholder": 1,
+                    "thumbnail": 1
+                }
+            ).sort([("timestamp", -1), ("_id", -1)]).limit(limit + 1).to_list(None)
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Failed to fetch history: {str(e)}"
         )
+    
+    next_cursor = None
+    if len(records) > limit:
+        records = records[:limit]
+        next_cursor = encode_history_cursor(records[-1])
+    
+    # Previews are kept on the shared blobs, fetch them all in one query
+    hashes = list({record["content_hash"] for record in records if "content_hash" in record})
+    previews = {}
+    if hashes:
+        with timed("history_previews"):
+            previews = {
+                blob["_id"]: blob
+                async for blob in db.image_blobs.find(
+                    {"_id": {"$in": hashes}},
+                    {"width": 1, "height": 1, "placeholder": 1, "thumbnail": 1}
+                )
+            }
+    for record in records:
+        preview = previews.get(record.get("content_hash"), {})
+        for field in ("width", "height", "placeholder", "thumbnail"):
+            if field in preview:
+                record[field] = preview[field]
+    
+    history = [
+        HistoryItem(
+            id=str(record["_id"]),
+            prompt=record["prompt"],
+            model=record["model"],
+            timestamp=record["timestamp"],
+            image_size=record["image_size"],
+            image_type=record["image_type"],
+            parent_image_id=str(record["parent_image_id"]) if record.get("parent_image_id") else None,
+            width=record.get("width"),
+            height=record.get("height"),
+            placeholder=record.get("placeholder"),
+            image_url=image_url(record),
+            thumbnail_url=f"{image_url(record)}/thumbnail" if record.get("thumbnail") else None
+        )
+        for record in records
+    ]
+    return HistoryResponse(history=history, next_cursor=next_cursor)
+
+
+@router.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(
+    job_id: str,
+    current_user: UserInfo = Depends(get_current_user),
+    db: AsyncIOMotorDatabase = Depends(get_database)
+):
+    """
+    Get the status of a background generation job
+    
+    Args:
+        job_id: job_id returned by an async generation request
+        current_user: Authenticated user information
+        db: Database instance
+        
+    Returns:
+        JobResponse: Job status, with the image id once completed
+        
+    Raises:
+        HTTPException: If the job does not exist or belongs to another user
+    """
+    return job_view(await find_job(db, job_id, current_user))
+
+
+@router.get("/jobs/{job_id}/events")
+async def get_job_events(
+    job_id: str,
+    current_user: UserInfo = Depends(get_current_user),
+    db: AsyncIOMotorDatabase = Depends(get_database)
+):
+    """
+    Follow a background generation job as server-sent events
+    
+    A status event carrying the job is sent on every state change and the
+    stream ends once the job has completed or failed.
+    
+    Args:
+        job_id: job_id returned by an async generation request
+        current_user: Authenticated user information
+        db: Database instance
+        
+    Returns:
+        StreamingResponse: text/event-stream of job status events
+        
+    Raises:
+        HTTPException: If the job does not exist or belongs to another user
+    """
+    job = await find_job(db, job_id, current_user)
+    return StreamingResponse(
+        job_manager.events(db, job),
+        media_type="text/event-stream",
+        # Keep proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.get("/blobs/{digest}")
+async def get_blob(
+    digest: str,
+    request: Request,
+    format: Optional[str] = IMAGE_FORMAT,
+    current_user: UserInfo = Depends(get_current_user),
+    db: AsyncIOMotorDatabase = Depends(get_database)
+):
+    """
+    Return a stored image by its content hash, as linked from /images/history
+    
+    The URL names the content, so the response is immutable: it carries a
+    strong ETag, is answered with 304 when If-None-Match matches and
+    supports single byte ranges. A WebP or AVIF variant is sent instead when
+    asked for with format or the Accept header, converted once and kept.
+    
+    Args:
+        digest: content hash of the image
+        request: the incoming request, for its Accept, conditional and range headers
+        format: webp or avif to convert, original to skip Accept negotiation
+        current_user: Authenticated user information
+        db: Database instance
+        
+    Returns:
+        Response: The image, 206 with a byte range or 304 without a body
+        
+    Raises:
+        HTTPException: If the user has no image with this content
+    """
+    blob = await find_owned_blob(db, digest, current_user)
+    return await image_delivery(request, db, blob, digest, format, negotiate=True)
+
+
+@router.get("/blobs/{digest}/thumbnail")
+async def get_blob_thumbnail(
+    digest: str,
+    request: Request,
+    current_user: UserInfo = Depends(get_current_user),
+    db: AsyncIOMotorDatabase = Depends(get_database)
+):
+    """
+    Return the WebP thumbnail of a stored image by its content hash
+    
+    Args:
+        digest: content hash of the image
+        request: the incoming request, for its If-None-Match header
+        current_user: Authenticated user information
+        db: Database instance
+        
+    Returns:
+        Response: The thumbnail, cacheable forever, or 304 without a body
+        
+    Raises:
+        HTTPException: If the user has no image with this content or it has no thumbnail
+    """
+    blob = await find_owned_blob(db, digest, current_user)
+    return thumbnail_delivery(request, db, blob, digest)
+
+
+@router.get("/{image_id}/thumbnail")
+async def get_thumbnail(
+    image_id: str,
+    request: Request,
+    current_user: UserInfo = Depends(get_current_user),
+    db: AsyncIOMotorDatabase = Depends(get_database)
+):
+    """
+    Return the WebP thumbnail of a stored image owned by the authenticated user
+    
+    Args:
+        image_id: id of the image record
+        request: the incoming request, for its If-None-Match header
+        current_user: Authenticated user information
+        db: Database instance
+        
+    Returns:
+        Response: The thumbnail, cacheable forever, or 304 without a body
+        
+    Raises:
+        HTTPException: If the image or its thumbnail does not exist
+    """
+    record = await find_image(db, image_id, current_user, {"thumbnail": 1, "content_hash": 1})
+    source = await image_source(db, record)
+    return thumbnail_delivery(request, db, source, record.get("content_hash") or image_id)
+
+
+@router.get("/{image_id}")
+async def get_image(
+    image_id: str,
+    request: Request,
+    format: Optional[str] = IMAGE_FORMAT,
+    current_user: UserInfo = Depends(get_current_user),
+    db: AsyncIOMotorDatabase = Depends(get_database)
+):
+    """
+    Stream the bytes of a stored image owned by the authenticated user
+    
+    A record always points at the same content, so the response carries the
+    same ETag as /images/blobs/{content_hash} and supports 304, ranges and
+    WebP/AVIF variants. Records saved before deduplication are sent as stored.
+    
+    Args:
+        image_id: id of the image record
+        request: the incoming request, for its Accept, conditional and range headers
+        format: webp or avif to convert, original to skip Accept negotiation
+        current_user: Authenticated user information
+        db: Database instance
+        
+    Returns:
+        StreamingResponse: The raw image with its content type
+        
+    Raises:
+        HTTPException: If the image does not exist or belongs to another user
+    """
+    record = await find_image(
+        db, image_id, current_user,
+        {"image_data": 1, "storage": 1, "storage_ref": 1, "image_size": 1,
+         "content_type": 1, "content_hash": 1}
+    )
+    source = await image_source(db, record)
+    # Blobs know their size and type, records saved before deduplication keep them themselves
+    source = {"content_type": record.get("content_type"), "size": record.get("image_size"), **source}
+    return await image_delivery(request, db, source, record.get("content_hash") or image_id,
+                                format, negotiate="content_hash" in record)
 
 
 @router.post('/generate')
 async def generate_image(
     image_request: ImageRequestBody,
+    request: Request,
+    mode: str = GENERATION_MODE,
+    format: Optional[str] = IMAGE_FORMAT,
     current_user: UserInfo = Depends(get_current_user),
-    db: Database = Depends(get_database)
+    db: AsyncIOMotorDatabase = Depends(get_database)
 ):
     """
     Generate an image based on a prompt using Verda API
     
     Args:
-        image_request: Image generation request with prompt and model
+        image_request: Image generation request with prompt, model (or model
+            family) and optional seed and latency budget
+        request: the incoming request, for its Accept header
+        mode: "async" to get a job back right away instead of waiting for the image
+        format: webp or avif to convert, original to skip Accept negotiation
         current_user: Authenticated user information
         db: Database instance
         
     Returns:
-        Response: Generated image as PNG
+        Response: Generated image as PNG, or as WebP/AVIF when asked for with
+        format or the Accept header, with an X-Cache header telling
+        whether a seeded request was served from the result cache and an
+        X-Model header naming the model that generated it.
+        In async mode a 202 JobResponse instead.
         
     Raises:
         HTTPException: If image generation fails
     """
-    print(f"Image generation called at: {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())}")
-    print(f"Generating image for user: {current_user.username}...")
+    logger.debug("Generating image", extra={"fields": {"user": current_user.username, "model": image_request.model}})
     
     prompt = image_request.prompt
     model = image_request.model
@@ -98,216 +417,485 @@ async def generate_image(
             detail="VERDA_API_KEY not set in environment."
         )
     
-    # Select API URL based on model
-    url = choose_model_url(model)
-    
-    # Prepare request
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {settings.VERDA_API_KEY}"
-    }
-    data = build_request_data(model, prompt)
+    if mode == "async":
+        return await submit_generation_job(db, current_user, image_request, image_type)
     
-    # Call Verda API
-    resp = requests.post(url, headers=headers, json=data)
+    model = model_router.choose(model, image_request.latency_budget_ms)
+    image_bytes, cache_status = await generate_with_cache(
+        db, model, prompt, seed=image_request.seed
+    )
+    body, media_type = await negotiated_image(request, format, image_bytes)
     
-    try:
-        resp.raise_for_status()
-    except requests.exceptions.HTTPError:
-        raise HTTPException(
-            status_code=resp.status_code,
-            detail=f"Image generation failed: {resp.text}"
-        )
+    # Saved to MongoDB in the background, with the variant that was sent
+    await history_writer.submit(
+        db, ImageSave(prompt, model, image_bytes, current_user.username, image_type,
+                      variants={media_type: body} if body is not image_bytes else {})
+    )
     
-    # Process response
-    resp_data = resp.json()
-    if model == "FLUX2_KLEIN_9B" or model == "FLUX2_KLEIN_4B":
-        if "image" in resp_data:
-                return_image_base64 = resp_data["image"]
-                print(f"Received base64 image (length: {len(return_image_base64)})")
+    return image_response(body, media_type, cache_status, model)
 
-                # Remove data URL prefix if exists
-                if "," in return_image_base64:
-                    return_image_base64 = return_image_base64.split(",", 1)[1]
 
-                # Decode base64 to bytes
-                image_bytes = base64.b64decode(return_image_base64)
-                save_image_to_db(db, prompt, model, return_image_base64, current_user, image_type)
-                
-                return Response(
-                    content=image_bytes,
-                    media_type="image/png",
-                    headers={"Content-Disposition": "inline"}
-                )
-    else:   
-        if resp_data.get("status") == "COMPLETED" and resp_data.get("output", {}).get("outputs"):
-            image_base64 = resp_data["output"]["outputs"][0]
-            print(f"Received base64 image (length: {len(image_base64)})")
-
-            # Remove data URL prefix if exists
-            if "," in image_base64:
-                image_base64 = image_base64.split(",", 1)[1]
-
-            # Decode base64 to bytes
-            image_bytes = base64.b64decode(image_base64)
-
-            print(f"Image generation finished at: {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())}")
-
-            # Save to MongoDB
-            save_image_to_db(db, prompt, model, image_base64, current_user, image_type)
-
-            return Response(
-                content=image_bytes,
-                media_type="image/png",
-                headers={"Content-Disposition": "inline"}
-            )
+@router.post("/generate/batch")
+async def generate_batch(
+    batch_request: BatchRequestBody,
+    request: Request,
+    format: Optional[str] = IMAGE_FORMAT,
+    current_user: UserInfo = Depends(get_current_user),
+    db: AsyncIOMotorDatabase = Depends(get_database)
+):
+    """
+    Generate several images with one request, streamed back as each finishes
     
-    raise HTTPException(
-        status_code=500,
-        detail={
-            "error": "Problem generating image",
-            "data": resp_data
+    The items are generated concurrently within each model's concurrency
+    limit. The response is NDJSON: a line per item in the order they finish,
+    with the image as base64 or the error that stopped it, then a summary
+    line once the images have been saved to the history with one write.
+    
+    Args:
+        batch_request: items with prompt, model, optional seed and latency
+            budget, or one prompt and model with seeds or a count of random seeds
+        request: the incoming request
+        format: webp or avif to convert the images to
+        current_user: Authenticated user information
+        db: Database instance
+        
+    Returns:
+        StreamingResponse: application/x-ndjson of item results and a summary
+        
+    Raises:
+        HTTPException: If the batch is empty, too large or names an unknown model
+    """
+    if not settings.VERDA_API_KEY:
+        raise HTTPException(
+            status_code=500,
+            detail="VERDA_API_KEY not set in environment."
+        )
+    items = expand_batch(batch_request)
+    logger.debug("Generating batch", extra={"fields": {"user": current_user.username, "images": len(items)}})
+    
+    async def generate(item: BatchItem, model: str) -> Tuple[dict, ImageSave]:
+        image_bytes, cache_status = await generate_with_cache(db, model, item.prompt, seed=item.seed)
+        body, media_type = await negotiated_image(request, format, image_bytes)
+        save = ImageSave(item.prompt, model, image_bytes, current_user.username, "generated",
+                         variants={media_type: body} if body is not image_bytes else {})
+        result = {
+            "status": "completed",
+            "model": model,
+            "image_id": str(save.image_id),
+            "image_url": f"/images/blobs/{content_hash(image_bytes)}",
+            "content_type": media_type,
+            "cache": cache_status,
+            "image": base64.b64encode(body).decode("ascii")
         }
+        return result, save
+    
+    async def finish(saves: list) -> dict:
+        with phase("persist"):
+            ids = await write_images(db, saves) if saves else []
+        return {"saved": sum(image_id is not None for image_id in ids)}
+    
+    events = batch_runner.start(items, generate, finish)
+    return StreamingResponse(
+        batch_lines(items, events),
+        media_type="application/x-ndjson",
+        # Keep proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
-@router.post("/edit-image")
+async def batch_lines(items: list, events: asyncio.Queue) -> AsyncIterator[str]:
+    """ one NDJSON line per batch item as it finishes, then the summary """
+    completed = failed = 0
+    while True:
+        index, result, error = await events.get()
+        if index is None:
+            yield json.dumps({"status": "done", "completed": completed, "failed": failed, **result}) + "\n"
+            return
+        item = items[index]
+        line = {"index": index, "prompt": item.prompt, "seed": item.seed}
+        if error is None:
+            line.update(result)
+            completed += 1
+        else:
+            line.update(status="failed", model=item.model, error=item_error(error))
+            failed += 1
+        yield json.dumps(line) + "\n"
+@router.post("/edit-image", openapi_extra=EDIT_IMAGE_BODY)
 async def edit_image(
-    image_request: ImageRequestBody,
+    request: Request,
+    mode: str = GENERATION_MODE,
+    format: Optional[str] = IMAGE_FORMAT,
     current_user: UserInfo = Depends(get_current_user),
-    db: Database = Depends(get_database)
+    db: AsyncIOMotorDatabase = Depends(get_database)
     ):
     
     """
     Edit an image based on a prompt and return it as a file response
+    The body is either JSON (ImageRequestBody, the image as base64) or
+    multipart/form-data with the same fields and the image as a binary file
+    part. Either is rejected with 413 while it streams in once the image
+    exceeds EDIT_IMAGE_MAX_BYTES.
     Args:
+        request: the incoming request, its body is read after authentication
+        mode (str): "async" to get a 202 job back right away instead of the image
+        format (str): webp or avif to convert the result, original to skip Accept negotiation
         current_user: UserInfo = Depends(get_current_user), _description_ (user info from )
-        db: Database = Depends(get_database), _description_
-        image_request (ImageRequestBody): _description_
+        db: AsyncIOMotorDatabase = Depends(get_database), _description_
     """
+    user_image_bytes = None
+    if is_multipart(request):
+        fields, user_image_bytes = await read_form(request)
+        image_request = validate(ImageRequestBody, fields)
+        if not user_image_bytes:
+            raise HTTPException(status_code=400, detail="An image is required for editing")
+        # The model API takes the image as base64
+        image_base64 = base64.b64encode(user_image_bytes).decode("ascii")
+    else:
+        image_request = await read_json(request, ImageRequestBody)
+        image_base64 = image_request.image # base64 image from req body
     prompt = image_request.prompt  # prompt from request body
     model = image_request.model    # model from req body
-    image_base64 = image_request.image # base64 image from req body
     image_type = "edited"
     
+    if not image_base64:
+        raise HTTPException(status_code=400, detail="An image is required for editing")
     if "," in image_base64:
         image_base64 = image_base64.split(",",1)[1]
-    print("editing image...")
-    url = choose_model_url(model)
-     # Prepare request
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {settings.VERDA_API_KEY}"
-    }
-
-    data = build_request_data(model, prompt, image_base64)
-    # call Verda API
-    resp = requests.post(url, headers=headers, json=data)
+    logger.debug("Editing image", extra={"fields": {"user": current_user.username, "model": model}})
     try:
-        resp.raise_for_status()
-        print(f"Response status: {resp.status_code}")
-
-        # Process response
-        resp_data = resp.json()
-        if model == "FLUX2_KLEIN_9B" or model == "FLUX2_KLEIN_4B":
-            if "image" in resp_data:
-                return_image_base64 = resp_data["image"]
-                print(f"Received base64 image (length: {len(return_image_base64)})")
-
-                # Remove data URL prefix if exists
-                if "," in return_image_base64:
-                    return_image_base64 = return_image_base64.split(",", 1)[1]
-
-                # Decode base64 to bytes
-                image_bytes = base64.b64decode(return_image_base64)
-                save_image_to_db(db, prompt, model, return_image_base64, current_user, image_type, image_base64)
-                return Response(
-                    content=image_bytes,
-                    media_type="image/png",
-                    headers={"Content-Disposition": "inline"}
-                )
-        else:
-            if resp_data.get("status") == "COMPLETED" and resp_data.get("output", {}).get("outputs"):
-                return_image_base64 = resp_data["output"]["outputs"][0]
-                print(f"Received base64 image (length: {len(return_image_base64)})")
-
-                # Remove data URL prefix if exists
-                if "," in return_image_base64:
-                    return_image_base64 = return_image_base64.split(",", 1)[1]
-
-                # Decode base64 to bytes
-                image_bytes = base64.b64decode(return_image_base64)
-                save_image_to_db(db, prompt, model, return_image_base64, current_user, image_type, image_base64)
-                return Response(
-                    content=image_bytes,
-                    media_type="image/png",
-                    headers={"Content-Disposition": "inline"}
-                )
-            else:
-                print(f"Condition failed, status: {resp_data.get('status')}, outputs: {resp_data.get('output')}")
-                raise HTTPException(
-                    status_code=500, 
-                    detail=f"Image not ready or missing outputs. status: {resp_data.get('status')}"
-                )
-        
+        if user_image_bytes is None:
+            user_image_bytes = base64.b64decode(image_base64)
+        if mode == "async":
+            return await submit_generation_job(db, current_user, image_request, image_type, user_image_bytes)
+        model = model_router.choose(model, image_request.latency_budget_ms)
+        image_bytes, cache_status = await generate_with_cache(
+            db, model, prompt, image_base64, user_image_bytes, image_request.seed
+        )
     except HTTPException:
         raise
     except Exception as e:
-        print("Full error traceback:\n", traceback.format_exc())
+        logger.exception(f"Image editing failed: {e}")
         raise HTTPException(
             status_code=500,
             detail={
                 "error": "Problem with image editing",
-                "exception": str(e),
-                "resp_data": resp.json() if 'resp' in locals() else None
+                "exception": str(e)
+            }
+        )
+    
+    body, media_type = await negotiated_image(request, format, image_bytes)
+    await history_writer.submit(
+        db, ImageSave(prompt, model, image_bytes, current_user.username, image_type, user_image_bytes,
+                      variants={media_type: body} if body is not image_bytes else {})
+    )
+    return image_response(body, media_type, cache_status, model)
+async def negotiated_image(request: Request, requested: Optional[str],
+                           image_bytes: bytes) -> Tuple[bytes, str]:
+    """ convert a generated image to the format the client asked for.
+        Returns the bytes to send and their media type; the image itself
+        when no conversion was asked for or it failed.
+    """
+    original_type = sniff_content_type(image_bytes)
+    target = negotiate_format(request.headers.get("accept"), requested, original_type)
+    if target is None:
+        return image_bytes, original_type
+    try:
+        return await transcoder.convert(image_bytes, target), target
+    except Exception as e:
+        logger.warning(f"Failed to convert image to {target}: {e}")
+        return image_bytes, original_type
+def image_response(body: bytes, media_type: str, cache_status: str, model: str) -> Response:
+    """ return a generated image to the client """
+    return Response(
+        content=body,
+        media_type=media_type,
+        headers={"Content-Disposition": "inline", "X-Cache": cache_status, "X-Model": model,
+                 "Vary": "Accept"}
+    )
+async def submit_generation_job(db: AsyncIOMotorDatabase, current_user: UserInfo,
+                          image_request: ImageRequestBody, image_type: str,
+                          user_image_bytes: Optional[bytes] = None) -> JSONResponse:
+    """ queue a generation for the job workers and answer 202 with the job.
+        The image to edit is kept as a blob until the job has finished.
+    """
+    # Reject unknown models before queuing, the variant is chosen when the job runs
+    if not model_router.is_known(image_request.model):
+        raise HTTPException(status_code=400, detail=f"Unsupported model: {image_request.model}")
+    job = {
+        "username": current_user.username,
+        "image_type": image_type,
+        "prompt": image_request.prompt,
+        "model": image_request.model,
+        "seed": image_request.seed,
+        "latency_budget_ms": image_request.latency_budget_ms
+    }
+    if user_image_bytes:
+        job["input_hash"], _ = await put_blob(db, user_image_bytes)
+    try:
+        job = await job_manager.submit(db, job)
+    except HTTPException:
+        if user_image_bytes:
+            await release_blob(db, job["input_hash"])
+        raise
+    view = job_view(job)
+    return JSONResponse(status_code=202, content=view, headers={"Location": view["status_url"]})
+async def release_job_input(db: AsyncIOMotorDatabase, job: dict):
+    """ give back the blob of the image to edit, only once per job
+        however many replicas ended up running it
+    """
+    if not job.get("input_hash"):
+        return
+    result = await db.jobs.update_one(
+        {"_id": job["_id"], "input_hash": {"$exists": True}},
+        {"$unset": {"input_hash": ""}}
+    )
+    if result.modified_count:
+        await release_blob(db, job["input_hash"])
+async def run_generation_job(db: AsyncIOMotorDatabase, job: dict) -> dict:
+    """ job handler: generate the image of a queued job and save it to history """
+    user_image_bytes = None
+    image_base64 = None
+    try:
+        if job.get("input_hash"):
+            source = await image_source(db, {"content_hash": job["input_hash"]})
+            user_image_bytes = await storage_for_record(source).load(db, source)
+            image_base64 = base64.b64encode(user_image_bytes).decode("utf-8")
+        model = model_router.choose(job["model"], job.get("latency_budget_ms"))
+        image_bytes, _ = await generate_with_cache(
+            db, model, job["prompt"], image_base64, user_image_bytes, job.get("seed")
+        )
+        # The account may have been deleted while the job was running
+        if not await db.users.find_one({"username": job["username"]}, {"_id": 1}):
+            raise HTTPException(status_code=410, detail="The account was deleted")
+        image_id = await save_image_to_db(
+            db, job["prompt"], model, image_bytes,
+            UserInfo(username=job["username"]), job["image_type"], user_image_bytes
+        )
+        if image_id is None:
+            raise HTTPException(status_code=500, detail="Failed to save the generated image")
+    except Exception:
+        await release_job_input(db, job)
+        raise
+    # Cancellation skips the release, the job runs again after a restart or takeover
+    await release_job_input(db, job)
+    return {"image_id": image_id, "model": model, "content_hash": content_hash(image_bytes)}
+async def find_job(db: AsyncIOMotorDatabase, job_id: str, current_user: UserInfo) -> dict:
+    """ return a job of the user or raise 404 """
+    job = None
+    if ObjectId.is_valid(job_id):
+        job = await db.jobs.find_one({"_id": ObjectId(job_id), "username": current_user.username})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+async def generate_with_cache(db: AsyncIOMotorDatabase, model: str, prompt: str,
+                              image_base64: Optional[str] = None,
+                              image_bytes: Optional[bytes] = None,
+                              seed: Optional[int] = None) -> Tuple[bytes, str]:
+    """ serve seeded requests from the result cache, call Verda otherwise.
+        Identical requests that arrive while a call is running wait for that
+        call instead of making their own.
+    Args:
+        db (AsyncIOMotorDatabase): db
+        model (str): model to use
+        prompt (str): user prompt
+        image_base64 (Optional[str]): image to edit in base64 format
+        image_bytes (Optional[bytes]): the same image decoded
+        seed (Optional[int]): explicit seed, requests without one are never cached
+    Returns:
+        Tuple[bytes, str]: the generated image and HIT, MISS or BYPASS
+    """
+    cacheable = seed is not None and settings.RESULT_CACHE_ENABLED
+    key = cache_key(model, prompt, seed, content_hash(image_bytes) if image_bytes else None)
+    if cacheable:
+        cached = await result_cache.get(db, key)
+        if cached is not None:
+            return cached, "HIT"
+    
+    async def call_upstream() -> bytes:
+        result = await request_image(model, prompt, image_base64, seed)
+        if cacheable:
+            await result_cache.put(db, key, result, content_hash(result))
+        return result
+    
+    if settings.SINGLE_FLIGHT_ENABLED:
+        result, _ = await generation_flights.do(key, call_upstream)
+    else:
+        result = await call_upstream()
+    return result, "MISS" if cacheable else "BYPASS"
+async def request_image(model: str, prompt: str,
+                        image_base64: Optional[str] = None,
+                        seed: Optional[int] = None) -> bytes:
+    """ call Verda and return the decoded image.
+        The call waits for a free slot of the model's admission gate and
+        is rejected with 429 when the model is overloaded. Its duration
+        feeds the latency-aware router.
+        The response body is streamed and only the image field is decoded,
+        straight into the buffer that is returned, so the raw JSON and the
+        base64 string are never held in memory as a whole.
+    """
+    url = choose_model_url(model)
+    with tracer.span("build_request_data", {"model": model}):
+        data = build_request_data(model, prompt, image_base64, seed)
+    async with admission.slot(model):
+        started = time.monotonic()
+        status = None
+        try:
+            with phase("upstream"), tracer.span("upstream POST", {"model": model}, kind=CLIENT) as span:
+                resp = await post_to_model(model, url, data)
+                if span:
+                    span.set_attribute("http.response.status_code", resp.status_code)
+            status = resp.status_code
+            try:
+                if resp.is_success:
+                    with phase("decode"), tracer.span("decode", {"model": model}):
+                        decoder = await decode_model_response(model, resp)
+                else:
+                    with phase("upstream"), upstream_errors():
+                        await resp.aread()
+            finally:
+                await resp.aclose()
+        except HTTPException as e:
+            # No answer from the model: timeouts, transport errors and an open breaker
+            status = status or e.status_code
+            raise
+        finally:
+            upstream_latency.observe(time.monotonic() - started, model=model, status=str(status or 500))
+        if resp.status_code < 500:
+            model_router.tracker.observe(model, time.monotonic() - started)
+    
+    if not resp.is_success:
+        raise HTTPException(
+            status_code=resp.status_code,
+            detail=f"Image generation failed: {resp.text}"
+        )
+    
+    image_bytes = decoder.image()
+    status = decoder.fields.get(("status",))
+    if image_bytes is None or ("KLEIN" not in model and status != "COMPLETED"):
+        logger.warning(f"No image in the response of {model}, status: {status}")
+        raise HTTPException(
+            status_code=500,
+            detail={
+                "error": "Problem generating image",
+                "data": {"status": status}
             }
         )
-def save_image_to_db(db: Database, prompt: str, model:
-                    str, image_base64: str, current_user:UserInfo,
-                    image_type:str, user_base64_image: Optional[str] = None ):
-    """ Saves the image(s) to mongoDB.
+    decoded_image_size.observe(len(image_bytes), model=model)
+    return image_bytes
+async def decode_model_response(model: str, resp: httpx.Response) -> ImageFieldDecoder:
+    """ feed the streamed response body through a decoder for the model's image field """
+    decoder = ImageFieldDecoder(image_path(model), fields=[("status",)])
+    with upstream_errors():
+        try:
+            async for chunk in resp.aiter_bytes():
+                decoder.feed(chunk)
+            decoder.image()
+        except ValueError as e:
+            raise HTTPException(
+                status_code=500,
+                detail={"error": "Problem generating image", "data": str(e)}
+            )
+    return decoder
+async def save_image_to_db(db: AsyncIOMotorDatabase, prompt: str, model:
+                    str, image_bytes: bytes, current_user:UserInfo,
+                    image_type:str, user_image_bytes: Optional[bytes] = None ):
+    """ Saves the image(s) to mongoDB right away.
+        The image bytes are stored once per distinct content as a shared blob,
+        and the record only keeps the blob's content hash. Thumbnails are
+        created in the background when a new blob is stored.
         If the user has provided the original image, it is also saved to the database,
-        and the edited image is referenced by the original record ID.
+        and the edited image is referenced by the original record ID. A user's
+        original with the same content is reused instead of saved again.
+        Routes hand their images to history_writer instead, which saves them
+        the same way in batches after the response.
     Args:
-        db (Database): db
+        db (AsyncIOMotorDatabase): db
         prompt (str): user prompt
         model (str): model used to generate/edit the image
-        image_base64 (str): generated image in base64 format
+        image_bytes (bytes): generated image
         current_user (UserInfo): logged-in user
-        user_base64_image (Optional[str], optional): image added by user in base64 format. Defaults to None.
+        user_image_bytes (Optional[bytes], optional): image added by user. Defaults to None.
         type (str): is the image returned by the AI edited or completely generated?
+    Returns:
+        Optional[str]: id of the saved image record, None if saving failed
+    """
+    save = ImageSave(prompt, model, image_bytes, current_user.username, image_type, user_image_bytes)
+    return (await write_images(db, [save]))[0]
+async def find_image(db: AsyncIOMotorDatabase, image_id: str, current_user: UserInfo,
+                     projection: dict) -> dict:
+    """ return the user's image record or raise 404 """
+    if not ObjectId.is_valid(image_id):
+        raise HTTPException(status_code=404, detail="Image not found")
+    record = await db.images.find_one(
+        {"_id": ObjectId(image_id), "username": current_user.username}, projection
+    )
+    if not record:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return record
+async def find_owned_blob(db: AsyncIOMotorDatabase, digest: str, current_user: UserInfo) -> dict:
+    """ return the blob with this content hash if one of the user's records refers to it, else 404 """
+    owned = await db.images.find_one(
+        {"username": current_user.username, "content_hash": digest}, {"_id": 1}
+    )
+    blob = await db.image_blobs.find_one({"_id": digest}) if owned else None
+    if not blob:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return blob
+async def image_delivery(request: Request, db: AsyncIOMotorDatabase, source: dict, key: str,
+                         requested: Optional[str] = None, negotiate: bool = False) -> Response:
+    """ answer with the image stored at source, its type sniffed only if unknown and sent.
+        key names the content for the ETag. With negotiate, source is a blob
+        and a WebP/AVIF variant is sent when asked for, created on first use.
     """
+    etag = make_etag(key)
+    vary = None
+    if negotiate and source.get("content_type"):
+        vary = "Accept" if requested is None else None
+        target = negotiate_format(request.headers.get("accept"), requested, source["content_type"])
+        if target:
+            variant_etag = make_etag(f"{key}.{variant_key(target)}")
+            try:
+                if not etag_matches(request.headers.get("if-none-match"), variant_etag):
+                    source = await transcoder.variant(db, source, target)
+                etag = variant_etag
+            except Exception as e:
+                logger.warning(f"Failed to convert image {key} to {target}: {e}")
+    chunks = storage_for_record(source).stream(db, source)
+    content_type = source.get("content_type")
+    if not content_type and not etag_matches(request.headers.get("if-none-match"), etag):
+        first_chunk = await anext(chunks, b"")
+        content_type = sniff_content_type(first_chunk)
+        chunks = prepend_chunk(first_chunk, chunks)
+    return deliver(request, chunks, etag, content_type or "application/octet-stream", source.get("size"), vary)
+def thumbnail_delivery(request: Request, db: AsyncIOMotorDatabase, source: dict, key: str) -> Response:
+    """ answer with the thumbnail attached to source """
+    thumbnail = source.get("thumbnail")
+    if not thumbnail:
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    chunks = storage_for_record(thumbnail).stream(db, thumbnail)
+    return deliver(request, chunks, make_etag(f"{key}-thumbnail"), "image/webp")
+async def prepend_chunk(first_chunk: bytes, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """ yield first_chunk, then the rest of chunks """
+    yield first_chunk
+    async for chunk in chunks:
+        yield chunk
+def image_url(record: dict) -> str:
+    """ stable URL of a record's image: its content hash, or the record id before deduplication """
+    if record.get("content_hash"):
+        return f"/images/blobs/{record['content_hash']}"
+    return f"/images/{record['_id']}"
+def encode_history_cursor(record: dict) -> str:
+    """ encode the position of a history record as an opaque cursor """
+    timestamp = record["timestamp"]
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    position = {"t": timestamp.isoformat(), "id": str(record["_id"])}
+    return base64.urlsafe_b64encode(json.dumps(position).encode("utf-8")).decode("ascii")
+def decode_history_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+    """ decode a cursor made by encode_history_cursor """
     try:
-        original_id = None
-        if user_base64_image:
-            user_input_image_record = {
-                "prompt": prompt,
-                "model": model,
-                "timestamp": datetime.now(timezone.utc),
-                "image_size": len(base64.b64decode(user_base64_image)),
-                "image_data": user_base64_image,
-                "username": current_user.username,
-                "image_type": "original"
-            }
-            res = db.images.insert_one(user_input_image_record)
-            original_id = res.inserted_id
-        
-        image_record = {
-            "prompt": prompt,
-            "model": model,
-            "timestamp": datetime.now(timezone.utc),
-            "image_size": len(base64.b64decode(image_base64)),
-            "image_data": image_base64,
-            "username": current_user.username,
-            "image_type": image_type
-        }
-        
-        if original_id != None:
-            image_record["parent_image_id"] = original_id
-                
-        db.images.insert_one(image_record)
-        print(f"Saved image data to MongoDB for user: {current_user.username}")
-    except Exception as e:
-        print(f"Failed to save to MongoDB: {e}")
-        
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(position["t"]), ObjectId(position["id"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 def choose_model_url(model: str)-> str:
     """ return the correct model URL """
     try:
@@ -317,12 +905,50 @@ def choose_model_url(model: str)-> str:
             status_code=400,
             detail=f"Unsupported model: {model}"
         )
-def build_request_data(model: str,  prompt: str, image_base64: Optional[str] = None) -> dict:
+async def post_to_model(model: str, url: str, data: dict) -> httpx.Response:
+    """ send the request to Verda through the pooled async client,
+        with the model's deadlines, retries and circuit breaker
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {settings.VERDA_API_KEY}"
+    }
+    request_id = current_request_id()
+    if request_id:
+        headers[REQUEST_ID_HEADER] = request_id
+    trace_context = current_context()
+    if trace_context:
+        headers[TRACEPARENT_HEADER] = trace_context.traceparent()
+    timeout = upstream_policy.timeout_for(model)
+    with upstream_errors():
+        return await upstream_policy.call(
+            model,
+            lambda: upstream_client.post(url, stream=True, headers=headers, json=data, timeout=timeout)
+        )
+@contextmanager
+def upstream_errors():
+    """ turn transport errors of an upstream call into 504 or 502 """
+    try:
+        yield
+    except httpx.TimeoutException:
+        raise HTTPException(
+            status_code=504,
+            detail="Image model did not respond in time"
+        )
+    except httpx.HTTPError as e:
+        raise HTTPException(
+            status_code=502,
+            detail=f"Could not reach image model: {str(e)}"
+        )
+def build_request_data(model: str,  prompt: str, image_base64: Optional[str] = None,
+                       seed: Optional[int] = None) -> dict:
     """ build the right type of data dictionary """
     base_data = {
             "prompt": prompt,
             "enable_base64_output": True
         }
+    if seed is not None:
+        base_data["seed"] = seed
     if image_base64:
         if "KLEIN" in model:
             base_data["input_images"] = [image_base64]
@@ -0,0 +1,146 @@
+"""
+Latency-aware routing between variants of a model family
+
+A request may name a model family from settings.MODEL_FAMILIES instead of a
+single model, and may give a latency budget. The router keeps a rolling
+window of upstream call durations per model and predicts the latency of a
+new call from a percentile of that window and the model's current queue.
+
+- A family without a budget goes to the fastest healthy variant.
+- With a budget, the first healthy variant in the family's order of
+  preference whose predicted latency fits is chosen, e.g. FLUX2_KLEIN_9B
+  falls back to FLUX2_KLEIN_4B when 9B is saturated.
+- A single model without a budget is used as is.
+"""
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from fastapi import HTTPException
+
+from app.admission import admission
+from app.config import settings
+from app.metrics import registry
+from app.resilience import upstream_policy
+
+routing_decisions = registry.counter(
+    "model_routing_decisions_total",
+    "Models chosen by the router for the model or family that was requested",
+    ("requested", "chosen")
+)
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """Nearest-rank percentile of unsorted samples, q between 0 and 100"""
+    ordered = sorted(samples)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+class LatencyTracker:
+    """Rolling window of upstream call durations per model"""
+
+    def __init__(self, window_size: int):
+        self.window_size = window_size
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, model: str, seconds: float):
+        with self._lock:
+            window = self._samples.get(model)
+            if window is None:
+                window = self._samples[model] = deque(maxlen=self.window_size)
+            window.append(seconds)
+
+    def percentile(self, model: str, q: float) -> Optional[float]:
+        """Percentile of the window in seconds, None before the first sample"""
+        with self._lock:
+            samples = list(self._samples.get(model, ()))
+        return percentile(samples, q) if samples else None
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+
+class ModelRouter:
+    """Picks the model that serves a request"""
+
+    def __init__(self, tracker: LatencyTracker):
+        self.tracker = tracker
+
+    def is_known(self, model: str) -> bool:
+        return model in settings.MODEL_URLS or model in settings.MODEL_FAMILIES
+
+    def predicted_latency(self, model: str) -> Optional[float]:
+        """
+        Expected seconds until a new call to the model returns
+
+        The window percentile is scaled by how many calls are queued ahead
+        for each of the model's slots. None while nothing has been observed.
+        """
+        latency = self.tracker.percentile(model, settings.ROUTING_PERCENTILE)
+        if latency is None:
+            return None
+        gate = admission.gate(model)
+        queued_ahead = gate.waiting + max(0, gate.active + 1 - gate.limit)
+        return latency * (1 + queued_ahead / max(gate.limit, 1))
+
+    def candidates(self, model: str, budget_ms: Optional[int]) -> List[str]:
+        """Variants that may serve the request, in order of preference"""
+        if model in settings.MODEL_FAMILIES:
+            return list(settings.MODEL_FAMILIES[model])
+        if budget_ms is not None:
+            # A single model may fall back to the variants after it in its family
+            for variants in settings.MODEL_FAMILIES.values():
+                if model in variants:
+                    return variants[variants.index(model):]
+        return [model]
+
+    def choose(self, model: str, budget_ms: Optional[int] = None) -> str:
+        """
+        Resolve a requested model or family to the model that will serve it
+
+        Args:
+            model: model name or family name
+            budget_ms: latency the caller is willing to wait, in milliseconds
+
+        Returns:
+            str: a model in settings.MODEL_URLS
+
+        Raises:
+            HTTPException: If the model or family is unknown
+        """
+        if not self.is_known(model):
+            raise HTTPException(status_code=400, detail=f"Unsupported model: {model}")
+        candidates = self.candidates(model, budget_ms)
+        if len(candidates) == 1:
+            chosen = candidates[0]
+        else:
+            chosen = self._pick(candidates, budget_ms)
+        routing_decisions.inc(requested=model, chosen=chosen)
+        return chosen
+
+    def _pick(self, candidates: List[str], budget_ms: Optional[int]) -> str:
+        healthy = [m for m in candidates if upstream_policy.breaker(m).available()] or candidates
+        predictions = {m: self.predicted_latency(m) for m in healthy}
+        if budget_ms is not None:
+            budget = budget_ms / 1000
+            for m in healthy:
+                # Unobserved variants are tried so they get observed
+                if predictions[m] is None or predictions[m] <= budget:
+                    return m
+        # Fastest variant; unobserved ones first, in order of preference
+        return min(healthy, key=lambda m: (predictions[m] is not None, predictions[m] or 0))
+
+    def status(self, model: str) -> dict:
+        """Observed latency percentiles of a model in milliseconds"""
+        status = {}
+        for q in (50, 90, 99):
+            latency = self.tracker.percentile(model, q)
+            status[f"latency_p{q}_ms"] = round(latency * 1000) if latency is not None else None
+        return status
+
+
+# Global router, fed with the durations of upstream calls
+model_router = ModelRouter(LatencyTracker(settings.ROUTING_WINDOW_SIZE))
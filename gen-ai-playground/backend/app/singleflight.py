@@ -0,0 +1,61 @@
+"""
+Coalescing of identical concurrent calls
+
+When several requests need the result of the same call at the same time,
+only the first one makes it and the others wait for its result.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from app.metrics import registry
+
+coalesced_requests = registry.counter(
+    "singleflight_requests_total",
+    "Calls that ran upstream (leader) or waited for an identical call (shared)",
+    ("result",)
+)
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time and shares its result"""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+
+    def in_flight(self) -> int:
+        """Number of calls currently running"""
+        return len(self._calls)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Run fn, or wait for the call already running under the same key
+
+        The call runs in its own task, so a caller that disconnects does not
+        cancel it for the others.
+
+        Args:
+            key: identifies calls that give the same result
+            fn: makes the call
+
+        Returns:
+            Tuple[Any, bool]: the result and whether it came from another caller's call
+        """
+        task = self._calls.get(key)
+        shared = task is not None
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        coalesced_requests.inc(result="shared" if shared else "leader")
+        return await asyncio.shield(task), shared
+
+    def _finished(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark the exception as retrieved in case every caller went away
+        if not task.cancelled():
+            task.exception()
+
+
+# Global coalescer for upstream image generation calls
+generation_flights = SingleFlight()
@@ -0,0 +1,213 @@
+"""
+Image storage backends
+
+Image records in the images collection hold metadata and a reference to the
+image bytes. The bytes themselves live in one of the backends below, selected
+with the IMAGE_STORAGE_BACKEND setting. Every operation is a coroutine; the
+filesystem backend does its file I/O in worker threads.
+"""
+import asyncio
+import base64
+import hashlib
+import os
+import tempfile
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Dict
+
+from gridfs.errors import NoFile
+from motor.motor_asyncio import AsyncIOMotorDatabase, AsyncIOMotorGridFSBucket
+
+from app.config import settings
+
+
+class ImageStorage(ABC):
+    """Base class for image storage backends"""
+
+    name: str = ""
+
+    @abstractmethod
+    async def save(self, db: AsyncIOMotorDatabase, image_bytes: bytes) -> dict:
+        """
+        Store image bytes
+
+        Args:
+            db: Database instance
+            image_bytes: decoded image
+
+        Returns:
+            dict: fields to store in the image record
+        """
+
+    @abstractmethod
+    async def load(self, db: AsyncIOMotorDatabase, record: dict) -> bytes:
+        """Return the image bytes referenced by an image record"""
+
+    async def stream(self, db: AsyncIOMotorDatabase, record: dict,
+                     chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+        """Yield the image bytes referenced by an image record in chunks"""
+        data = await self.load(db, record)
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+
+    @abstractmethod
+    async def delete(self, db: AsyncIOMotorDatabase, record: dict):
+        """Remove the image bytes referenced by an image record"""
+
+
+class InlineStorage(ImageStorage):
+    """Keeps the image as a base64 string inside the image record"""
+
+    name = "inline"
+
+    async def save(self, db: AsyncIOMotorDatabase, image_bytes: bytes) -> dict:
+        return {
+            "storage": self.name,
+            "image_data": base64.b64encode(image_bytes).decode("utf-8")
+        }
+
+    async def load(self, db: AsyncIOMotorDatabase, record: dict) -> bytes:
+        return base64.b64decode(record["image_data"])
+
+    async def delete(self, db: AsyncIOMotorDatabase, record: dict):
+        # The data goes away together with the record fields
+        pass
+
+
+class GridFSStorage(ImageStorage):
+    """Keeps the image in a MongoDB GridFS bucket"""
+
+    name = "gridfs"
+
+    def __init__(self, collection: str = "image_files"):
+        self.collection = collection
+
+    def _fs(self, db: AsyncIOMotorDatabase) -> AsyncIOMotorGridFSBucket:
+        # Same layout as the image_files.files and image_files.chunks collections
+        return AsyncIOMotorGridFSBucket(db, bucket_name=self.collection)
+
+    async def save(self, db: AsyncIOMotorDatabase, image_bytes: bytes) -> dict:
+        file_id = await self._fs(db).upload_from_stream("image", image_bytes)
+        return {"storage": self.name, "storage_ref": file_id}
+
+    async def load(self, db: AsyncIOMotorDatabase, record: dict) -> bytes:
+        grid_out = await self._fs(db).open_download_stream(record["storage_ref"])
+        return await grid_out.read()
+
+    async def stream(self, db: AsyncIOMotorDatabase, record: dict,
+                     chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+        grid_out = await self._fs(db).open_download_stream(record["storage_ref"])
+        while True:
+            chunk = await grid_out.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    async def delete(self, db: AsyncIOMotorDatabase, record: dict):
+        try:
+            await self._fs(db).delete(record["storage_ref"])
+        except NoFile:
+            pass
+
+
+class FilesystemStorage(ImageStorage):
+    """
+    Keeps the image in a content-addressed directory tree.
+
+    Files are named by the SHA-256 of their bytes, so identical images are
+    written once and shared by every record that references them.
+    """
+
+    name = "filesystem"
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    async def save(self, db: AsyncIOMotorDatabase, image_bytes: bytes) -> dict:
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        await asyncio.to_thread(self._write, self._path(digest), image_bytes)
+        return {"storage": self.name, "storage_ref": digest}
+
+    def _write(self, path: str, image_bytes: bytes):
+        if not os.path.exists(path):
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            # Write to a temporary file first so readers never see a partial image
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(image_bytes)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+    def _read(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    async def load(self, db: AsyncIOMotorDatabase, record: dict) -> bytes:
+        return await asyncio.to_thread(self._read, self._path(record["storage_ref"]))
+
+    async def stream(self, db: AsyncIOMotorDatabase, record: dict,
+                     chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+        f = await asyncio.to_thread(open, self._path(record["storage_ref"]), "rb")
+        try:
+            while True:
+                chunk = await asyncio.to_thread(f.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            f.close()
+
+    async def delete(self, db: AsyncIOMotorDatabase, record: dict):
+        # Other blobs, or records from before blobs, may point at the same content
+        query = {
+            "_id": {"$ne": record.get("_id")},
+            "storage": self.name,
+            "storage_ref": record["storage_ref"]
+        }
+        if await db.image_blobs.find_one(query) or await db.images.find_one(query):
+            return
+        path = self._path(record["storage_ref"])
+        try:
+            await asyncio.to_thread(os.remove, path)
+        except FileNotFoundError:
+            pass
+
+
+def get_backend(name: str) -> ImageStorage:
+    """
+    Return the storage backend with the given name
+
+    Raises:
+        ValueError: If the name is not a known backend
+    """
+    backends: Dict[str, ImageStorage] = {
+        InlineStorage.name: InlineStorage(),
+        GridFSStorage.name: GridFSStorage(),
+        FilesystemStorage.name: FilesystemStorage(settings.IMAGE_STORAGE_PATH)
+    }
+    try:
+        return backends[name]
+    except KeyError:
+        raise ValueError(f"Unknown image storage backend: {name}")
+
+
+def get_storage() -> ImageStorage:
+    """Return the backend new images are written to"""
+    return get_backend(settings.IMAGE_STORAGE_BACKEND)
+
+
+def storage_for_record(record: dict) -> ImageStorage:
+    """Return the backend holding a record's image; old records are inline"""
+    return get_backend(record.get("storage", InlineStorage.name))
+
+
+async def load_image(db: AsyncIOMotorDatabase, record: dict) -> bytes:
+    """Read the image bytes of a record from whichever backend holds them"""
+    return await storage_for_record(record).load(db, record)
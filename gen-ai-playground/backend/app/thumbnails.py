@@ -0,0 +1,117 @@
+"""
+Thumbnail and placeholder generation for stored images
+
+Resizing runs in a small background thread pool so that saving an image
+never waits for it. When the work is done the image blob is updated, back
+on the event loop, with the image dimensions, a WebP thumbnail and a tiny
+blurred placeholder.
+"""
+import asyncio
+import base64
+import io
+import logging
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Optional, Set
+
+from PIL import Image
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from app.config import settings
+from app.storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+
+def make_thumbnail(image_bytes: bytes) -> dict:
+    """
+    Build the preview fields for an image
+
+    Args:
+        image_bytes: decoded image in any format Pillow understands
+
+    Returns:
+        dict: width, height, WebP thumbnail bytes and a data URL placeholder
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        width, height = image.size
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+        thumbnail = image.copy()
+        thumbnail.thumbnail((settings.THUMBNAIL_SIZE, settings.THUMBNAIL_SIZE))
+        thumbnail_buffer = io.BytesIO()
+        thumbnail.save(thumbnail_buffer, format="WEBP", quality=settings.THUMBNAIL_QUALITY)
+
+        # A few pixels are enough, the browser scales and blurs it
+        placeholder = image.copy()
+        placeholder.thumbnail((settings.PLACEHOLDER_SIZE, settings.PLACEHOLDER_SIZE))
+        placeholder_buffer = io.BytesIO()
+        placeholder.save(placeholder_buffer, format="WEBP", quality=30)
+
+    placeholder_base64 = base64.b64encode(placeholder_buffer.getvalue()).decode("ascii")
+    return {
+        "width": width,
+        "height": height,
+        "thumbnail": thumbnail_buffer.getvalue(),
+        "placeholder": f"data:image/webp;base64,{placeholder_base64}"
+    }
+
+
+async def process_thumbnail(db: AsyncIOMotorDatabase, digest: str, image_bytes: bytes,
+                            executor: Optional[Executor] = None):
+    """
+    Create the previews of a stored image and attach them to its blob
+
+    Args:
+        db: Database instance
+        digest: content hash of the image blob
+        image_bytes: the stored image
+        executor: pool to resize in, defaults to the loop's default executor
+    """
+    try:
+        loop = asyncio.get_running_loop()
+        preview = await loop.run_in_executor(executor, make_thumbnail, image_bytes)
+        thumbnail_ref = await get_storage().save(db, preview["thumbnail"])
+        await db.image_blobs.update_one(
+            {"_id": digest},
+            {"$set": {
+                "width": preview["width"],
+                "height": preview["height"],
+                "placeholder": preview["placeholder"],
+                "thumbnail": thumbnail_ref
+            }}
+        )
+    except Exception as e:
+        logger.warning(f"Failed to create thumbnail for image {digest}: {e}")
+
+
+class ThumbnailPipeline:
+    """Runs process_thumbnail as background tasks resizing in a thread pool"""
+
+    def __init__(self):
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def submit(self, db: AsyncIOMotorDatabase, digest: str, image_bytes: bytes) -> asyncio.Task:
+        """Queue thumbnail creation for an image blob and return immediately"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=settings.THUMBNAIL_WORKERS,
+                thread_name_prefix="thumbnail"
+            )
+        task = asyncio.create_task(process_thumbnail(db, digest, image_bytes, self._executor))
+        # Keep a reference until done, the loop only holds weak ones
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def stop(self):
+        """Wait for queued thumbnails to finish and release the threads"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+# Global thumbnail pipeline instance, stopped by the app lifespan
+thumbnail_pipeline = ThumbnailPipeline()
@@ -0,0 +1,310 @@
+"""
+In-process tracing with W3C trace context
+
+Spans time the phases of a generation: authentication, building the model
+request, the upstream POST, decoding the response and saving the image. A
+request's spans belong to the trace named by its traceparent header, or to
+a new one, and the upstream POST sends a traceparent naming its own span so
+the model API can continue the trace.
+
+Finished spans go on a bounded queue. A background thread exports them in
+batches as OTLP/JSON, either appended to TRACE_FILE as one line per batch
+or POSTed to an OTLP/HTTP collector at TRACE_OTLP_ENDPOINT. Tracing is off
+unless TRACE_EXPORTER names one of the two; spans are then no-ops. Images
+saved by the background history writer are written in a span of its own,
+linked to the spans of the requests that produced them.
+"""
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List, Optional
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.config import settings
+from app.logs import current_request_id
+from app.metrics import registry
+from app.request_metrics import route_template
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT_HEADER = "traceparent"
+_TRACEPARENT = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+SERVICE_NAME = "gen-ai-playground-backend"
+EXPORT_BATCH_SIZE = 512
+EXPORT_INTERVAL_SECONDS = 1.0
+
+# OTLP span kinds
+INTERNAL = 1
+SERVER = 2
+CLIENT = 3
+
+spans_dropped = registry.counter(
+    "trace_spans_dropped_total",
+    "Finished spans dropped because the export queue was full"
+)
+export_failures = registry.counter(
+    "trace_export_failures_total",
+    "Spans that could not be written to the trace file or collector"
+)
+
+
+@dataclass(frozen=True)
+class SpanContext:
+    """The identity of a span, as carried by traceparent"""
+    trace_id: str
+    span_id: str
+    sampled: bool
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[SpanContext]:
+    """The span context of a traceparent header, None if it is missing or invalid"""
+    if not value:
+        return None
+    match = _TRACEPARENT.match(value.strip().lower())
+    if not match:
+        return None
+    version, trace_id, span_id, flags = match.groups()
+    if version == "ff" or trace_id == "0" * 32 or span_id == "0" * 16:
+        return None
+    return SpanContext(trace_id, span_id, bool(int(flags, 16) & 1))
+
+
+def _new_id(length: int) -> str:
+    return os.urandom(length // 2).hex()
+
+
+def _attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+class Span:
+    """A timed operation of a trace"""
+
+    def __init__(self, name: str, context: SpanContext, parent_id: Optional[str] = None,
+                 kind: int = INTERNAL, attributes: Optional[dict] = None,
+                 links: Iterable[SpanContext] = ()):
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.links = list(links)
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.context.trace_id,
+            "spanId": self.context.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_attribute(key, value) for key, value in self.attributes.items()],
+            # 2 = error, 0 = unset
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 0}
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.links:
+            span["links"] = [{"traceId": link.trace_id, "spanId": link.span_id} for link in self.links]
+        return span
+
+
+def otlp_payload(spans: List[Span]) -> dict:
+    """An OTLP/JSON ExportTraceServiceRequest with the spans"""
+    return {"resourceSpans": [{
+        "resource": {"attributes": [_attribute("service.name", SERVICE_NAME)]},
+        "scopeSpans": [{"scope": {"name": __name__}, "spans": [span.to_otlp() for span in spans]}]
+    }]}
+
+
+_current: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def current_context() -> Optional[SpanContext]:
+    """Context of the span being run, to link work done later to it"""
+    span = _current.get()
+    return span.context if span else None
+
+
+class Tracer:
+    """Creates spans and exports the finished ones from a background thread"""
+
+    def __init__(self):
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        """Start exporting if TRACE_EXPORTER is "file" or "otlp" """
+        if self._thread is not None or settings.TRACE_EXPORTER not in ("file", "otlp"):
+            return
+        self._queue = queue.Queue(maxsize=settings.TRACE_QUEUE_SIZE)
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._export_loop, name="trace-export", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Export the spans still queued, then stop"""
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        self._queue = None
+
+    @contextmanager
+    def span(self, name: str, attributes: Optional[dict] = None, kind: int = INTERNAL,
+             parent: Optional[SpanContext] = None, links: Iterable[SpanContext] = (),
+             root: bool = False) -> Iterator[Optional[Span]]:
+        """
+        Run the block in a span
+
+        The span is a child of parent, or of the span being run. Without
+        either it starts a new trace when root is set or it has links, and
+        is skipped otherwise, so helpers called outside a traced request or
+        job cost nothing.
+
+        Yields:
+            Optional[Span]: the span, None when nothing is traced
+        """
+        links = [link for link in links if link is not None]
+        current = _current.get()
+        if parent is None and current is not None:
+            parent = current.context
+        if not self.enabled or (parent is None and not root and not links):
+            yield None
+            return
+        if parent is not None:
+            context = SpanContext(parent.trace_id, _new_id(16), parent.sampled)
+        else:
+            sampled = random.random() < settings.TRACE_SAMPLE_RATE
+            context = SpanContext(_new_id(32), _new_id(16), sampled)
+        span = Span(name, context, parent.span_id if parent else None, kind, attributes, links)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            # Client errors (4xx) are answers, not failures of the span
+            status_code = getattr(e, "status_code", 500)
+            if status_code >= 500:
+                span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current.reset(token)
+            span.end_ns = time.time_ns()
+            if context.sampled:
+                self._finish(span)
+
+    def _finish(self, span: Span):
+        try:
+            self._queue.put_nowait(span)
+        except (queue.Full, AttributeError):
+            spans_dropped.inc()
+
+    def _export_loop(self):
+        while True:
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=EXPORT_INTERVAL_SECONDS))
+            except queue.Empty:
+                pass
+            while len(batch) < EXPORT_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch:
+                self._export(batch)
+            if self._stopping.is_set() and self._queue.empty():
+                return
+
+    def _export(self, spans: List[Span]):
+        body = json.dumps(otlp_payload(spans))
+        try:
+            if settings.TRACE_EXPORTER == "file":
+                with open(settings.TRACE_FILE, "a", encoding="utf-8") as trace_file:
+                    trace_file.write(body + "\n")
+            else:
+                request = urllib.request.Request(
+                    settings.TRACE_OTLP_ENDPOINT,
+                    data=body.encode("utf-8"),
+                    headers={"Content-Type": "application/json"},
+                    method="POST"
+                )
+                with urllib.request.urlopen(request, timeout=5):
+                    pass
+        except Exception as e:
+            export_failures.inc(len(spans))
+            logger.warning(f"Failed to export {len(spans)} span(s): {e}")
+
+
+class TracingMiddleware:
+    """Runs every HTTP request in a server span, continuing the caller's trace"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not tracer.enabled:
+            await self.app(scope, receive, send)
+            return
+        incoming = None
+        for name, value in scope["headers"]:
+            if name == TRACEPARENT_HEADER.encode():
+                incoming = value.decode("latin-1")
+        method = scope["method"]
+        status: Optional[int] = None
+
+        async def send_with_status(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        with tracer.span(method, kind=SERVER, parent=parse_traceparent(incoming), root=True) as span:
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                # Named once the router has matched the route
+                span.name = f"{method} {route_template(scope)}"
+                span.set_attribute("http.request.method", method)
+                span.set_attribute("http.route", route_template(scope))
+                span.set_attribute("http.response.status_code", status or 500)
+                span.set_attribute("request_id", current_request_id())
+                if (status or 500) >= 500:
+                    span.error = span.error or f"HTTP {status or 500}"
+
+
+# Global tracer, started and stopped by the app lifespan
+tracer = Tracer()
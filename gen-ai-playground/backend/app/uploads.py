@@ -0,0 +1,164 @@
+"""
+Reading image uploads from request bodies as they stream in
+
+/images/edit-image accepts either JSON with a base64 image or
+multipart/form-data with the image as a binary file part. Both are read
+from the request stream in chunks and rejected with 413 as soon as they
+grow past EDIT_IMAGE_MAX_BYTES, before the rest of the body is received.
+The multipart reader keeps the file part in one buffer and never spools
+it to disk.
+"""
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
+from python_multipart.exceptions import FormParserError
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+from app.config import settings
+
+# Room for the prompt, the other fields and the multipart framing
+FORM_OVERHEAD_BYTES = 64 * 1024
+MAX_FORM_FIELDS = 16
+
+
+def is_multipart(request: Request) -> bool:
+    return request.headers.get("content-type", "").startswith("multipart/form-data")
+
+
+def payload_too_large(limit: int) -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"Upload exceeds the limit of {limit // (1024 * 1024)} MB"
+    )
+
+
+async def limited_stream(request: Request, limit: int) -> AsyncIterator[bytes]:
+    """
+    Yield the request body, failing with 413 once more than limit bytes arrived
+
+    A Content-Length above the limit is rejected before anything is read.
+    """
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > limit:
+        raise payload_too_large(limit)
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > limit:
+            raise payload_too_large(limit)
+        yield chunk
+
+
+def validate(model: type, data) -> BaseModel:
+    """Validate into model, answering 422 the way FastAPI does for declared bodies"""
+    try:
+        if isinstance(data, (bytes, bytearray)):
+            return model.model_validate_json(data)
+        return model.model_validate(data)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors(include_url=False))
+
+
+async def read_json(request: Request, model: type) -> BaseModel:
+    """Read a JSON body with a base64 image, at most 4/3 of the image limit"""
+    limit = settings.EDIT_IMAGE_MAX_BYTES * 4 // 3 + FORM_OVERHEAD_BYTES
+    body = bytearray()
+    async for chunk in limited_stream(request, limit):
+        body += chunk
+    return validate(model, body)
+
+
+class _FormReader:
+    """Collects the parts of a multipart body, the file part in a single buffer"""
+
+    def __init__(self, file_field: str):
+        self.file_field = file_field
+        self.fields: Dict[str, str] = {}
+        self.file: Optional[bytearray] = None
+        self._headers: Dict[bytes, bytes] = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._name: Optional[str] = None
+        self._is_file = False
+        self._data = bytearray()
+
+    def callbacks(self) -> dict:
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end
+        }
+
+    def on_part_begin(self):
+        if len(self.fields) + (self.file is not None) >= MAX_FORM_FIELDS:
+            raise HTTPException(status_code=400, detail="Too many form fields")
+        self._headers = {}
+        self._data = bytearray()
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._name = options.get(b"name", b"").decode("utf-8", "replace")
+        self._is_file = self._name == self.file_field
+        if self._is_file and self.file is not None:
+            raise HTTPException(status_code=400, detail=f"More than one {self.file_field} part")
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        limit = settings.EDIT_IMAGE_MAX_BYTES if self._is_file else FORM_OVERHEAD_BYTES
+        if len(self._data) + end - start > limit:
+            raise payload_too_large(settings.EDIT_IMAGE_MAX_BYTES)
+        self._data += data[start:end]
+
+    def on_part_end(self):
+        if self._is_file:
+            self.file = self._data
+        elif self._name and self._data:
+            # Empty fields count as not sent, like omitted optional JSON keys
+            self.fields[self._name] = self._data.decode("utf-8", "replace")
+        self._data = bytearray()
+
+
+async def read_form(request: Request, file_field: str = "image") -> Tuple[Dict[str, str], Optional[bytes]]:
+    """
+    Read a multipart/form-data body as it streams in
+
+    Args:
+        request: the incoming request
+        file_field: name of the part holding the image
+
+    Returns:
+        Tuple[Dict[str, str], Optional[bytes]]: the text fields and the image, None if absent
+
+    Raises:
+        HTTPException: 413 past EDIT_IMAGE_MAX_BYTES, 400 for malformed bodies
+    """
+    _, options = parse_options_header(request.headers.get("content-type", ""))
+    boundary = options.get(b"boundary")
+    if not boundary:
+        raise HTTPException(status_code=400, detail="Missing multipart boundary")
+    reader = _FormReader(file_field)
+    parser = MultipartParser(boundary, reader.callbacks())
+    limit = settings.EDIT_IMAGE_MAX_BYTES + FORM_OVERHEAD_BYTES
+    try:
+        async for chunk in limited_stream(request, limit):
+            parser.write(chunk)
+        parser.finalize()
+    except FormParserError:
+        raise HTTPException(status_code=400, detail="Invalid multipart body")
+    return reader.fields, bytes(reader.file) if reader.file is not None else None
@@ -0,0 +1,97 @@
+"""
+Pooled asynchronous HTTP client for the Verda inference API
+"""
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+import httpx
+
+from app.config import settings
+
+
+def http2_available() -> bool:
+    """Check whether the optional h2 package needed for HTTP/2 is installed"""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class UpstreamClient:
+    """
+    Keeps one keep-alive connection pool per upstream host.
+
+    The clients are created when the application starts and closed when it
+    shuts down. A client for a host that was not known at startup is created
+    lazily on first use.
+    """
+
+    def __init__(self, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._transport = transport
+
+    def _build_client(self) -> httpx.AsyncClient:
+        """Create a client configured from settings"""
+        limits = httpx.Limits(
+            max_connections=settings.UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.UPSTREAM_KEEPALIVE_EXPIRY
+        )
+        timeout = httpx.Timeout(
+            connect=settings.UPSTREAM_CONNECT_TIMEOUT,
+            read=settings.UPSTREAM_READ_TIMEOUT,
+            write=settings.UPSTREAM_WRITE_TIMEOUT,
+            pool=settings.UPSTREAM_POOL_TIMEOUT
+        )
+        return httpx.AsyncClient(
+            limits=limits,
+            timeout=timeout,
+            http2=settings.UPSTREAM_HTTP2 and http2_available(),
+            transport=self._transport
+        )
+
+    @staticmethod
+    def _host_key(url: str) -> str:
+        """Pools are shared by every URL on the same scheme and host"""
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def client_for(self, url: str) -> httpx.AsyncClient:
+        """Return the pooled client for the host of the given URL"""
+        key = self._host_key(url)
+        client = self._clients.get(key)
+        if client is None or client.is_closed:
+            client = self._build_client()
+            self._clients[key] = client
+        return client
+
+    async def start(self):
+        """Open a pool for every host in settings.MODEL_URLS"""
+        for url in settings.MODEL_URLS.values():
+            self.client_for(url)
+
+    async def close(self):
+        """Close every pool"""
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.aclose()
+
+    async def post(self, url: str, stream: bool = False, **kwargs) -> httpx.Response:
+        """
+        Send a POST request through the pool of the URL's host
+
+        With stream=True only the headers have been received when the
+        response is returned; the caller reads the body with aiter_bytes()
+        and must aclose() the response.
+        """
+        client = self.client_for(url)
+        if not stream:
+            return await client.post(url, **kwargs)
+        timeout = kwargs.pop("timeout", httpx.USE_CLIENT_DEFAULT)
+        request = client.build_request("POST", url, timeout=timeout, **kwargs)
+        return await client.send(request, stream=True)
+
+
+# Global upstream client instance, opened and closed by the app lifespan
+upstream_client = UpstreamClient()
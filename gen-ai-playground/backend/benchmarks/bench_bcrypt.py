@@ -0,0 +1,55 @@
+"""
+Benchmark of login throughput at different bcrypt costs
+
+Runs concurrent password checks through the same bounded thread pool the
+login route uses and reports logins per second for each cost factor.
+
+    $ python -m benchmarks.bench_bcrypt --costs 10 11 12 13 --logins 40
+"""
+import argparse
+import asyncio
+import time
+
+from app.config import settings
+from app.passwords import PasswordHasher, hash_password
+
+PASSWORD = "correct horse battery staple"
+
+
+async def run_logins(hasher: PasswordHasher, hashed: bytes, logins: int, concurrency: int) -> float:
+    """Check the password logins times, concurrency at a time, and return the elapsed seconds"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def login():
+        async with semaphore:
+            assert await hasher.verify(PASSWORD, hashed)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[login() for _ in range(logins)])
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure logins per second at each bcrypt cost")
+    parser.add_argument("--costs", type=int, nargs="+", default=[10, 11, 12, 13])
+    parser.add_argument("--logins", type=int, default=40, help="logins per cost")
+    parser.add_argument("--concurrency", type=int, default=32, help="logins in flight at once")
+    parser.add_argument("--workers", type=int, default=settings.PASSWORD_HASH_WORKERS,
+                        help="size of the bcrypt thread pool")
+    args = parser.parse_args()
+
+    settings.PASSWORD_HASH_WORKERS = args.workers
+    settings.PASSWORD_HASH_QUEUE_SIZE = args.concurrency
+
+    print(f"{args.workers} bcrypt worker(s), {args.concurrency} concurrent logins")
+    print(f"{'cost':>4}  {'logins/s':>9}  {'ms/login':>9}")
+    for cost in args.costs:
+        hasher = PasswordHasher()
+        hashed = hash_password(PASSWORD, cost)
+        elapsed = asyncio.run(run_logins(hasher, hashed, args.logins, args.concurrency))
+        hasher.stop()
+        print(f"{cost:>4}  {args.logins / elapsed:>9.1f}  {elapsed * 1000 / args.logins:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Benchmark of peak memory per generation request, before and after streaming
+
+Streams a fake model response holding a base64 image of each size through
+httpx and turns it into image bytes two ways: the previous pipeline
+(resp.json(), pick the string, strip the data URL prefix, b64decode) and
+the streaming decoder request_image uses now. Each measurement runs in a
+fresh process and reports how far the peak RSS rose above the baseline,
+plus the peak of Python allocations seen by tracemalloc.
+
+    $ python -m benchmarks.bench_image_memory --sizes 2 8 32
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import resource
+import subprocess
+import sys
+import tracemalloc
+
+import httpx
+
+from app.image_stream import ImageFieldDecoder, image_path
+
+MODEL = "FLUX1_KREA_DEV"
+CHUNK_SIZE = 64 * 1024
+PIPELINES = ("before", "after")
+
+
+class FakeModelBody(httpx.AsyncByteStream):
+    """
+    A COMPLETED model response with a random image of image_size bytes
+
+    The body is produced chunk by chunk as a socket would deliver it, so no
+    copy of it exists before the pipeline under test reads it.
+    """
+
+    def __init__(self, image_size: int):
+        self.image_size = image_size
+
+    async def __aiter__(self):
+        yield b'{"status": "COMPLETED", "output": {"outputs": ["data:image/png;base64,'
+        remaining = self.image_size
+        while remaining:
+            # Multiples of 3 bytes encode without padding in the middle of the string
+            raw = os.urandom(min(remaining, CHUNK_SIZE // 4 * 3))
+            remaining -= len(raw)
+            yield base64.b64encode(raw)
+        yield b'"]}}'
+
+
+def client_for(image_size: int) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.MockTransport(
+        lambda request: httpx.Response(200, stream=FakeModelBody(image_size))
+    ))
+
+
+async def before(image_size: int) -> int:
+    """The previous pipeline: whole body, parsed JSON, base64 string, then the image"""
+    async with client_for(image_size) as client:
+        resp = await client.post("https://model.test/runsync", json={"prompt": "a cat"})
+        image_base64 = resp.json()["output"]["outputs"][0]
+        if "," in image_base64:
+            image_base64 = image_base64.split(",", 1)[1]
+        image_bytes = base64.b64decode(image_base64)
+    return len(image_bytes)
+
+
+async def after(image_size: int) -> int:
+    """The streaming pipeline: only the decoded image is kept"""
+    async with client_for(image_size) as client:
+        request = client.build_request("POST", "https://model.test/runsync", json={"prompt": "a cat"})
+        resp = await client.send(request, stream=True)
+        try:
+            decoder = ImageFieldDecoder(image_path(MODEL), fields=[("status",)])
+            async for chunk in resp.aiter_bytes():
+                decoder.feed(chunk)
+        finally:
+            await resp.aclose()
+        image_bytes = decoder.image()
+    return len(image_bytes)
+
+
+def max_rss_mb() -> float:
+    """Peak resident set size of this process so far (ru_maxrss is KiB on Linux)"""
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / (1024 * 1024)
+
+
+def measure(pipeline: str, image_mb: int):
+    """Run one request of one pipeline in this process and print the measurement as JSON"""
+    run = before if pipeline == "before" else after
+    # Warm up imports and the event loop so they are part of the baseline
+    asyncio.run(run(1024))
+    baseline = max_rss_mb()
+    tracemalloc.start()
+    size = asyncio.run(run(image_mb * 1024 * 1024))
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(json.dumps({
+        "image_bytes": size,
+        "rss_mb": max_rss_mb() - baseline,
+        "traced_mb": traced_peak / (1024 * 1024)
+    }))
+
+
+def measure_in_subprocess(pipeline: str, image_mb: int) -> dict:
+    """Peak RSS can only grow, so every measurement gets a fresh interpreter"""
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_image_memory",
+         "--child", pipeline, "--sizes", str(image_mb)],
+        check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure peak memory per generation request")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2, 8, 32],
+                        help="decoded image sizes in MiB")
+    parser.add_argument("--child", choices=PIPELINES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        measure(args.child, args.sizes[0])
+        return
+
+    print(f"{'image':>8} {'pipeline':>9} {'peak RSS':>10} {'traced':>10} {'x image':>8}")
+    for image_mb in args.sizes:
+        for pipeline in PIPELINES:
+            result = measure_in_subprocess(pipeline, image_mb)
+            print(f"{image_mb:>6}MB {pipeline:>9} {result['rss_mb']:>8.1f}MB "
+                  f"{result['traced_mb']:>8.1f}MB {result['traced_mb'] / image_mb:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
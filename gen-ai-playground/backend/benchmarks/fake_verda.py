@@ -0,0 +1,140 @@
+"""
+Fake Verda inference API for load tests
+
+Answers on the paths of settings.MODEL_URLS with the response shape the
+backend expects of each model: {"image": ...} for the FLUX2_KLEIN models and
+{"status": "COMPLETED", "output": {"outputs": [...]}} for the FLUX1 models.
+Every answer waits for a latency drawn from a distribution, carries a PNG
+of about the configured size that is unique per response (so blob
+deduplication does not flatter the backend), and fails with error_status at
+the configured rate.
+
+Latencies are given as "fixed:MS", "uniform:LOW_MS:HIGH_MS" or
+"lognormal:MEDIAN_MS:SIGMA", for all models or per model:
+
+    $ python -m benchmarks.fake_verda --port 8100 --latency lognormal:800:0.5 \\
+        --model-latency FLUX1_KREA_DEV=lognormal:4000:0.3 --image-kb 1500 --error-rate 0.01
+
+The backend is pointed at it with VERDA_BASE_URL=http://127.0.0.1:8100.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import itertools
+import json
+import random
+import struct
+import zlib
+from dataclasses import dataclass, field
+from typing import Callable, Dict
+from urllib.parse import urlsplit
+
+import uvicorn
+from PIL import Image
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+from app.config import settings
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """A function drawing latencies in seconds from a "kind:params" spec"""
+    kind, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(":")] if params else []
+    if kind == "fixed" and len(values) == 1:
+        return lambda: values[0] / 1000
+    if kind == "uniform" and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1]) / 1000
+    if kind == "lognormal" and len(values) == 2:
+        median, sigma = values
+        return lambda: median * random.lognormvariate(0, sigma) / 1000
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def make_png(size: int) -> bytes:
+    """A PNG of noise of about size bytes, noise being what compresses worst"""
+    side = max(1, int((size / 3) ** 0.5))
+    image = Image.frombytes("RGB", (side, side), random.randbytes(side * side * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def unique_png(png: bytes, counter: int) -> bytes:
+    """The PNG with a text chunk holding the counter inserted before IEND"""
+    data = b"fake-verda\x00" + str(counter).encode()
+    chunk = struct.pack(">I", len(data)) + b"tEXt" + data + struct.pack(">I", zlib.crc32(b"tEXt" + data))
+    # IEND is the last 12 bytes: length, type and CRC
+    return png[:-12] + chunk + png[-12:]
+
+
+@dataclass
+class FakeVerdaConfig:
+    """How the fake answers: latency specs, image size and failures"""
+    latency: str = "lognormal:800:0.5"
+    model_latency: Dict[str, str] = field(default_factory=dict)
+    image_bytes: int = 1024 * 1024
+    error_rate: float = 0.0
+    error_status: int = 500
+
+
+def create_app(config: FakeVerdaConfig) -> Starlette:
+    """The fake API as an ASGI app"""
+    png = make_png(config.image_bytes)
+    counter = itertools.count()
+    default_latency = parse_latency(config.latency)
+    latencies = {model: parse_latency(spec) for model, spec in config.model_latency.items()}
+    models = {urlsplit(url).path: model for model, url in settings.MODEL_URLS.items()}
+
+    async def predict(request: Request) -> Response:
+        model = models.get(request.url.path)
+        if model is None:
+            return PlainTextResponse("Not found", status_code=404)
+        if not request.headers.get("authorization", "").startswith("Bearer "):
+            return PlainTextResponse("Unauthorized", status_code=401)
+        body = await request.json()
+        prompt = body.get("prompt") if "KLEIN" in model else body.get("input", {}).get("prompt")
+        if not prompt:
+            return PlainTextResponse("prompt is required", status_code=400)
+
+        await asyncio.sleep(latencies.get(model, default_latency)())
+        if random.random() < config.error_rate:
+            return PlainTextResponse("Simulated upstream failure", status_code=config.error_status)
+        image = base64.b64encode(unique_png(png, next(counter))).decode("ascii")
+        if "KLEIN" in model:
+            return JSONResponse({"image": image})
+        return JSONResponse({"status": "COMPLETED", "output": {"outputs": [image]}})
+
+    paths = sorted(models)
+    return Starlette(routes=[Route(path, predict, methods=["POST"]) for path in paths])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake Verda inference API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", default="lognormal:800:0.5",
+                        help="fixed:MS, uniform:LOW_MS:HIGH_MS or lognormal:MEDIAN_MS:SIGMA")
+    parser.add_argument("--model-latency", nargs="*", default=[], metavar="MODEL=SPEC",
+                        help="latency of single models")
+    parser.add_argument("--image-kb", type=int, default=1024, help="approximate size of the returned PNG")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls that fail")
+    parser.add_argument("--error-status", type=int, default=500)
+    args = parser.parse_args()
+
+    config = FakeVerdaConfig(
+        latency=args.latency,
+        model_latency=dict(item.split("=", 1) for item in args.model_latency),
+        image_bytes=args.image_kb * 1024,
+        error_rate=args.error_rate,
+        error_status=args.error_status
+    )
+    print(json.dumps({"fake_verda": f"http://{args.host}:{args.port}", "models": list(settings.MODEL_URLS)}))
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+"""
+End-to-end load test of the backend against a fake Verda API
+
+Starts benchmarks.fake_verda and the backend (uvicorn server:app, one
+process) on free local ports, registers a few users and then drives
+concurrent generate, edit, history and login traffic for a while. It
+reports the throughput, error rate and p50/p95/p99 latency of each kind of
+request and the peak RSS of the backend process, and checks them against
+regression thresholds:
+
+    $ MONGO_DB_URL=mongodb://localhost:27017 python -m benchmarks.load_test \\
+        --duration 60 --concurrency 32 --check benchmarks/load_thresholds.json --output load.json
+
+The backend uses a database of its own (--db-name, by default a new
+gen_ai_playground_load_<random> one). The run refuses to start on a database
+that already exists and drops the one it created afterwards unless
+--keep-data is given; MONGO_DB_NAME is ignored. Any other setting, e.g. BCRYPT_ROUNDS or UPSTREAM_MODEL_CONCURRENCY,
+is passed on from the environment. --base-url tests a backend that is
+already running instead; its peak RSS is then not measured.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from pymongo import MongoClient
+
+from benchmarks.fake_verda import make_png
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MIX = "generate=40,edit=10,history=40,login=10"
+LOAD_DB_PREFIX = "gen_ai_playground_load_"
+GENERATE_MODELS = ["FLUX2_KLEIN_4B", "FLUX1_KREA_DEV"]
+EDIT_MODELS = ["FLUX1_KONTEXT_DEV", "FLUX2_KLEIN_4B"]
+PASSWORD = "load-test-password"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_process(args: List[str], env: dict, log_dir: str, name: str) -> subprocess.Popen:
+    """Start a server process, its output going to a log file"""
+    log = open(os.path.join(log_dir, f"{name}.log"), "w")
+    return subprocess.Popen(args, cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_ready(url: str, process: Optional[subprocess.Popen], timeout: float = 60):
+    """Poll url until it answers, failing early when the process exits"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"{url} exited with {process.returncode} before answering")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not answer within {timeout:.0f}s")
+
+
+def peak_rss_mb(pid: int) -> Optional[float]:
+    """Peak resident set size of a running process, from /proc on Linux"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name not in ("generate", "edit", "history", "login"):
+            raise ValueError(f"Unknown request kind: {name}")
+        weights[name] = float(weight)
+    return weights
+
+
+def percentile(values: List[float], share: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    return values[min(len(values) - 1, int(share * len(values)))] if values else 0.0
+
+
+class LoadTest:
+    """Drives the request mix against a backend and records every request"""
+
+    def __init__(self, base_url: str, invitation_code: str, users: int, mix: Dict[str, float],
+                 edit_image_kb: int):
+        self.base_url = base_url
+        self.invitation_code = invitation_code
+        self.usernames = [f"load-{uuid.uuid4().hex[:8]}-{index}" for index in range(users)]
+        self.tokens: Dict[str, str] = {}
+        self.kinds = list(mix)
+        self.weights = list(mix.values())
+        self.edit_image = make_png(edit_image_kb * 1024)
+        # kind -> (latency in seconds, status) of each request
+        self.samples: Dict[str, List[Tuple[float, int]]] = defaultdict(list)
+        self.recording = False
+
+    async def setup(self, client: httpx.AsyncClient):
+        """Register and log in the users"""
+        for username in self.usernames:
+            response = await client.post("/register", json={
+                "username": username, "password": PASSWORD, "invitation_code": self.invitation_code
+            })
+            response.raise_for_status()
+            response = await client.post("/login", json={"username": username, "password": PASSWORD})
+            response.raise_for_status()
+            self.tokens[username] = response.json()["token"]
+
+    async def request(self, client: httpx.AsyncClient, kind: str) -> int:
+        username = random.choice(self.usernames)
+        headers = {"Authorization": f"Bearer {self.tokens[username]}"}
+        prompt = f"load test {uuid.uuid4().hex[:12]}"
+        if kind == "generate":
+            response = await client.post("/images/generate", headers=headers,
+                                         json={"prompt": prompt, "model": random.choice(GENERATE_MODELS)})
+        elif kind == "edit":
+            response = await client.post(
+                "/images/edit-image", headers=headers,
+                data={"prompt": prompt, "model": random.choice(EDIT_MODELS)},
+                files={"image": ("input.png", io.BytesIO(self.edit_image), "image/png")}
+            )
+        elif kind == "history":
+            response = await client.get("/images/history", headers=headers)
+        else:
+            response = await client.post("/login", json={"username": username, "password": PASSWORD})
+        return response.status_code
+
+    async def worker(self, client: httpx.AsyncClient, stop_at: float):
+        while time.monotonic() < stop_at:
+            kind = random.choices(self.kinds, self.weights)[0]
+            started = time.perf_counter()
+            try:
+                status = await self.request(client, kind)
+            except httpx.HTTPError:
+                status = 0  # no answer
+            if self.recording:
+                self.samples[kind].append((time.perf_counter() - started, status))
+
+    async def run(self, concurrency: int, warmup: float, duration: float) -> float:
+        """Run the workers, recording after the warmup; returns the seconds recorded"""
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(base_url=self.base_url, limits=limits, timeout=300) as client:
+            await self.setup(client)
+            stop_at = time.monotonic() + warmup + duration
+            workers = [asyncio.create_task(self.worker(client, stop_at)) for _ in range(concurrency)]
+            await asyncio.sleep(warmup)
+            self.recording = True
+            recording_started = time.monotonic()
+            await asyncio.gather(*workers)
+            return time.monotonic() - recording_started
+
+    def report(self, elapsed: float) -> Dict[str, dict]:
+        """Throughput, error rate and latency percentiles per kind and over all"""
+        stats = {}
+        everything = []
+        for kind in self.kinds + ["all"]:
+            samples = everything if kind == "all" else self.samples[kind]
+            if kind != "all":
+                everything.extend(samples)
+            latencies = sorted(latency * 1000 for latency, _ in samples)
+            statuses: Dict[str, int] = defaultdict(int)
+            for _, status in samples:
+                statuses[str(status)] += 1
+            errors = sum(1 for _, status in samples if not 200 <= status < 300)
+            stats[kind] = {
+                "requests": len(samples),
+                "rps": round(len(samples) / elapsed, 2),
+                "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+                "p50_ms": round(percentile(latencies, 0.5), 1),
+                "p95_ms": round(percentile(latencies, 0.95), 1),
+                "p99_ms": round(percentile(latencies, 0.99), 1),
+                "statuses": dict(statuses)
+            }
+        return stats
+
+
+def check_thresholds(result: dict, thresholds: dict) -> List[str]:
+    """Descriptions of the thresholds the result breaks"""
+    failures = []
+    for kind, limits in thresholds.get("requests", {}).items():
+        stats = result["requests"].get(kind)
+        if stats is None:
+            continue
+        for key, limit in limits.items():
+            measure, _, bound = key.rpartition("_")
+            value = stats[measure]
+            if (bound == "max" and value > limit) or (bound == "min" and value < limit):
+                failures.append(f"{kind} {measure} {value} is beyond the {bound} of {limit}")
+    max_rss = thresholds.get("peak_rss_mb_max")
+    if max_rss is not None and result["peak_rss_mb"] is not None and result["peak_rss_mb"] > max_rss:
+        failures.append(f"peak RSS {result['peak_rss_mb']} MB is beyond the max of {max_rss} MB")
+    return failures
+
+
+def print_report(result: dict):
+    print(f"{'kind':<10}  {'requests':>8}  {'req/s':>7}  {'errors':>7}  "
+          f"{'p50 ms':>8}  {'p95 ms':>8}  {'p99 ms':>8}")
+    for kind, stats in result["requests"].items():
+        print(f"{kind:<10}  {stats['requests']:>8}  {stats['rps']:>7.1f}  {stats['error_rate']:>7.2%}  "
+              f"{stats['p50_ms']:>8.1f}  {stats['p95_ms']:>8.1f}  {stats['p99_ms']:>8.1f}")
+    if result["peak_rss_mb"] is not None:
+        print(f"peak RSS of the backend: {result['peak_rss_mb']:.0f} MB")
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the backend against a fake Verda API")
+    parser.add_argument("--duration", type=float, default=60, help="seconds recorded")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds run before recording")
+    parser.add_argument("--concurrency", type=int, default=32, help="requests in flight at once")
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weights of generate, edit, history and login")
+    parser.add_argument("--edit-image-kb", type=int, default=512, help="size of the image uploaded to edit")
+    parser.add_argument("--latency", default="lognormal:800:0.5", help="latency of the fake Verda API")
+    parser.add_argument("--model-latency", nargs="*", default=[], metavar="MODEL=SPEC")
+    parser.add_argument("--image-kb", type=int, default=1024, help="size of the images the fake returns")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of fake Verda calls that fail")
+    parser.add_argument("--base-url", help="test this running backend instead of starting one")
+    parser.add_argument("--check", metavar="THRESHOLDS", help="JSON file of regression thresholds")
+    parser.add_argument("--output", help="write the result as JSON, to compare runs over time")
+    parser.add_argument("--db-name", default=f"{LOAD_DB_PREFIX}{uuid.uuid4().hex[:12]}",
+                        help="database the backend creates, which must not exist yet")
+    parser.add_argument("--keep-data", action="store_true", help="keep the load test database")
+    args = parser.parse_args()
+
+    invitation_code = os.getenv("INVITATION_CODE") or uuid.uuid4().hex
+    mongo_url = os.getenv("MONGO_DB_URL")
+    created_db: Optional[str] = None
+    processes: List[subprocess.Popen] = []
+    backend: Optional[subprocess.Popen] = None
+    log_dir = tempfile.mkdtemp(prefix="load-test-")
+    base_url = args.base_url
+    try:
+        if base_url is None:
+            if not mongo_url:
+                parser.error("MONGO_DB_URL must point at a MongoDB the backend can use")
+            if args.db_name in MongoClient(mongo_url).list_database_names():
+                parser.error(f"database {args.db_name} already exists; the load test only uses a new one")
+            created_db = args.db_name
+            verda_port, backend_port = free_port(), free_port()
+            processes.append(start_process([
+                sys.executable, "-m", "benchmarks.fake_verda", "--port", str(verda_port),
+                "--latency", args.latency, "--image-kb", str(args.image_kb),
+                "--error-rate", str(args.error_rate), "--model-latency", *args.model_latency
+            ], dict(os.environ), log_dir, "fake_verda"))
+            env = dict(os.environ,
+                       MONGO_DB_URL=mongo_url,
+                       MONGO_DB_NAME=args.db_name,
+                       VERDA_BASE_URL=f"http://127.0.0.1:{verda_port}",
+                       VERDA_API_KEY="load-test",
+                       INVITATION_CODE=invitation_code)
+            env.setdefault("JWT_SECRET_KEY", uuid.uuid4().hex)
+            env.setdefault("ALLOWED_ORIGINS", "http://localhost")
+            env.setdefault("LOG_LEVEL", "WARNING")
+            backend = start_process([
+                sys.executable, "-m", "uvicorn", "server:app",
+                "--host", "127.0.0.1", "--port", str(backend_port), "--log-level", "warning"
+            ], env, log_dir, "backend")
+            processes.append(backend)
+            base_url = f"http://127.0.0.1:{backend_port}"
+            wait_ready(f"http://127.0.0.1:{verda_port}/", processes[0])
+            wait_ready(f"{base_url}/", backend)
+        print(f"Load testing {base_url} for {args.duration:.0f}s with {args.concurrency} concurrent requests "
+              f"(server logs in {log_dir})")
+
+        load = LoadTest(base_url, invitation_code, args.users, parse_mix(args.mix), args.edit_image_kb)
+        elapsed = asyncio.run(load.run(args.concurrency, args.warmup, args.duration))
+        peak_rss = peak_rss_mb(backend.pid) if backend else None
+        result = {
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "config": {key: value for key, value in vars(args).items() if key not in ("check", "output")},
+            "requests": load.report(elapsed),
+            "peak_rss_mb": round(peak_rss, 1) if peak_rss is not None else None
+        }
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait(timeout=30)
+        if created_db is not None and not args.keep_data:
+            MongoClient(mongo_url).drop_database(created_db)
+
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+    if args.check:
+        with open(args.check) as thresholds:
+            failures = check_thresholds(result, json.load(thresholds))
+        for failure in failures:
+            print(f"REGRESSION: {failure}")
+        if failures:
+            sys.exit(1)
+        print("All thresholds met")
+
+
+if __name__ == "__main__":
+    main()
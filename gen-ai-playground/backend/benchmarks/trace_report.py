@@ -0,0 +1,92 @@
+"""
+Latency report of exported traces, and a stand-in OTLP collector
+
+Reads the OTLP/JSON lines the backend writes with TRACE_EXPORTER=file and
+prints the count and the 50th, 95th and 99th percentile duration of each
+span name, so the slowest phase under load is visible at a glance:
+
+    $ python -m benchmarks.trace_report traces.jsonl
+
+With --listen it instead accepts OTLP/HTTP JSON exports, as the backend
+sends them with TRACE_EXPORTER=otlp, appends them to the file and prints
+the report on Ctrl+C:
+
+    $ python -m benchmarks.trace_report traces.jsonl --listen 4318
+"""
+import argparse
+import json
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, List
+
+
+def span_durations(lines: Iterable[str]) -> Dict[str, List[float]]:
+    """Durations in milliseconds of the spans in OTLP/JSON lines, by span name"""
+    durations: Dict[str, List[float]] = defaultdict(list)
+    for line in lines:
+        if not line.strip():
+            continue
+        for resource in json.loads(line).get("resourceSpans", []):
+            for scope in resource.get("scopeSpans", []):
+                for span in scope.get("spans", []):
+                    elapsed = int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])
+                    durations[span["name"]].append(elapsed / 1e6)
+    return durations
+
+
+def percentile(values: List[float], share: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def print_report(path: str):
+    with open(path, encoding="utf-8") as trace_file:
+        durations = span_durations(trace_file)
+    print(f"{'span':<32}  {'count':>6}  {'p50 ms':>8}  {'p95 ms':>8}  {'p99 ms':>8}")
+    for name, values in sorted(durations.items(), key=lambda item: -percentile(sorted(item[1]), 0.99)):
+        values.sort()
+        print(f"{name:<32}  {len(values):>6}  {percentile(values, 0.5):>8.1f}  "
+              f"{percentile(values, 0.95):>8.1f}  {percentile(values, 0.99):>8.1f}")
+
+
+def listen(path: str, port: int):
+    """Append every OTLP/JSON export POSTed to /v1/traces to the file"""
+    class Collector(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path != "/v1/traces":
+                self.send_response(404)
+            else:
+                with open(path, "a", encoding="utf-8") as trace_file:
+                    trace_file.write(json.dumps(json.loads(body)) + "\n")
+                self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Collector)
+    print(f"Collecting OTLP/JSON traces on http://localhost:{port}/v1/traces into {path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report span latencies of exported traces")
+    parser.add_argument("file", help="OTLP/JSON lines written by the backend")
+    parser.add_argument("--listen", type=int, metavar="PORT",
+                        help="collect OTLP/HTTP exports into the file first, report on Ctrl+C")
+    args = parser.parse_args()
+
+    if args.listen:
+        listen(args.file, args.listen)
+    print_report(args.file)
+
+
+if __name__ == "__main__":
+    main()
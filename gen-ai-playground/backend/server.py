@@ -4,18 +4,60 @@ Gen AI Playground Backend Server
 FastAPI server for generating images using Verda API.
 Refactored with proper separation of concerns.
 """
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 
 from app.config import settings
+from app.database import db_manager
+from app.jobs import job_manager
+from app.logs import RequestLogMiddleware, structured_logging
+from app.admission import admission
+from app.batch import batch_runner
+from app.metrics import registry
+from app.passwords import password_hasher
+from app.persistence import history_writer
+from app.request_metrics import RequestMetricsMiddleware
+from app.resilience import upstream_policy
+from app.routing import model_router
 from app.routers import auth, images
+from app.thumbnails import thumbnail_pipeline
+from app.tracing import TracingMiddleware, tracer
+from app.variants import transcoder
+from app.upstream import upstream_client
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open shared resources on startup and release them on shutdown"""
+    structured_logging.start()
+    tracer.start()
+    await db_manager.connect()
+    await upstream_client.start()
+    await history_writer.start()
+    await job_manager.start(images.run_generation_job, db_manager.get_db())
+    yield
+    await job_manager.stop()
+    await batch_runner.stop()
+    # Images still waiting to be saved are written before the database closes
+    await history_writer.stop()
+    await upstream_client.close()
+    await thumbnail_pipeline.stop()
+    transcoder.stop()
+    password_hasher.stop()
+    db_manager.close()
+    tracer.stop()
+    # Last, so everything logged during shutdown is written
+    structured_logging.stop()
 
 
 # Initialize FastAPI app
 app = FastAPI(
     title="Gen AI Playground API",
     description="Image generation API using Verda AI models",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Configure CORS
@@ -26,6 +68,10 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Added last so they run first: the request ID and timings cover everything the app does
+app.add_middleware(TracingMiddleware)
+app.add_middleware(RequestMetricsMiddleware)
+app.add_middleware(RequestLogMiddleware)
 
 # Register routers
 app.include_router(auth.router)
@@ -33,11 +79,29 @@ app.include_router(images.router)
 
 
 @app.get("/")
-def read_root():
+async def read_root():
     """Health check endpoint"""
     return {"message": "Gen AI Playground Backend API", "status": "running"}
 
 
+@app.get("/upstream/status")
+async def upstream_status():
+    """Circuit breaker state, load and latency of every image model"""
+    models = upstream_policy.status()
+    for model, status in models.items():
+        gate = admission.gate(model)
+        status["in_flight"] = gate.active
+        status["waiting"] = gate.waiting
+        status.update(model_router.status(model))
+    return {"models": models, "families": settings.MODEL_FAMILIES}
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics():
+    """Metrics in the Prometheus text format"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
 
 
 
@@ -0,0 +1,137 @@
+"""
+Fixtures shared by the test modules
+
+mock_db is an in-memory MongoDB per test and async_db the same data through
+the async client the app uses. client is a TestClient authenticated as
+testuser on that database, with the Verda upstream replaced by
+upstream_handler; lifespan_client also runs the app lifespan. Modules
+override these fixtures where they need more, and single tests pick
+another handler with
+
+    @pytest.mark.parametrize("upstream_handler", [handler], indirect=True)
+"""
+import base64
+import pytest
+import httpx
+import mongomock
+import mongomock.gridfs
+from mongomock_motor import AsyncMongoMockClient, enabled_gridfs_integration
+from unittest.mock import AsyncMock, patch
+from fastapi.testclient import TestClient
+
+from server import app
+from app.admission import admission
+from app.database import get_database
+from app.dependencies import get_current_user
+from app.models import UserInfo
+from app.resilience import upstream_policy
+from app.result_cache import result_cache
+from app.upstream import UpstreamClient
+
+FAKE_IMAGE = b"\x89PNG\r\n\x1a\nfake image"
+
+mongomock.gridfs.enable_gridfs_integration()
+
+
+def image_response(image: bytes) -> httpx.Response:
+    """Fake Verda reply in the FLUX2_KLEIN shape"""
+    return httpx.Response(200, json={"image": base64.b64encode(image).decode("utf-8")})
+
+
+@pytest.fixture
+def mock_db():
+    """Create a mock MongoDB database for testing"""
+    client = mongomock.MongoClient()
+    return client["gen_ai_playground"]
+
+
+@pytest.fixture
+def async_db(mock_db):
+    """The mock database through the async client the app uses, GridFS included"""
+    with enabled_gridfs_integration():
+        yield AsyncMongoMockClient(mock_mongo_client=mock_db.client)["gen_ai_playground"]
+
+
+@pytest.fixture
+def overrides(mock_db, async_db):
+    """Bypass authentication as testuser, whose account exists, and use the mock database"""
+    mock_db.users.insert_one({"username": "testuser", "password": b"x"})
+    app.dependency_overrides[get_current_user] = lambda: UserInfo(username="testuser")
+    app.dependency_overrides[get_database] = lambda: async_db
+    yield
+    app.dependency_overrides.clear()
+
+
+@pytest.fixture
+def upstream_image():
+    """Image the default fake upstream answers with"""
+    return FAKE_IMAGE
+
+
+@pytest.fixture
+def upstream_requests():
+    """Requests the default fake upstream received"""
+    return []
+
+
+@pytest.fixture
+def upstream_handler(request, upstream_image, upstream_requests):
+    """Fake Verda model: the handler passed as parameter, or one answering with upstream_image"""
+    handler = getattr(request, "param", None)
+    if handler is not None:
+        return handler
+
+    def record_and_answer(request: httpx.Request) -> httpx.Response:
+        upstream_requests.append(request)
+        return image_response(upstream_image)
+
+    return record_and_answer
+
+
+@pytest.fixture
+def upstream_transport(upstream_handler):
+    """Transport the upstream client sends through"""
+    return httpx.MockTransport(upstream_handler)
+
+
+@pytest.fixture
+def result_cache_enabled():
+    """Whether seeded generations are served from the result cache"""
+    return False
+
+
+@pytest.fixture
+def fake_upstream(upstream_transport, result_cache_enabled):
+    """Route the image endpoints' upstream calls to the fake, with fresh upstream state"""
+    upstream = UpstreamClient(transport=upstream_transport)
+    upstream_policy.reset()
+    admission.reset()
+    result_cache.clear()
+    with patch("app.routers.images.upstream_client", upstream), \
+            patch("app.config.settings.VERDA_API_KEY", "test-api-key"), \
+            patch("app.config.settings.RESULT_CACHE_ENABLED", result_cache_enabled):
+        yield upstream
+    upstream_policy.reset()
+    admission.reset()
+    result_cache.clear()
+
+
+@pytest.fixture
+def client(overrides, fake_upstream):
+    """Test client authenticated as testuser, calling the fake upstream"""
+    return TestClient(app)
+
+
+@pytest.fixture
+def app_lifespan(async_db):
+    """Let the app lifespan start on the mock database instead of connecting to MONGO_DB_URL"""
+    with patch("app.database.db_manager.connect", AsyncMock()), \
+            patch("app.database.db_manager.get_db", return_value=async_db):
+        yield
+
+
+@pytest.fixture
+def lifespan_client(overrides, fake_upstream, app_lifespan):
+    """Like client, with the app lifespan running"""
+    with TestClient(app) as client:
+        yield client
@@ -0,0 +1,150 @@
+import asyncio
+import base64
+import json
+import pytest
+import httpx
+from unittest.mock import patch
+from fastapi import HTTPException
+
+from server import app
+from app.admission import AdmissionGate
+from app.metrics import Histogram
+
+
+class TestAdmissionGate:
+    """Tests for the per-model concurrency limit and wait queue"""
+
+    def test_limits_concurrent_calls(self):
+        gate = AdmissionGate("M", limit=2, queue_size=10, queue_timeout=5)
+        running = []
+        peak = []
+
+        async def call():
+            async with gate.slot():
+                running.append(1)
+                peak.append(len(running))
+                await asyncio.sleep(0.02)
+                running.pop()
+
+        async def run():
+            await asyncio.gather(*[call() for _ in range(6)])
+
+        asyncio.run(run())
+
+        assert max(peak) == 2
+        assert gate.active == 0
+        assert gate.waiting == 0
+
+    def test_full_queue_is_rejected_with_retry_after(self):
+        gate = AdmissionGate("M", limit=1, queue_size=1, queue_timeout=5)
+        gate.service_time = 10
+
+        async def hold():
+            async with gate.slot():
+                await asyncio.sleep(0.1)
+
+        async def run():
+            holder = asyncio.ensure_future(hold())
+            waiter = asyncio.ensure_future(hold())
+            await asyncio.sleep(0.01)
+            try:
+                await gate.acquire()
+            finally:
+                await asyncio.gather(holder, waiter)
+
+        with pytest.raises(HTTPException) as exc:
+            asyncio.run(run())
+
+        assert exc.value.status_code == 429
+        # One call waiting ahead on a single slot, each taking about 10 s
+        assert exc.value.headers["Retry-After"] == "20"
+
+    def test_wait_times_out(self):
+        gate = AdmissionGate("M", limit=1, queue_size=5, queue_timeout=0.02)
+
+        async def run():
+            await gate.acquire()
+            with pytest.raises(HTTPException) as exc:
+                await gate.acquire()
+            gate.release()
+            return exc.value
+
+        error = asyncio.run(run())
+
+        assert error.status_code == 429
+        assert gate.active == 0
+        assert gate.waiting == 0
+
+    def test_cancelled_waiter_does_not_leak_slot(self):
+        gate = AdmissionGate("M", limit=1, queue_size=5, queue_timeout=5)
+
+        async def run():
+            await gate.acquire()
+            waiter = asyncio.ensure_future(gate.acquire())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+            gate.release()
+            # The slot is free again without waiting
+            await asyncio.wait_for(gate.acquire(), 0.1)
+            gate.release()
+
+        asyncio.run(run())
+
+        assert gate.active == 0
+
+    def test_service_time_is_smoothed(self):
+        gate = AdmissionGate("M", limit=1, queue_size=1, queue_timeout=1)
+        gate.observe_service_time(10)
+        gate.observe_service_time(20)
+
+        assert gate.service_time == pytest.approx(12)
+
+
+async def slow_handler(request: httpx.Request) -> httpx.Response:
+    await asyncio.sleep(0.2)
+    body = json.loads(request.content)
+    image = base64.b64encode(body["prompt"].encode()).decode("utf-8")
+    return httpx.Response(200, json={"image": image})
+
+
+class TestAdmissionEndpoint:
+    """Tests for admission control in front of the upstream call"""
+
+    @pytest.mark.parametrize("upstream_handler", [slow_handler], indirect=True)
+    def test_overloaded_model_answers_429(self, overrides, fake_upstream):
+        async def run():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await asyncio.gather(*[
+                    client.post("/images/generate", json={"prompt": f"p{i}", "model": "FLUX2_KLEIN_4B"})
+                    for i in range(3)
+                ])
+
+        with patch("app.config.settings.UPSTREAM_MODEL_CONCURRENCY", 1), \
+                patch("app.config.settings.UPSTREAM_MODEL_QUEUE_SIZE", 1):
+            responses = asyncio.run(run())
+
+        statuses = sorted(r.status_code for r in responses)
+        assert statuses == [200, 200, 429]
+        rejected = next(r for r in responses if r.status_code == 429)
+        assert int(rejected.headers["retry-after"]) >= 1
+
+
+class TestHistogram:
+    """Tests for the histogram metric used for queue wait times"""
+
+    def test_renders_cumulative_buckets(self):
+        histogram = Histogram("wait_seconds", "Wait", ("model",), buckets=(0.1, 1))
+        histogram.observe(0.05, model="M")
+        histogram.observe(0.5, model="M")
+        histogram.observe(5, model="M")
+
+        text = histogram.render()
+
+        assert 'wait_seconds_bucket{model="M",le="0.1"} 1' in text
+        assert 'wait_seconds_bucket{model="M",le="1"} 2' in text
+        assert 'wait_seconds_bucket{model="M",le="+Inf"} 3' in text
+        assert 'wait_seconds_count{model="M"} 3' in text
+        assert histogram.get(model="M") == 3
+        assert histogram.get_sum(model="M") == pytest.approx(5.55)
@@ -3,7 +3,6 @@ from fastapi.testclient import TestClient
 from datetime import datetime, timedelta
 import bcrypt
 import jwt
-import mongomock
 from unittest.mock import patch, MagicMock
 import os
 
@@ -13,18 +12,10 @@ from app.models import RegisterRequest, LoginRequest
 
 
 @pytest.fixture
-def mock_db():
-    """Create a mock MongoDB database for testing"""
-    client = mongomock.MongoClient()
-    db = client["gen_ai_playground"]
-    return db
-
-
-@pytest.fixture
-def client(mock_db):
+def client(async_db):
     """Create a test client with mocked database"""
-    with patch('app.database.db_manager.db', mock_db):
-        with patch('app.database.get_database', return_value=mock_db):
+    with patch('app.database.db_manager.db', async_db):
+        with patch('app.database.get_database', return_value=async_db):
             yield TestClient(app)
 
 
@@ -0,0 +1,178 @@
+import asyncio
+import time
+import pytest
+import bcrypt
+import mongomock
+from datetime import datetime
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+
+from server import app
+from app.blobs import put_blob
+from app.auth_cache import AuthCache, auth_cache
+
+
+@pytest.fixture
+def client(async_db):
+    """Test client with mocked database and an empty authentication cache"""
+    auth_cache.clear()
+    with patch('app.database.db_manager.db', async_db):
+        yield TestClient(app)
+    auth_cache.clear()
+
+
+@pytest.fixture
+def token(client, mock_db):
+    """Token of a registered and logged-in user"""
+    mock_db.users.insert_one({
+        "username": "testuser",
+        "password": bcrypt.hashpw(b"SecurePassword123!", bcrypt.gensalt()),
+        "created_at": datetime.utcnow()
+    })
+    response = client.post("/login", json={"username": "testuser", "password": "SecurePassword123!"})
+    return response.json()["token"]
+
+
+@pytest.fixture
+def user_lookups():
+    """Count find_one calls on the users collection"""
+    calls = []
+    original = mongomock.collection.Collection.find_one
+
+    def counting_find_one(self, *args, **kwargs):
+        if self.name == "users":
+            calls.append(args)
+        return original(self, *args, **kwargs)
+
+    with patch.object(mongomock.collection.Collection, "find_one", counting_find_one):
+        yield calls
+
+
+def auth(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+class TestCachedAuthentication:
+    """Tests for the token cache in get_current_user"""
+
+    def test_warm_token_skips_user_lookup(self, client, token, user_lookups):
+        for _ in range(3):
+            assert client.get("/images/history", headers=auth(token)).status_code == 200
+
+        assert len(user_lookups) == 1
+
+    def test_revoked_tokens_stop_working(self, client, token):
+        assert client.get("/images/history", headers=auth(token)).status_code == 200
+
+        assert client.post("/revoke-tokens", headers=auth(token)).status_code == 200
+
+        response = client.get("/images/history", headers=auth(token))
+        assert response.status_code == 401
+        assert response.json()["detail"] == "Token has been revoked"
+        # A fresh login works again
+        new_token = client.post(
+            "/login", json={"username": "testuser", "password": "SecurePassword123!"}
+        ).json()["token"]
+        assert client.get("/images/history", headers=auth(new_token)).status_code == 200
+
+    def test_deleted_user_is_rejected(self, client, mock_db, token):
+        assert client.get("/images/history", headers=auth(token)).status_code == 200
+
+        assert client.delete("/account", headers=auth(token)).status_code == 200
+
+        response = client.get("/images/history", headers=auth(token))
+        assert response.status_code == 401
+        assert mock_db.users.count_documents({}) == 0
+
+    def test_account_deletion_removes_history(self, client, mock_db, token):
+        mock_db.images.insert_one({
+            "username": "testuser", "storage": "inline", "image_data": "aGk=",
+            "prompt": "p", "model": "M", "image_size": 2, "image_type": "generated",
+            "timestamp": datetime.utcnow()
+        })
+
+        client.delete("/account", headers=auth(token))
+
+        assert mock_db.images.count_documents({"username": "testuser"}) == 0
+
+    def test_account_deletion_releases_inputs_of_unfinished_jobs(self, client, mock_db, async_db, token):
+        input_hash, _ = asyncio.run(put_blob(async_db, b"source image"))
+        mock_db.jobs.insert_one({"username": "testuser", "status": "queued", "input_hash": input_hash})
+
+        client.delete("/account", headers=auth(token))
+
+        assert mock_db.jobs.count_documents({}) == 0
+        assert mock_db.image_blobs.count_documents({"_id": input_hash}) == 0
+
+    def test_hit_ratio_in_metrics(self, client, token):
+        client.get("/images/history", headers=auth(token))
+        client.get("/images/history", headers=auth(token))
+
+        text = client.get("/metrics").text
+        assert 'auth_cache_requests_total{result="hit"}' in text
+        assert "auth_cache_hit_ratio" in text
+
+    def test_cache_can_be_disabled(self, client, token, user_lookups):
+        with patch("app.config.settings.AUTH_CACHE_ENABLED", False):
+            client.get("/images/history", headers=auth(token))
+            client.get("/images/history", headers=auth(token))
+
+        assert len(user_lookups) == 2
+
+
+class TestAuthCache:
+    """Tests for the cache itself"""
+
+    def test_bounded_lru(self):
+        cache = AuthCache(max_entries=2, ttl_seconds=60)
+        expires = time.time() + 3600
+        cache.put("a", "alice", expires, cache.generation("alice"))
+        cache.put("b", "bob", expires, cache.generation("bob"))
+        cache.get("a")
+        cache.put("c", "carol", expires, cache.generation("carol"))
+
+        assert cache.get("a") == "alice"
+        assert cache.get("b") is None
+        assert cache.get("c") == "carol"
+
+    def test_entries_expire(self):
+        cache = AuthCache(max_entries=10, ttl_seconds=0.01)
+        cache.put("a", "alice", time.time() + 3600, 0)
+        time.sleep(0.02)
+
+        assert cache.get("a") is None
+
+    def test_never_outlives_token(self):
+        cache = AuthCache(max_entries=10, ttl_seconds=60)
+        cache.put("a", "alice", time.time() - 1, 0)
+
+        assert cache.get("a") is None
+
+    def test_invalidate_user(self):
+        cache = AuthCache(max_entries=10, ttl_seconds=60)
+        expires = time.time() + 3600
+        cache.put("a1", "alice", expires, 0)
+        cache.put("a2", "alice", expires, 0)
+        cache.put("b", "bob", expires, 0)
+
+        cache.invalidate_user("alice")
+
+        assert cache.get("a1") is None
+        assert cache.get("a2") is None
+        assert cache.get("b") == "bob"
+
+    def test_lookup_racing_invalidation_is_not_stored(self):
+        cache = AuthCache(max_entries=10, ttl_seconds=60)
+        generation = cache.generation("alice")
+        cache.invalidate_user("alice")
+        cache.put("a", "alice", time.time() + 3600, generation)
+
+        assert cache.get("a") is None
+
+    def test_hit_ratio(self):
+        cache = AuthCache(max_entries=10, ttl_seconds=60)
+        cache.put("a", "alice", time.time() + 3600, 0)
+        cache.get("a")
+        cache.get("missing")
+
+        assert cache.hit_ratio() == 0.5
@@ -0,0 +1,154 @@
+import asyncio
+import base64
+import json
+import pytest
+import httpx
+from unittest.mock import patch
+
+from app.batch import BatchRunner
+from app.models import BatchItem
+from app.persistence import write_images
+
+
+@pytest.fixture
+def upstream():
+    """Calls the fake model has running, and the most it had at once"""
+    return {"running": 0, "most": 0}
+
+
+@pytest.fixture
+def upstream_handler(upstream):
+    """
+    Fake model answering with the prompt and seed as the image
+
+    Prompts starting with "slow" take a while, "bad" ones are rejected.
+    """
+    async def handler(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        upstream["running"] += 1
+        upstream["most"] = max(upstream["most"], upstream["running"])
+        try:
+            await asyncio.sleep(0.3 if body["prompt"].startswith("slow") else 0.02)
+        finally:
+            upstream["running"] -= 1
+        if body["prompt"].startswith("bad"):
+            return httpx.Response(400, text="prompt rejected")
+        image = f"\x89PNG\r\n\x1a\n{body['prompt']} {body.get('seed')}".encode()
+        return httpx.Response(200, json={"image": base64.b64encode(image).decode()})
+
+    return handler
+
+
+@pytest.fixture
+def writes():
+    """Sizes of the history writes made"""
+    sizes = []
+
+    async def counting_write(db, saves):
+        sizes.append(len(saves))
+        return await write_images(db, saves)
+
+    with patch("app.routers.images.write_images", counting_write):
+        yield sizes
+
+
+def post_batch(client, body: dict) -> list:
+    """POST a batch and return its NDJSON lines in the order they arrived"""
+    with client.stream("POST", "/images/generate/batch", json=body) as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        return [json.loads(line) for line in response.iter_lines() if line]
+
+
+class TestGenerateBatch:
+    """Tests for /images/generate/batch"""
+
+    def test_seeds_are_generated_and_saved_in_one_write(self, client, mock_db, writes):
+        lines = post_batch(client, {"prompt": "a cat", "model": "FLUX2_KLEIN_4B", "seeds": [1, 2, 3]})
+
+        items, summary = lines[:-1], lines[-1]
+        assert sorted(line["seed"] for line in items) == [1, 2, 3]
+        for line in items:
+            assert line["status"] == "completed"
+            assert base64.b64decode(line["image"]).endswith(f"a cat {line['seed']}".encode())
+        assert summary == {"status": "done", "completed": 3, "failed": 0, "saved": 3}
+        assert writes == [3]
+        records = list(mock_db.images.find())
+        assert {str(record["_id"]) for record in records} == {line["image_id"] for line in items}
+        assert {f"/images/blobs/{record['content_hash']}" for record in records} == \
+            {line["image_url"] for line in items}
+
+    def test_results_stream_as_they_finish(self, client):
+        lines = post_batch(client, {"items": [
+            {"prompt": "slow cat", "model": "FLUX2_KLEIN_4B"},
+            {"prompt": "quick dog", "model": "FLUX2_KLEIN_9B"}
+        ]})
+
+        assert [line.get("index") for line in lines] == [1, 0, None]
+        assert lines[0]["model"] == "FLUX2_KLEIN_9B"
+
+    def test_stays_within_model_limit(self, client, upstream):
+        """Test that a batch larger than the limit and queue waits for itself instead of getting 429"""
+        with patch("app.config.settings.UPSTREAM_MODEL_CONCURRENCY", 2), \
+                patch("app.config.settings.UPSTREAM_MODEL_QUEUE_SIZE", 0):
+            lines = post_batch(client, {"prompt": "a cat", "model": "FLUX2_KLEIN_4B", "count": 6})
+
+        assert lines[-1]["completed"] == 6
+        assert upstream["most"] == 2
+        assert len({line["seed"] for line in lines[:-1]}) == 6
+
+    def test_failed_item_does_not_stop_the_batch(self, client, mock_db):
+        lines = post_batch(client, {"items": [
+            {"prompt": "bad cat", "model": "FLUX2_KLEIN_4B", "seed": 7},
+            {"prompt": "good dog", "model": "FLUX2_KLEIN_4B", "seed": 7}
+        ]})
+
+        failed = next(line for line in lines if line.get("index") == 0)
+        assert failed["status"] == "failed"
+        assert failed["error"]["status_code"] == 400
+        assert lines[-1] == {"status": "done", "completed": 1, "failed": 1, "saved": 1}
+        assert mock_db.images.count_documents({}) == 1
+
+    @pytest.mark.parametrize("body", [
+        {"prompt": "a cat", "model": "FLUX2_KLEIN_4B"},
+        {"prompt": "a cat", "model": "FLUX2_KLEIN_4B", "seeds": [1], "count": 2},
+        {"items": [{"prompt": "a cat", "model": "FLUX2_KLEIN_4B"}], "seeds": [1]},
+        {"items": []},
+        {"prompt": "a cat", "model": "FLUX2_KLEIN_4B", "count": 17},
+        {"items": [{"prompt": "a cat", "model": "NOT_A_MODEL"}]}
+    ])
+    def test_invalid_batch(self, client, upstream, body):
+        response = client.post("/images/generate/batch", json=body)
+
+        assert response.status_code == 400
+        assert upstream["most"] == 0
+
+
+class TestBatchRunner:
+    """Tests for running the items of a batch"""
+
+    def test_finish_gets_only_what_the_items_kept(self):
+        items = [BatchItem(prompt=prompt, model="FLUX2_KLEIN_4B") for prompt in ("a", "b")]
+        finished = []
+
+        async def generate(item: BatchItem, model: str):
+            return {"image": f"large image of {item.prompt}"}, item.prompt
+
+        async def finish(kept: list) -> dict:
+            finished.append(kept)
+            return {"saved": len(kept)}
+
+        async def run() -> list:
+            events = BatchRunner().start(items, generate, finish)
+            received = []
+            while not received or received[-1][0] is not None:
+                received.append(await events.get())
+            return received
+
+        received = asyncio.run(run())
+
+        assert finished == [["a", "b"]]
+        assert sorted(result["image"] for index, result, _ in received if index is not None) == [
+            "large image of a", "large image of b"
+        ]
+        assert received[-1] == (None, {"saved": 2}, None)
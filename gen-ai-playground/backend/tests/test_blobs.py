@@ -0,0 +1,134 @@
+import asyncio
+import pytest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+from app.blobs import content_hash, put_blob, release_blob
+from app.models import UserInfo
+from app.routers.images import save_image_to_db
+from app.storage import FilesystemStorage
+from app.thumbnails import thumbnail_pipeline
+
+
+@pytest.fixture
+def user():
+    return UserInfo(username="testuser")
+
+
+class TestBlobs:
+    """Tests for reference-counted blobs"""
+
+    def test_identical_bytes_share_a_blob(self, mock_db, async_db):
+        async def run():
+            return await put_blob(async_db, b"same bytes"), await put_blob(async_db, b"same bytes")
+
+        (first, created_first), (second, created_second) = asyncio.run(run())
+
+        assert first == second == content_hash(b"same bytes")
+        assert created_first and not created_second
+        assert mock_db.image_blobs.find_one({"_id": first})["refcount"] == 2
+
+    def test_release_deletes_unreferenced_blob(self, mock_db, async_db):
+        async def run():
+            digest, _ = await put_blob(async_db, b"bytes")
+            await put_blob(async_db, b"bytes")
+
+            await release_blob(async_db, digest)
+            assert mock_db.image_blobs.find_one({"_id": digest})["refcount"] == 1
+            assert mock_db.image_files.files.count_documents({}) == 1
+
+            await release_blob(async_db, digest)
+            assert mock_db.image_blobs.find_one({"_id": digest}) is None
+            assert mock_db.image_files.files.count_documents({}) == 0
+
+        with patch("app.config.settings.IMAGE_STORAGE_BACKEND", "gridfs"):
+            asyncio.run(run())
+
+
+    def test_bytes_are_stored_again_while_their_blob_is_deleted(self, mock_db, async_db, tmp_path):
+        storage = FilesystemStorage(str(tmp_path))
+
+        async def run():
+            digest, _ = await put_blob(async_db, b"bytes", storage=storage)
+            # release_blob marked the blob and is about to remove its file
+            mock_db.image_blobs.update_one({"_id": digest}, {"$set": {
+                "refcount": 0, "deleting_at": datetime.now(timezone.utc)
+            }})
+            put = asyncio.create_task(put_blob(async_db, b"bytes", storage=storage))
+            await asyncio.sleep(0.01)
+            await storage.delete(async_db, mock_db.image_blobs.find_one({"_id": digest}))
+            mock_db.image_blobs.delete_one({"_id": digest})
+            return await put
+
+        digest, created = asyncio.run(run())
+
+        blob = mock_db.image_blobs.find_one({"_id": digest})
+        assert created
+        assert blob["refcount"] == 1 and "deleting_at" not in blob
+        assert asyncio.run(storage.load(async_db, blob)) == b"bytes"
+
+    def test_abandoned_deletion_is_given_up(self, mock_db, async_db, tmp_path):
+        digest = content_hash(b"bytes")
+        mock_db.image_blobs.insert_one({
+            "_id": digest, "refcount": 0, "storage": "filesystem", "storage_ref": digest,
+            "deleting_at": datetime.now(timezone.utc) - timedelta(minutes=5)
+        })
+
+        _, created = asyncio.run(put_blob(async_db, b"bytes", storage=FilesystemStorage(str(tmp_path))))
+
+        blob = mock_db.image_blobs.find_one({"_id": digest})
+        assert created
+        assert blob["refcount"] == 1 and "deleting_at" not in blob
+
+
+def save_all(db, saves):
+    """Run save_image_to_db for each argument tuple and wait for the thumbnails"""
+    async def run():
+        for args in saves:
+            await save_image_to_db(db, *args)
+        await thumbnail_pipeline.stop()
+    asyncio.run(run())
+
+
+class TestSaveDeduplicates:
+    """Tests for deduplication in save_image_to_db"""
+
+    def test_repeated_edits_reuse_original(self, mock_db, async_db, user):
+        """Test that re-submitting a source image stores one original"""
+        save_all(async_db, [
+            (f"prompt {i}", "FLUX2_KLEIN_4B", f"result {i}".encode(), user, "edited", b"source image")
+            for i in range(3)
+        ])
+
+        originals = list(mock_db.images.find({"image_type": "original"}))
+        edits = list(mock_db.images.find({"image_type": "edited"}))
+        assert len(originals) == 1
+        assert len(edits) == 3
+        for edit in edits:
+            assert edit["parent_image_id"] == originals[0]["_id"]
+            assert edit["parent_content_hash"] == originals[0]["content_hash"]
+
+        source_blob = mock_db.image_blobs.find_one({"_id": content_hash(b"source image")})
+        assert source_blob["refcount"] == 1
+        assert mock_db.image_blobs.count_documents({}) == 4
+
+    def test_identical_outputs_stored_once(self, mock_db, async_db, user):
+        """Test that outputs with the same bytes share a blob across users"""
+        save_all(async_db, [
+            ("prompt", "FLUX2_KLEIN_4B", b"output", user, "generated"),
+            ("prompt", "FLUX2_KLEIN_4B", b"output", UserInfo(username="otheruser"), "generated"),
+        ])
+
+        assert mock_db.images.count_documents({}) == 2
+        assert mock_db.image_blobs.count_documents({}) == 1
+        assert mock_db.image_blobs.find_one()["refcount"] == 2
+
+    def test_originals_are_not_shared_between_users(self, mock_db, async_db, user):
+        """Test that each user gets their own original record"""
+        save_all(async_db, [
+            ("prompt", "FLUX2_KLEIN_4B", b"out", user, "edited", b"source"),
+            ("prompt", "FLUX2_KLEIN_4B", b"out", UserInfo(username="otheruser"), "edited", b"source"),
+        ])
+
+        assert mock_db.images.count_documents({"image_type": "original"}) == 2
+        assert mock_db.image_blobs.find_one({"_id": content_hash(b"source")})["refcount"] == 2
@@ -0,0 +1,14 @@
+from app.config import parse_key_values
+
+
+class TestParseKeyValues:
+    """Tests for settings written as KEY=value,KEY=value"""
+
+    def test_values_are_cast(self):
+        assert parse_key_values("A=2, B=8") == {"A": 2, "B": 8}
+        assert parse_key_values("A=2.5", float) == {"A": 2.5}
+        assert parse_key_values("app.jobs=debug", str) == {"app.jobs": "debug"}
+
+    def test_empty(self):
+        assert parse_key_values("") == {}
+        assert parse_key_values(None) == {}
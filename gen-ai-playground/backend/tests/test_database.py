@@ -0,0 +1,52 @@
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from fastapi import HTTPException
+
+from app.database import DatabaseManager, get_database
+
+
+class TestDatabaseManager:
+    """Tests for the async client setup"""
+
+    def test_pool_is_configured_from_settings(self):
+        client = MagicMock()
+        client.admin.command = AsyncMock()
+        manager = DatabaseManager()
+
+        with patch("app.database.AsyncIOMotorClient", return_value=client) as motor_client, \
+                patch("app.database.ensure_indexes", AsyncMock()) as ensure_indexes, \
+                patch("app.config.settings.MONGO_DB_URL", "mongodb://db:27017"), \
+                patch("app.config.settings.MONGO_MAX_POOL_SIZE", 20), \
+                patch("app.config.settings.MONGO_MIN_POOL_SIZE", 5):
+            asyncio.run(manager.connect())
+
+        _, kwargs = motor_client.call_args
+        assert kwargs["maxPoolSize"] == 20
+        assert kwargs["minPoolSize"] == 5
+        client.admin.command.assert_awaited_once_with("ping")
+        ensure_indexes.assert_awaited_once()
+        assert manager.is_available()
+
+        manager.close()
+        client.close.assert_called_once()
+        assert not manager.is_available()
+
+    def test_failed_ping_continues_without_database(self):
+        client = MagicMock()
+        client.admin.command = AsyncMock(side_effect=Exception("unreachable"))
+        manager = DatabaseManager()
+
+        with patch("app.database.AsyncIOMotorClient", return_value=client), \
+                patch("app.config.settings.MONGO_DB_URL", "mongodb://db:27017"):
+            asyncio.run(manager.connect())
+
+        assert manager.get_db() is None
+        client.close.assert_called_once()
+
+    def test_get_database_without_connection(self):
+        with patch("app.database.db_manager", DatabaseManager()):
+            with pytest.raises(HTTPException) as exc:
+                asyncio.run(get_database())
+
+        assert exc.value.status_code == 503
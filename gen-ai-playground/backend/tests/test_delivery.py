@@ -0,0 +1,120 @@
+import asyncio
+import io
+import pytest
+from fastapi import HTTPException
+from PIL import Image
+
+from server import app
+from app.delivery import etag_matches, parse_range
+from app.dependencies import get_current_user
+from app.models import UserInfo
+from app.routers.images import save_image_to_db
+from app.thumbnails import thumbnail_pipeline
+
+
+@pytest.fixture
+def png_bytes():
+    """A real 320x240 PNG image"""
+    buffer = io.BytesIO()
+    Image.new("RGB", (320, 240), (20, 120, 240)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def stored(client, async_db, png_bytes):
+    """The history item of a saved image, with its thumbnail"""
+    async def run():
+        await save_image_to_db(async_db, "prompt", "FLUX2_KLEIN_4B", png_bytes,
+                               UserInfo(username="testuser"), "generated")
+        await thumbnail_pipeline.stop()
+    asyncio.run(run())
+    return client.get("/images/history").json()["history"][0]
+
+
+class TestConditionalDelivery:
+    """Tests for content-hash image URLs"""
+
+    def test_immutable_response_with_etag(self, client, stored, png_bytes):
+        response = client.get(stored["image_url"])
+
+        assert stored["image_url"].startswith("/images/blobs/")
+        assert response.status_code == 200
+        assert response.content == png_bytes
+        assert response.headers["content-type"] == "image/png"
+        assert response.headers["etag"] == f'"{stored["image_url"].rsplit("/", 1)[1]}"'
+        assert "immutable" in response.headers["cache-control"]
+        assert response.headers["accept-ranges"] == "bytes"
+
+    @pytest.mark.parametrize("url_key", ["image_url", "thumbnail_url"])
+    def test_if_none_match_is_not_modified(self, client, stored, url_key):
+        etag = client.get(stored[url_key]).headers["etag"]
+
+        response = client.get(stored[url_key], headers={"If-None-Match": f'"other", W/{etag}'})
+
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers["etag"] == etag
+
+    def test_record_url_shares_etag(self, client, stored):
+        by_hash = client.get(stored["image_url"])
+        by_record = client.get(f"/images/{stored['id']}")
+
+        assert by_record.headers["etag"] == by_hash.headers["etag"]
+        assert by_record.content == by_hash.content
+
+    def test_byte_range(self, client, stored, png_bytes):
+        response = client.get(stored["image_url"], headers={"Range": "bytes=4-11"})
+
+        assert response.status_code == 206
+        assert response.content == png_bytes[4:12]
+        assert response.headers["content-range"] == f"bytes 4-11/{len(png_bytes)}"
+
+    def test_stale_if_range_sends_everything(self, client, stored, png_bytes):
+        response = client.get(stored["image_url"],
+                              headers={"Range": "bytes=0-3", "If-Range": '"stale"'})
+
+        assert response.status_code == 200
+        assert response.content == png_bytes
+
+    def test_unsatisfiable_range(self, client, stored, png_bytes):
+        response = client.get(stored["image_url"], headers={"Range": f"bytes={len(png_bytes)}-"})
+
+        assert response.status_code == 416
+        assert response.headers["content-range"] == f"bytes */{len(png_bytes)}"
+
+    def test_other_users_hash_not_found(self, client, stored):
+        app.dependency_overrides[get_current_user] = lambda: UserInfo(username="otheruser")
+
+        assert client.get(stored["image_url"]).status_code == 404
+        assert client.get(stored["thumbnail_url"]).status_code == 404
+
+
+class TestRangeParsing:
+    """Tests for the Range and If-None-Match helpers"""
+
+    @pytest.mark.parametrize("header, expected", [
+        ("bytes=0-0", (0, 0)),
+        ("bytes=90-", (90, 99)),
+        ("bytes=-10", (90, 99)),
+        ("bytes=-500", (0, 99)),
+        ("bytes=50-500", (50, 99)),
+        ("bytes=0-1, 5-6", None),
+        ("items=0-1", None),
+        ("bytes=5-2", None),
+        (None, None)
+    ])
+    def test_parse_range(self, header, expected):
+        assert parse_range(header, 100) == expected
+
+    def test_range_past_end(self):
+        with pytest.raises(HTTPException) as exc:
+            parse_range("bytes=100-", 100)
+
+        assert exc.value.status_code == 416
+
+    def test_etag_matches(self):
+        assert etag_matches('"abc"', '"abc"')
+        assert etag_matches("*", '"abc"')
+        assert etag_matches('"x", W/"abc"', '"abc"')
+        assert not etag_matches('"abcd"', '"abc"')
+        assert not etag_matches(None, '"abc"')
@@ -3,28 +3,20 @@ from fastapi.testclient import TestClient
 from datetime import datetime, timedelta
 import bcrypt
 import jwt
-import mongomock
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, AsyncMock
 import os
 import base64
+import httpx
 
 # Import the app
 from server import app
 
 
 @pytest.fixture
-def mock_db():
-    """Create a mock MongoDB database for testing"""
-    client = mongomock.MongoClient()
-    db = client["gen_ai_playground"]
-    return db
-
-
-@pytest.fixture
-def client(mock_db):
+def client(async_db):
     """Create a test client with mocked database"""
-    with patch('app.database.db_manager.db', mock_db):
-        with patch('app.database.get_database', return_value=mock_db):
+    with patch('app.database.db_manager.db', async_db):
+        with patch('app.database.get_database', return_value=async_db):
             yield TestClient(app)
 
 
@@ -212,9 +204,9 @@ class TestHistoryEndpoint:
         for item in data2["history"]:
             assert "user 2" in item["prompt"]
     
-    def test_get_history_includes_image_data(self, client, registered_user, auth_token, 
-                                             populated_history, sample_image_data):
-        """Test that history includes image data"""
+    def test_get_history_returns_metadata_only(self, client, registered_user, auth_token,
+                                               populated_history):
+        """Test that history items carry metadata but no image data"""
         headers = {"Authorization": f"Bearer {auth_token}"}
         response = client.get("/images/history", headers=headers)
         
@@ -222,12 +214,13 @@ class TestHistoryEndpoint:
         data = response.json()
         
         for item in data["history"]:
-            assert "image_data" in item
-            assert item["image_data"] == sample_image_data
+            assert "image_data" not in item
+            assert "id" in item
             assert "prompt" in item
             assert "model" in item
             assert "timestamp" in item
             assert "image_size" in item
+            assert "image_type" in item
     
     def test_get_history_sorted_by_timestamp(self, client, registered_user, auth_token, populated_history):
         """Test that history is sorted by newest first"""
@@ -303,6 +296,103 @@ class TestHistoryEndpoint:
         assert len(data["history"]) == 50  # Should be limited to 50
 
 
+    def test_get_history_cursor_pagination(self, client, registered_user, auth_token, mock_db, sample_image_data):
+        """Test that following next_cursor walks every item exactly once"""
+        now = datetime.utcnow()
+        for i in range(7):
+            mock_db.images.insert_one({
+                "prompt": f"Test prompt {i}",
+                "model": "FLUX1_KONTEXT_DEV",
+                # Pairs of images share a timestamp so the _id tiebreak is used
+                "timestamp": now - timedelta(minutes=i // 2),
+                "image_size": 1024,
+                "image_data": sample_image_data,
+                "username": registered_user["username"],
+                "image_type": "generated"
+            })
+        
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        seen = []
+        cursor = None
+        pages = 0
+        while True:
+            params = {"limit": 3}
+            if cursor:
+                params["cursor"] = cursor
+            response = client.get("/images/history", headers=headers, params=params)
+            assert response.status_code == 200
+            data = response.json()
+            seen.extend(item["id"] for item in data["history"])
+            pages += 1
+            cursor = data["next_cursor"]
+            if not cursor:
+                break
+        
+        assert pages == 3
+        assert len(seen) == 7
+        assert len(set(seen)) == 7
+    
+    def test_get_history_invalid_cursor(self, client, registered_user, auth_token):
+        """Test that a malformed cursor is rejected"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        response = client.get("/images/history", headers=headers, params={"cursor": "not-a-cursor"})
+        
+        assert response.status_code == 400
+
+
+class TestGetImageEndpoint:
+    """Tests for GET /images/{id}"""
+    
+    def test_get_image_returns_bytes(self, client, registered_user, auth_token, populated_history):
+        """Test that an image listed in history can be fetched"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        item = client.get("/images/history", headers=headers).json()["history"][0]
+        
+        response = client.get(f"/images/{item['id']}", headers=headers)
+        
+        assert response.status_code == 200
+        assert response.content == b"fake_image_data_for_testing"
+        assert response.headers["content-type"] == "image/png"
+    
+    def test_get_image_content_type_is_sniffed(self, client, registered_user, auth_token, mock_db):
+        """Test that the content type matches the stored image format"""
+        jpeg_bytes = b"\xff\xd8\xff\xe0fake_jpeg"
+        image_id = mock_db.images.insert_one({
+            "prompt": "jpeg",
+            "model": "FLUX1_KONTEXT_DEV",
+            "timestamp": datetime.utcnow(),
+            "image_size": len(jpeg_bytes),
+            "image_data": base64.b64encode(jpeg_bytes).decode("utf-8"),
+            "username": registered_user["username"],
+            "image_type": "original"
+        }).inserted_id
+        
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        response = client.get(f"/images/{image_id}", headers=headers)
+        
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/jpeg"
+        assert response.content == jpeg_bytes
+    
+    def test_get_image_of_other_user(self, client, registered_user, registered_user2,
+                                     auth_token, auth_token2, populated_history):
+        """Test that users cannot fetch each other's images"""
+        item = client.get("/images/history",
+                          headers={"Authorization": f"Bearer {auth_token2}"}).json()["history"][0]
+        
+        response = client.get(f"/images/{item['id']}",
+                              headers={"Authorization": f"Bearer {auth_token}"})
+        
+        assert response.status_code == 404
+    
+    def test_get_image_invalid_id(self, client, registered_user, auth_token):
+        """Test that a malformed id is not found"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        response = client.get("/images/not-an-id", headers=headers)
+        
+        assert response.status_code == 404
+
+
 class TestGenerateImageWithAuth:
     """Tests for /generate-image endpoint with authentication"""
     
@@ -330,20 +420,21 @@ class TestGenerateImageWithAuth:
         assert response.status_code == 401
         assert "Invalid token" in response.json()["detail"]
     
-    @patch('app.routers.images.requests.post')
+    @patch('app.routers.images.upstream_client.post', new_callable=AsyncMock)
     def test_generate_image_stores_with_username(self, mock_post, client, registered_user, 
                                                   auth_token, mock_db, sample_image_data):
         """Test that generated image is stored with username"""
         # Mock the external API response
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {
-            "status": "COMPLETED",
-            "output": {
-                "outputs": [sample_image_data]
-            }
-        }
-        mock_post.return_value = mock_response
+        mock_post.return_value = httpx.Response(
+            200,
+            json={
+                "status": "COMPLETED",
+                "output": {
+                    "outputs": [sample_image_data]
+                }
+            },
+            request=httpx.Request("POST", "https://upstream.test/predict")
+        )
         
         image_request = {
             "prompt": "A beautiful sunset",
@@ -361,26 +452,28 @@ class TestGenerateImageWithAuth:
         assert stored_image is not None
         assert stored_image["username"] == registered_user["username"]
         assert stored_image["model"] == "FLUX1_KONTEXT_DEV"
-        assert stored_image["image_data"] == sample_image_data
+        blob = mock_db.image_blobs.find_one({"_id": stored_image["content_hash"]})
+        assert blob["image_data"] == sample_image_data
         assert "timestamp" in stored_image
         assert "image_size" in stored_image
     
-    @patch('app.routers.images.requests.post')
+    @patch('app.routers.images.upstream_client.post', new_callable=AsyncMock)
     def test_generate_image_different_users_separate_storage(self, mock_post, client, 
                                                               registered_user, registered_user2,
                                                               auth_token, auth_token2, 
                                                               mock_db, sample_image_data):
         """Test that images from different users are stored separately"""
         # Mock the external API response
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {
-            "status": "COMPLETED",
-            "output": {
-                "outputs": [sample_image_data]
-            }
-        }
-        mock_post.return_value = mock_response
+        mock_post.return_value = httpx.Response(
+            200,
+            json={
+                "status": "COMPLETED",
+                "output": {
+                    "outputs": [sample_image_data]
+                }
+            },
+            request=httpx.Request("POST", "https://upstream.test/predict")
+        )
         
         with patch('app.config.settings.VERDA_API_KEY', "test-api-key"):
             # Generate image for user 1
@@ -0,0 +1,141 @@
+import asyncio
+import base64
+import json
+import os
+import pytest
+import httpx
+from unittest.mock import patch
+from fastapi import HTTPException
+
+from app.image_stream import ImageFieldDecoder, image_path
+from app.resilience import upstream_policy
+from app.routers.images import request_image
+from app.upstream import UpstreamClient
+
+IMAGE = b"\x89PNG\r\n\x1a\n" + os.urandom(5000)
+
+
+def decode(body: bytes, model: str = "FLUX2_KLEIN_4B", chunk_size: int = 1) -> ImageFieldDecoder:
+    decoder = ImageFieldDecoder(image_path(model), fields=[("status",)])
+    for i in range(0, len(body), chunk_size):
+        decoder.feed(body[i:i + chunk_size])
+    return decoder
+
+
+class ChunkedBody(httpx.AsyncByteStream):
+    """Response body sent in small pieces, recording whether it was closed"""
+
+    def __init__(self, body: bytes, chunk_size: int = 1000):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.closed = False
+
+    async def __aiter__(self):
+        for i in range(0, len(self.body), self.chunk_size):
+            yield self.body[i:i + self.chunk_size]
+
+    async def aclose(self):
+        self.closed = True
+
+
+class TestImageFieldDecoder:
+    """Tests for the incremental JSON scanner"""
+
+    @pytest.mark.parametrize("chunk_size", [1, 3, 7, 64, 100000])
+    def test_klein_image_in_any_chunking(self, chunk_size):
+        body = json.dumps({
+            "seed": 12, "nsfw": False, "timings": [1.5, {"total": 2}],
+            "image": base64.b64encode(IMAGE).decode("ascii")
+        }).encode()
+
+        assert decode(body, chunk_size=chunk_size).image() == IMAGE
+
+    def test_completed_output_and_status(self):
+        body = json.dumps({
+            "id": "abc", "status": "COMPLETED",
+            "output": {"meta": {"outputs": ["not this"]}, "outputs": [base64.b64encode(IMAGE).decode()]}
+        }).encode()
+
+        decoder = decode(body, "FLUX1_KREA_DEV", chunk_size=5)
+
+        assert decoder.image() == IMAGE
+        assert decoder.fields == {("status",): "COMPLETED"}
+
+    def test_data_url_prefix_and_escaped_slashes(self):
+        encoded = base64.b64encode(IMAGE).decode("ascii")
+        body = ('{"image": "data:image/png;base64,' + encoded.replace("/", "\\/") + '"}').encode()
+
+        assert "/" in encoded
+        assert decode(body, chunk_size=2).image() == IMAGE
+
+    def test_missing_image(self):
+        body = json.dumps({"status": "FAILED", "output": {"outputs": []}}).encode()
+
+        decoder = decode(body, "FLUX1_KREA_DEV")
+
+        assert decoder.image() is None
+        assert decoder.fields[("status",)] == "FAILED"
+
+    def test_escaped_field_value(self):
+        body = json.dumps({"status": "DONE é\n\"quoted\"", "image": "aGk="}).encode()
+
+        decoder = decode(body)
+
+        assert decoder.fields[("status",)] == "DONE é\n\"quoted\""
+        assert decoder.image() == b"hi"
+
+    def test_truncated_document(self):
+        body = json.dumps({"image": base64.b64encode(IMAGE).decode()}).encode()
+
+        with pytest.raises(ValueError):
+            decode(body[:-10], chunk_size=100).image()
+
+    def test_invalid_base64(self):
+        with pytest.raises(ValueError):
+            decode(b'{"image": "abcde"}').image()
+
+
+class TestRequestImage:
+    """Tests for streaming the model response in request_image"""
+
+    def run_request(self, handler, model="FLUX2_KLEIN_4B"):
+        upstream = UpstreamClient(transport=httpx.MockTransport(handler))
+        upstream_policy.reset()
+        with patch("app.routers.images.upstream_client", upstream), \
+                patch("app.config.settings.UPSTREAM_RETRY_BASE_DELAY", 0):
+            return asyncio.run(request_image(model, "a cat"))
+
+    def test_streamed_body_is_decoded_and_closed(self):
+        body = ChunkedBody(json.dumps({"image": base64.b64encode(IMAGE).decode()}).encode())
+
+        image = self.run_request(lambda request: httpx.Response(200, stream=body))
+
+        assert image == IMAGE
+        assert body.closed
+
+    def test_retried_response_is_closed(self):
+        failed = ChunkedBody(b"overloaded")
+        image = base64.b64encode(IMAGE).decode()
+        responses = [
+            httpx.Response(503, stream=failed),
+            httpx.Response(200, stream=ChunkedBody(json.dumps({"image": image}).encode()))
+        ]
+
+        assert self.run_request(lambda request: responses.pop(0)) == IMAGE
+        assert failed.closed
+
+    def test_error_body_in_detail(self):
+        with pytest.raises(HTTPException) as exc:
+            self.run_request(lambda request: httpx.Response(400, text="bad prompt"))
+
+        assert exc.value.status_code == 400
+        assert "bad prompt" in exc.value.detail
+
+    def test_incomplete_job_is_an_error(self):
+        body = {"status": "IN_PROGRESS", "output": {"outputs": ["aGk="]}}
+
+        with pytest.raises(HTTPException) as exc:
+            self.run_request(lambda request: httpx.Response(200, json=body), "FLUX1_KREA_DEV")
+
+        assert exc.value.status_code == 500
+        assert exc.value.detail["data"] == {"status": "IN_PROGRESS"}
@@ -0,0 +1,127 @@
+import asyncio
+import os
+import uuid
+import pytest
+import mongomock
+from mongomock_motor import AsyncMongoMockClient
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock, patch
+from fastapi.testclient import TestClient
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from server import app
+from app.indexes import HOT_QUERIES, check_query_plans, ensure_indexes, uses_index
+
+
+def async_view(db):
+    """A mock database through the async client the app uses"""
+    return AsyncMongoMockClient(mock_mongo_client=db.client)[db.name]
+
+
+@pytest.fixture
+def mock_db():
+    """Create a mock MongoDB database with the application's indexes"""
+    client = mongomock.MongoClient()
+    db = client["gen_ai_playground"]
+    asyncio.run(ensure_indexes(async_view(db)))
+    return db
+
+
+def explain_of(plan: dict) -> dict:
+    return {"queryPlanner": {"winningPlan": plan}}
+
+
+class TestIndexRegistry:
+    """Tests for creating the declared indexes"""
+
+    def test_creates_declared_indexes(self, mock_db):
+        users = mock_db.users.index_information()
+        images = mock_db.images.index_information()
+
+        assert users["username_unique"]["unique"]
+        assert list(images["username_timestamp"]["key"]) == [
+            ("username", 1), ("timestamp", -1), ("_id", -1)
+        ]
+        assert "expires_at_ttl" in mock_db.generation_cache.index_information()
+        assert mock_db.jobs.index_information()["finished_at_ttl"]["expireAfterSeconds"] > 0
+
+    def test_is_idempotent(self, mock_db, async_db):
+        asyncio.run(ensure_indexes(async_db))
+
+        assert len(mock_db.users.index_information()) == 2
+
+    def test_failing_index_does_not_stop_others(self):
+        db = mongomock.MongoClient()["gen_ai_playground"]
+        db.users.insert_many([{"username": "same"}, {"username": "same"}])
+
+        asyncio.run(ensure_indexes(async_view(db)))
+
+        assert "username_unique" not in db.users.index_information()
+        assert "username_timestamp" in db.images.index_information()
+
+    def test_concurrent_registration_is_rejected(self, mock_db, async_db):
+        mock_db.users.insert_one({"username": "taken", "password": b"x", "created_at": datetime.utcnow()})
+        original = mongomock.collection.Collection.find_one
+
+        def find_one_before_insert(self, *args, **kwargs):
+            # The other registration has not been inserted yet when we check
+            if self.name == "users":
+                return None
+            return original(self, *args, **kwargs)
+
+        with patch('app.database.db_manager.db', async_db), \
+                patch("app.config.settings.INVITATION_CODE", "code"), \
+                patch("app.config.settings.BCRYPT_ROUNDS", 4), \
+                patch.object(mongomock.collection.Collection, "find_one", find_one_before_insert):
+            response = TestClient(app).post("/register", json={
+                "username": "taken", "password": "SecurePassword123!", "invitation_code": "code"
+            })
+
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Username already exists"
+        assert mock_db.users.count_documents({"username": "taken"}) == 1
+
+
+class TestQueryPlans:
+    """Tests for recognising index use in explain() output"""
+
+    def test_index_scan(self):
+        plan = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": "username_unique"}}
+        assert uses_index(explain_of(plan))
+
+    def test_collection_scan(self):
+        plan = {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}
+        assert not uses_index(explain_of(plan))
+
+    def test_slot_based_engine_plan(self):
+        plan = {"queryPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}}
+        assert uses_index(explain_of(plan))
+
+    def test_or_with_one_scanning_branch(self):
+        plan = {"stage": "OR", "inputStages": [{"stage": "IXSCAN"}, {"stage": "COLLSCAN"}]}
+        assert not uses_index(explain_of(plan))
+
+    def test_explains_every_hot_query(self):
+        db = MagicMock()
+        cursor = db.__getitem__.return_value.find.return_value
+        cursor.sort.return_value = cursor
+        cursor.explain = AsyncMock(return_value=explain_of({"stage": "IXSCAN"}))
+
+        results = asyncio.run(check_query_plans(db))
+
+        assert set(results) == set(HOT_QUERIES)
+        assert all(results.values())
+
+    @pytest.mark.skipif(not os.getenv("MONGO_TEST_URL"), reason="needs a MongoDB server in MONGO_TEST_URL")
+    def test_hot_queries_use_indexes_on_mongodb(self):
+        async def run():
+            client = AsyncIOMotorClient(os.getenv("MONGO_TEST_URL"))
+            db = client[f"index_check_{uuid.uuid4().hex}"]
+            try:
+                await ensure_indexes(db)
+                return await check_query_plans(db)
+            finally:
+                await client.drop_database(db.name)
+                client.close()
+
+        assert asyncio.run(run()) == {name: True for name in HOT_QUERIES}
@@ -0,0 +1,353 @@
+import asyncio
+import base64
+import json
+import time
+import pytest
+import httpx
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+from fastapi import HTTPException
+
+from server import app
+from app.dependencies import get_current_user
+from app.blobs import put_blob
+from app.jobs import JobManager
+from app.models import UserInfo
+from app.routers.images import release_job_input, run_generation_job
+
+
+@pytest.fixture
+def upstream_status():
+    """Status code the fake Verda upstream answers with"""
+    return {"code": 200}
+
+
+@pytest.fixture
+def upstream_handler(upstream_status):
+    """Fake Verda model answering with an image naming the prompt, or with upstream_status"""
+    def handler(request: httpx.Request) -> httpx.Response:
+        if upstream_status["code"] != 200:
+            return httpx.Response(upstream_status["code"], text="model overloaded")
+        body = json.loads(request.content)
+        image = base64.b64encode(f"image for {body['prompt']}".encode()).decode("utf-8")
+        return httpx.Response(200, json={"image": image})
+
+    return handler
+
+
+@pytest.fixture
+def client(lifespan_client):
+    """Test client with the app lifespan, and so the job workers, running"""
+    with patch("app.config.settings.UPSTREAM_RETRY_BASE_DELAY", 0):
+        yield lifespan_client
+
+
+def wait_for_job(client, status_url, timeout=5):
+    """Poll a job until it has finished"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = client.get(status_url).json()
+        if job["status"] in ("completed", "failed"):
+            return job
+        time.sleep(0.02)
+    raise AssertionError("job did not finish in time")
+
+
+class TestAsyncGeneration:
+    """Tests for ?mode=async on the generation endpoints"""
+
+    def test_generate_returns_job_right_away(self, client, mock_db):
+        response = client.post(
+            "/images/generate?mode=async",
+            json={"prompt": "A beautiful sunset", "model": "FLUX2_KLEIN_4B"}
+        )
+
+        assert response.status_code == 202
+        job = response.json()
+        assert job["status"] in ("queued", "running", "completed")
+        assert response.headers["location"] == job["status_url"]
+
+        job = wait_for_job(client, job["status_url"])
+        assert job["status"] == "completed"
+        image = client.get(job["image_url"])
+        assert image.content == b"image for A beautiful sunset"
+        assert mock_db.images.count_documents({"username": "testuser"}) == 1
+
+    def test_edit_job_keeps_input_until_finished(self, client, mock_db):
+        source = base64.b64encode(b"source image").decode("utf-8")
+        response = client.post(
+            "/images/edit-image?mode=async",
+            json={"prompt": "make it blue", "model": "FLUX2_KLEIN_4B", "image": source}
+        )
+
+        job = wait_for_job(client, response.json()["status_url"])
+
+        assert job["status"] == "completed"
+        edited = mock_db.images.find_one({"image_type": "edited"})
+        assert edited["parent_image_id"] is not None
+        # Only the history record still references the input blob
+        input_blob = mock_db.image_blobs.find_one({"_id": edited["parent_content_hash"]})
+        assert input_blob["refcount"] == 1
+
+    def test_upstream_error_fails_job(self, client, upstream_status):
+        upstream_status["code"] = 503
+        response = client.post(
+            "/images/generate?mode=async",
+            json={"prompt": "A beautiful sunset", "model": "FLUX2_KLEIN_4B"}
+        )
+
+        job = wait_for_job(client, response.json()["status_url"])
+
+        assert job["status"] == "failed"
+        assert job["error"]["status_code"] == 503
+        assert job["image_id"] is None
+
+    def test_unknown_model_rejected_before_queuing(self, client, mock_db):
+        response = client.post(
+            "/images/generate?mode=async",
+            json={"prompt": "A beautiful sunset", "model": "NOT_A_MODEL"}
+        )
+
+        assert response.status_code == 400
+        assert mock_db.jobs.count_documents({}) == 0
+
+    def test_invalid_mode_rejected(self, client):
+        response = client.post(
+            "/images/generate?mode=later",
+            json={"prompt": "A beautiful sunset", "model": "FLUX2_KLEIN_4B"}
+        )
+
+        assert response.status_code == 422
+
+    def test_jobs_are_private(self, client):
+        response = client.post(
+            "/images/generate?mode=async",
+            json={"prompt": "A beautiful sunset", "model": "FLUX2_KLEIN_4B"}
+        )
+        status_url = response.json()["status_url"]
+
+        app.dependency_overrides[get_current_user] = lambda: UserInfo(username="someoneelse")
+        assert client.get(status_url).status_code == 404
+        assert client.get("/images/jobs/not-an-id").status_code == 404
+
+    def test_events_stream_until_finished(self, client):
+        response = client.post(
+            "/images/generate?mode=async",
+            json={"prompt": "A beautiful sunset", "model": "FLUX2_KLEIN_4B"}
+        )
+
+        with client.stream("GET", response.json()["events_url"]) as events:
+            assert events.headers["content-type"].startswith("text/event-stream")
+            statuses = [
+                json.loads(line[len("data: "):])["status"]
+                for line in events.iter_lines()
+                if line.startswith("data: ")
+            ]
+
+        assert statuses[-1] == "completed"
+
+    def test_job_of_a_deleted_account_saves_nothing(self, fake_upstream, mock_db, async_db):
+        mock_db.users.delete_many({"username": "testuser"})
+        job_id = mock_db.jobs.insert_one({
+            "username": "testuser", "status": "running", "prompt": "A beautiful sunset",
+            "model": "FLUX2_KLEIN_4B", "image_type": "generated"
+        }).inserted_id
+
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(run_generation_job(async_db, mock_db.jobs.find_one({"_id": job_id})))
+
+        assert error.value.status_code == 410
+        assert mock_db.images.count_documents({}) == 0
+
+
+class TestJobManager:
+    """Tests for the queue and worker pool"""
+
+    def test_unfinished_jobs_resume_after_restart(self, mock_db, async_db):
+        now = datetime.now(timezone.utc)
+        for status in ("queued", "running", "completed"):
+            mock_db.jobs.insert_one({
+                "username": "testuser", "status": status,
+                "created_at": now, "updated_at": now
+            })
+        handled = []
+
+        async def handler(db, job):
+            handled.append(job["_id"])
+            return {"image_id": "abc"}
+
+        async def run():
+            manager = JobManager()
+            await manager.start(handler, async_db)
+            for _ in range(100):
+                if len(handled) == 2:
+                    break
+                await asyncio.sleep(0.01)
+            await manager.stop()
+
+        asyncio.run(run())
+
+        assert len(handled) == 2
+        assert mock_db.jobs.count_documents({"status": "completed"}) == 3
+
+    def test_jobs_leased_by_a_live_replica_are_left_alone(self, mock_db, async_db):
+        now = datetime.now(timezone.utc)
+        leases = {"live": now + timedelta(minutes=5), "expired": now - timedelta(seconds=1)}
+        for owner, lease in leases.items():
+            mock_db.jobs.insert_one({
+                "username": "testuser", "status": "running", "owner": owner,
+                "lease_expires_at": lease, "created_at": now, "updated_at": now
+            })
+        handled = []
+
+        async def handler(db, job):
+            handled.append(job["_id"])
+            return {"image_id": "abc"}
+
+        async def run():
+            manager = JobManager()
+            await manager.start(handler, async_db)
+            for _ in range(100):
+                if handled:
+                    break
+                await asyncio.sleep(0.01)
+            await manager.stop()
+            return manager.owner
+
+        owner = asyncio.run(run())
+
+        live = mock_db.jobs.find_one({"owner": "live"})
+        taken_over = mock_db.jobs.find_one({"_id": handled[0]})
+        assert len(handled) == 1
+        assert live["status"] == "running"
+        assert taken_over["status"] == "completed"
+        assert "owner" not in taken_over and "lease_expires_at" not in taken_over
+        assert taken_over["finished_at"] >= now.replace(tzinfo=None)
+        assert owner != "live"
+
+    def test_lease_is_renewed_while_running(self, mock_db, async_db):
+        leases = []
+
+        async def handler(db, job):
+            leases.append((await db.jobs.find_one({"_id": job["_id"]}))["lease_expires_at"])
+            await asyncio.sleep(0.1)
+            leases.append((await db.jobs.find_one({"_id": job["_id"]}))["lease_expires_at"])
+            return {"image_id": "abc"}
+
+        async def run():
+            manager = JobManager()
+            with patch("app.config.settings.JOB_LEASE_SECONDS", 0.06):
+                await manager.start(handler, async_db)
+                await manager.submit(async_db, {"username": "testuser"})
+                for _ in range(100):
+                    if len(leases) == 2:
+                        break
+                    await asyncio.sleep(0.01)
+                await manager.stop()
+
+        asyncio.run(run())
+
+        assert len(leases) == 2
+        assert leases[1] > leases[0]
+
+    def test_result_of_a_job_taken_over_is_dropped(self, mock_db, async_db):
+        async def handler(db, job):
+            # Another replica took the job over after this one's lease expired
+            await db.jobs.update_one({"_id": job["_id"]}, {"$set": {"owner": "other"}})
+            return {"image_id": "abc"}
+
+        async def run():
+            manager = JobManager()
+            await manager.start(handler, async_db)
+            job = await manager.submit(async_db, {"username": "testuser"})
+            for _ in range(20):
+                await asyncio.sleep(0.01)
+            await manager.stop()
+            return job["_id"]
+
+        job_id = asyncio.run(run())
+
+        job = mock_db.jobs.find_one({"_id": job_id})
+        assert job["status"] == "running"
+        assert job["owner"] == "other"
+        assert "result" not in job
+
+    def test_replica_stops_a_job_taken_over_after_its_lease_expired(self, mock_db, async_db):
+        first, second = JobManager(), JobManager()
+        started, cancelled = [], []
+
+        async def handler(db, job):
+            started.append(job["owner"])
+            try:
+                await asyncio.sleep(1 if job["owner"] == first.owner else 0)
+            except asyncio.CancelledError:
+                cancelled.append(job["owner"])
+                raise
+            return {"image_id": job["owner"]}
+
+        async def run():
+            with patch("app.config.settings.JOB_LEASE_SECONDS", 0.06):
+                await first.start(handler, async_db)
+                job = await first.submit(async_db, {"username": "testuser"})
+                while not started:
+                    await asyncio.sleep(0.005)
+                # The first replica stalled past its lease, the second takes the job over
+                mock_db.jobs.update_one({"_id": job["_id"]}, {"$set": {
+                    "lease_expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)
+                }})
+                await second.start(handler, async_db)
+                for _ in range(100):
+                    if cancelled:
+                        break
+                    await asyncio.sleep(0.01)
+                await first.stop()
+                await second.stop()
+            return job["_id"]
+
+        job_id = asyncio.run(run())
+
+        job = mock_db.jobs.find_one({"_id": job_id})
+        assert started == [first.owner, second.owner]
+        assert cancelled == [first.owner]
+        assert job["status"] == "completed"
+        assert job["result"] == {"image_id": second.owner}
+
+    def test_input_is_released_once_per_job(self, mock_db, async_db):
+        async def run():
+            input_hash, _ = await put_blob(async_db, b"source image")
+            # Also held by a history record
+            await put_blob(async_db, b"source image")
+            await async_db.jobs.insert_one({"username": "testuser", "input_hash": input_hash})
+            job = await async_db.jobs.find_one({"input_hash": input_hash})
+            # Both replicas that ran the job give its input back
+            await release_job_input(async_db, job)
+            await release_job_input(async_db, job)
+            return input_hash
+
+        input_hash = asyncio.run(run())
+
+        assert mock_db.image_blobs.find_one({"_id": input_hash})["refcount"] == 1
+
+    def test_full_queue_rejects_with_429(self, mock_db, async_db):
+        async def run():
+            manager = JobManager()
+            with patch("app.config.settings.JOB_WORKERS", 0), \
+                    patch("app.config.settings.JOB_QUEUE_SIZE", 1):
+                await manager.start(lambda db, job: None)
+            await manager.submit(async_db, {"username": "testuser"})
+            with pytest.raises(HTTPException) as exc:
+                await manager.submit(async_db, {"username": "testuser"})
+            await manager.stop()
+            return exc.value
+
+        error = asyncio.run(run())
+
+        assert error.status_code == 429
+        assert "Retry-After" in error.headers
+        assert mock_db.jobs.count_documents({}) == 1
+
+    def test_submit_without_workers_is_unavailable(self, async_db):
+        with pytest.raises(HTTPException) as exc:
+            asyncio.run(JobManager().submit(async_db, {"username": "testuser"}))
+
+        assert exc.value.status_code == 503
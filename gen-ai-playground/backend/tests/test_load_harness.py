@@ -0,0 +1,133 @@
+import asyncio
+import io
+import pytest
+import httpx
+from PIL import Image
+from unittest.mock import patch
+
+from server import app
+from app.database import get_database
+from benchmarks.fake_verda import FakeVerdaConfig, create_app, parse_latency, unique_png, make_png
+from benchmarks.load_test import LoadTest, check_thresholds, parse_mix
+
+
+@pytest.fixture
+def fake_config():
+    """How the fake Verda API answers, changed by tests before the first request"""
+    return FakeVerdaConfig(latency="fixed:0", image_bytes=4096)
+
+
+@pytest.fixture
+def upstream_transport(fake_config):
+    """Upstream calls go to the fake Verda API"""
+    return httpx.ASGITransport(app=create_app(fake_config))
+
+
+@pytest.fixture
+def client(client):
+    """Test client authenticated as testuser, calling the fake Verda API once per request"""
+    with patch("app.config.settings.UPSTREAM_RETRY_ATTEMPTS", 1):
+        yield client
+
+
+class TestFakeVerda:
+    """Tests for the fake upstream the load test runs against"""
+
+    @pytest.mark.parametrize("model", ["FLUX2_KLEIN_4B", "FLUX1_KREA_DEV"])
+    def test_backend_decodes_both_response_shapes(self, client, model):
+        response = client.post("/images/generate", json={"prompt": "a cat", "model": model})
+
+        assert response.status_code == 200
+        assert Image.open(io.BytesIO(response.content)).format == "PNG"
+
+    def test_edit_with_upload(self, client):
+        response = client.post("/images/edit-image",
+                               data={"prompt": "make it blue", "model": "FLUX1_KONTEXT_DEV"},
+                               files={"image": ("in.png", make_png(2048), "image/png")})
+
+        assert response.status_code == 200
+
+    def test_images_are_unique_per_response(self, client):
+        first = client.post("/images/generate", json={"prompt": "a cat", "model": "FLUX2_KLEIN_4B"})
+        second = client.post("/images/generate", json={"prompt": "a cat", "model": "FLUX2_KLEIN_4B"})
+
+        assert first.content != second.content
+
+    def test_error_rate(self, client, fake_config):
+        fake_config.error_rate = 1.0
+
+        response = client.post("/images/generate", json={"prompt": "a cat", "model": "FLUX2_KLEIN_4B"})
+
+        assert response.status_code == 500
+        assert "Simulated upstream failure" in response.json()["detail"]
+
+    def test_unique_png_stays_valid(self):
+        image = Image.open(io.BytesIO(unique_png(make_png(1024), 7)))
+
+        image.load()
+        assert image.text == {"fake-verda": "7"}
+
+    @pytest.mark.parametrize("spec,low,high", [
+        ("fixed:250", 0.25, 0.25), ("uniform:100:200", 0.1, 0.2), ("lognormal:500:0", 0.5, 0.5)
+    ])
+    def test_latency_specs(self, spec, low, high):
+        draw = parse_latency(spec)
+
+        assert all(low <= draw() <= high for _ in range(20))
+
+    def test_unknown_latency_spec(self):
+        with pytest.raises(ValueError):
+            parse_latency("normal:100")
+
+
+class TestLoadTest:
+    """Tests for driving the request mix through the app"""
+
+    def test_setup_and_every_kind_of_request(self, async_db, fake_upstream):
+        app.dependency_overrides[get_database] = lambda: async_db
+        load = LoadTest("http://backend", "code", users=2,
+                        mix={"generate": 1, "edit": 1, "history": 1, "login": 1}, edit_image_kb=2)
+
+        async def drive() -> dict:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app),
+                                         base_url="http://backend") as client:
+                await load.setup(client)
+                return {kind: await load.request(client, kind) for kind in load.kinds}
+
+        try:
+            with patch("app.config.settings.INVITATION_CODE", "code"), \
+                    patch("app.config.settings.JWT_SECRET_KEY", "load-test-secret-of-32-bytes-min"), \
+                    patch("app.config.settings.BCRYPT_ROUNDS", 4):
+                statuses = asyncio.run(drive())
+        finally:
+            app.dependency_overrides.clear()
+
+        assert set(load.tokens) == set(load.usernames)
+        assert statuses == {"generate": 200, "edit": 200, "history": 200, "login": 200}
+
+
+class TestThresholds:
+    """Tests for checking load test results against regression thresholds"""
+
+    def test_breaches_are_reported(self):
+        result = {
+            "requests": {"generate": {"p95_ms": 900.0, "rps": 1.5, "error_rate": 0.0}},
+            "peak_rss_mb": 1200.0
+        }
+        thresholds = {
+            "requests": {"generate": {"p95_ms_max": 1000, "rps_min": 2, "error_rate_max": 0.01},
+                         "login": {"p95_ms_max": 10}},
+            "peak_rss_mb_max": 1024
+        }
+
+        failures = check_thresholds(result, thresholds)
+
+        assert failures == [
+            "generate rps 1.5 is beyond the min of 2",
+            "peak RSS 1200.0 MB is beyond the max of 1024 MB"
+        ]
+
+    def test_mix(self):
+        assert parse_mix("generate=3,history=1") == {"generate": 3.0, "history": 1.0}
+        with pytest.raises(ValueError):
+            parse_mix("upload=1")
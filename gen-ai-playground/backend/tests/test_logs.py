@@ -0,0 +1,126 @@
+import io
+import json
+import logging
+import queue
+import sys
+import pytest
+from unittest.mock import patch
+
+from app.logs import JsonFormatter, _NonBlockingQueueHandler, records_dropped, structured_logging
+
+
+@pytest.fixture
+def read_logs():
+    """Log as JSON into a buffer; calling the fixture stops logging and returns the lines"""
+    stream = io.StringIO()
+    structured_logging.start(stream)
+
+    def read() -> list:
+        structured_logging.stop()
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    yield read
+    structured_logging.stop()
+
+
+def summaries(lines: list) -> list:
+    return [line for line in lines if line["logger"] == "app.requests"]
+
+
+class TestRequestIds:
+    """Tests for assigning and propagating request IDs"""
+
+    def test_generated_when_missing(self, client):
+        request_id = client.get("/").headers["x-request-id"]
+
+        assert len(request_id) == 32
+
+    def test_propagated_to_response_and_upstream(self, client, upstream_requests):
+        response = client.post("/images/generate", headers={"X-Request-ID": "trace-42"},
+                               json={"prompt": "a cat", "model": "FLUX2_KLEIN_4B"})
+
+        assert response.headers["x-request-id"] == "trace-42"
+        assert upstream_requests[0].headers["x-request-id"] == "trace-42"
+
+    def test_unusable_id_is_replaced(self, client):
+        response = client.get("/", headers={"X-Request-ID": "x" * 200})
+
+        assert len(response.headers["x-request-id"]) == 32
+
+
+class TestStructuredLogs:
+    """Tests for the JSON log lines"""
+
+    def test_summary_line_with_phases(self, client, read_logs):
+        client.post("/images/generate", headers={"X-Request-ID": "trace-7"},
+                    json={"prompt": "a cat", "model": "FLUX2_KLEIN_4B"})
+
+        [summary] = summaries(read_logs())
+        assert summary["request_id"] == "trace-7"
+        assert summary["level"] == "INFO"
+        assert summary["route"] == "/images/generate"
+        assert summary["status"] == 200
+        assert set(summary["phases_ms"]) == {"upstream", "decode", "persist"}
+        assert summary["duration_ms"] >= sum(summary["phases_ms"].values())
+
+    def test_records_carry_the_request_id(self, client, read_logs):
+        logging.getLogger("app.routers.images").warning("inside the request")
+        with patch("app.routers.images.transcoder.convert", side_effect=RuntimeError("no encoder")):
+            client.post("/images/generate", params={"format": "webp"}, headers={"X-Request-ID": "trace-8"},
+                        json={"prompt": "a cat", "model": "FLUX2_KLEIN_4B"})
+
+        lines = read_logs()
+        outside = next(line for line in lines if line["message"] == "inside the request")
+        warning = next(line for line in lines if "no encoder" in line["message"])
+        assert "request_id" not in outside
+        assert warning["request_id"] == "trace-8"
+        assert warning["logger"] == "app.routers.images"
+
+    def test_sampled_route(self, client):
+        # Sample rates are read when logging starts
+        stream = io.StringIO()
+        with patch("app.config.settings.LOG_SAMPLE_RATES", "/images/history=0"):
+            structured_logging.start(stream)
+        try:
+            for _ in range(3):
+                client.get("/images/history")
+            client.get("/")
+        finally:
+            structured_logging.stop()
+
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert [line["route"] for line in summaries(lines)] == ["/"]
+
+    def test_level_overrides(self, read_logs):
+        with patch("app.config.settings.LOG_LEVEL_OVERRIDES", "app.persistence=ERROR"):
+            structured_logging.stop()
+            structured_logging.start(io.StringIO())
+        try:
+            assert logging.getLogger("app.persistence").getEffectiveLevel() == logging.ERROR
+            assert logging.getLogger("app.jobs").getEffectiveLevel() == logging.INFO
+        finally:
+            logging.getLogger("app.persistence").setLevel(logging.NOTSET)
+
+    def test_exception_is_a_field(self):
+        try:
+            raise ValueError("broken")
+        except ValueError:
+            record = logging.LogRecord("app.x", logging.ERROR, __file__, 1, "failed %s", ("here",),
+                                       exc_info=sys.exc_info())
+        record.fields = {"model": "FLUX2_KLEIN_4B"}
+
+        line = json.loads(JsonFormatter().format(record))
+
+        assert line["message"] == "failed here"
+        assert line["model"] == "FLUX2_KLEIN_4B"
+        assert "ValueError: broken" in line["exception"]
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        handler = _NonBlockingQueueHandler(queue.Queue(maxsize=1))
+        record = logging.LogRecord("app.x", logging.INFO, __file__, 1, "message", None, None)
+        before = records_dropped.get()
+
+        handler.emit(record)
+        handler.emit(record)
+
+        assert records_dropped.get() == before + 1
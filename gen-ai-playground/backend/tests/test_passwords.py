@@ -0,0 +1,107 @@
+import asyncio
+import threading
+import pytest
+import bcrypt
+from datetime import datetime
+from unittest.mock import patch
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from server import app
+from app import passwords
+from app.passwords import PasswordHasher, hash_cost, password_hasher
+
+
+@pytest.fixture
+def client(async_db):
+    """Test client with mocked database and a cheap bcrypt cost"""
+    with patch('app.database.db_manager.db', async_db), \
+            patch("app.config.settings.BCRYPT_ROUNDS", 4):
+        yield TestClient(app)
+
+
+def add_user(db, password: str, rounds: int):
+    db.users.insert_one({
+        "username": "testuser",
+        "password": bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds=rounds)),
+        "created_at": datetime.utcnow()
+    })
+
+
+class TestPasswordHasher:
+    """Tests for hashing in the dedicated thread pool"""
+
+    def test_hash_uses_configured_cost(self):
+        with patch("app.config.settings.BCRYPT_ROUNDS", 5):
+            hashed = asyncio.run(password_hasher.hash("secret"))
+
+        assert hash_cost(hashed) == 5
+        assert asyncio.run(password_hasher.verify("secret", hashed))
+        assert not asyncio.run(password_hasher.verify("wrong", hashed))
+
+    def test_runs_in_bcrypt_threads(self):
+        threads = []
+        original = passwords.check_password
+
+        def recording_check(password, hashed):
+            threads.append(threading.current_thread().name)
+            return original(password, hashed)
+
+        hashed = bcrypt.hashpw(b"secret", bcrypt.gensalt(rounds=4))
+        with patch("app.passwords.check_password", recording_check):
+            asyncio.run(PasswordHasher().verify("secret", hashed))
+
+        assert threads[0].startswith("bcrypt")
+
+    def test_full_queue_is_rejected(self):
+        hasher = PasswordHasher()
+        hasher._pending = 3
+        with patch("app.config.settings.PASSWORD_HASH_WORKERS", 1), \
+                patch("app.config.settings.PASSWORD_HASH_QUEUE_SIZE", 2):
+            with pytest.raises(HTTPException) as exc:
+                asyncio.run(hasher.hash("secret"))
+
+        assert exc.value.status_code == 503
+        assert exc.value.headers["Retry-After"] == "1"
+
+    def test_hash_cost(self):
+        assert hash_cost(b"$2b$12$abcdefghijklmnopqrstuv") == 12
+        assert hash_cost(b"not a hash") is None
+
+
+class TestRehashOnLogin:
+    """Tests for replacing hashes made with another cost"""
+
+    def test_login_rehashes_to_configured_cost(self, client, mock_db):
+        add_user(mock_db, "SecurePassword123!", rounds=5)
+
+        response = client.post("/login", json={"username": "testuser", "password": "SecurePassword123!"})
+
+        assert response.status_code == 200
+        stored = mock_db.users.find_one({"username": "testuser"})["password"]
+        assert hash_cost(stored) == 4
+        assert bcrypt.checkpw(b"SecurePassword123!", stored)
+
+    def test_login_keeps_hash_with_configured_cost(self, client, mock_db):
+        add_user(mock_db, "SecurePassword123!", rounds=4)
+        before = mock_db.users.find_one({"username": "testuser"})["password"]
+
+        client.post("/login", json={"username": "testuser", "password": "SecurePassword123!"})
+
+        assert mock_db.users.find_one({"username": "testuser"})["password"] == before
+
+    def test_failed_login_does_not_rehash(self, client, mock_db):
+        add_user(mock_db, "SecurePassword123!", rounds=5)
+
+        response = client.post("/login", json={"username": "testuser", "password": "wrong"})
+
+        assert response.status_code == 401
+        assert hash_cost(mock_db.users.find_one({"username": "testuser"})["password"]) == 5
+
+    def test_register_uses_configured_cost(self, client, mock_db):
+        with patch("app.config.settings.INVITATION_CODE", "code"):
+            client.post("/register", json={
+                "username": "newuser", "password": "SecurePassword123!", "invitation_code": "code"
+            })
+
+        assert hash_cost(mock_db.users.find_one({"username": "newuser"})["password"]) == 4
@@ -0,0 +1,157 @@
+import asyncio
+import pytest
+import mongomock
+from unittest.mock import patch
+from pymongo.errors import AutoReconnect, BulkWriteError, OperationFailure
+
+from app.persistence import HistoryWriter, ImageSave, write_batch_size, write_images
+from app.thumbnails import thumbnail_pipeline
+
+
+@pytest.fixture
+def insert_calls():
+    """Record every insert_many and insert_one on the images collection"""
+    calls = []
+    insert_many = mongomock.collection.Collection.insert_many
+    insert_one = mongomock.collection.Collection.insert_one
+
+    def recording_insert_many(self, documents, *args, **kwargs):
+        if self.name == "images":
+            calls.append(("insert_many", list(documents)))
+        return insert_many(self, documents, *args, **kwargs)
+
+    def recording_insert_one(self, document, *args, **kwargs):
+        if self.name == "images":
+            calls.append(("insert_one", [document]))
+        return insert_one(self, document, *args, **kwargs)
+
+    with patch.object(mongomock.collection.Collection, "insert_many", recording_insert_many), \
+            patch.object(mongomock.collection.Collection, "insert_one", recording_insert_one):
+        yield calls
+
+
+def edit(i: int, username: str = "testuser") -> ImageSave:
+    return ImageSave(f"prompt {i}", "FLUX2_KLEIN_4B", f"result {i}".encode(), username,
+                     "edited", b"source image")
+
+
+def write_and_wait(db, saves):
+    async def run():
+        ids = await write_images(db, saves)
+        await thumbnail_pipeline.stop()
+        return ids
+    return asyncio.run(run())
+
+
+class TestWriteImages:
+    """Tests for saving a batch of images"""
+
+    def test_parent_and_child_in_one_insert(self, mock_db, async_db, insert_calls):
+        [image_id] = write_and_wait(async_db, [edit(0)])
+
+        assert [kind for kind, _ in insert_calls] == ["insert_many"]
+        original, edited = insert_calls[0][1]
+        assert original["image_type"] == "original"
+        assert edited["parent_image_id"] == original["_id"]
+        assert str(edited["_id"]) == image_id
+        assert mock_db.images.count_documents({}) == 2
+
+    def test_batch_shares_original_between_edits(self, mock_db, async_db, insert_calls):
+        ids = write_and_wait(async_db, [edit(0), edit(1), edit(2, "otheruser")])
+
+        assert all(ids)
+        assert len(insert_calls) == 1
+        originals = list(mock_db.images.find({"image_type": "original"}))
+        assert sorted(o["username"] for o in originals) == ["otheruser", "testuser"]
+        # A later batch reuses the stored original
+        write_and_wait(async_db, [edit(3)])
+        assert mock_db.images.count_documents({"image_type": "original"}) == 2
+
+    def test_transient_error_is_retried(self, mock_db, async_db):
+        insert_many = mongomock.collection.Collection.insert_many
+        attempts = []
+
+        def flaky_insert_many(self, documents, *args, **kwargs):
+            attempts.append(1)
+            if len(attempts) == 1:
+                # The first attempt stores the records but the reply is lost
+                insert_many(self, documents, *args, **kwargs)
+                raise AutoReconnect("connection reset")
+            return insert_many(self, documents, *args, **kwargs)
+
+        with patch.object(mongomock.collection.Collection, "insert_many", flaky_insert_many), \
+                patch("app.config.settings.HISTORY_WRITE_RETRY_DELAY", 0):
+            ids = write_and_wait(async_db, [edit(0)])
+
+        assert len(attempts) == 2
+        assert ids[0] is not None
+        assert mock_db.images.count_documents({}) == 2
+
+    def test_failed_write_releases_blobs(self, mock_db, async_db):
+        def failing_insert_many(self, documents, *args, **kwargs):
+            raise OperationFailure("not authorized")
+
+        with patch.object(mongomock.collection.Collection, "insert_many", failing_insert_many):
+            ids = write_and_wait(async_db, [edit(0)])
+
+        assert ids == [None]
+        assert mock_db.images.count_documents({}) == 0
+        assert mock_db.image_blobs.count_documents({}) == 0
+
+
+    @pytest.mark.parametrize("failing_type", ["original", "edited"])
+    def test_original_and_edit_are_saved_together(self, mock_db, async_db, failing_type):
+        insert_many = mongomock.collection.Collection.insert_many
+
+        def partly_failing_insert_many(self, documents, *args, **kwargs):
+            documents = list(documents)
+            insert_many(self, [d for d in documents if d["image_type"] != failing_type], *args, **kwargs)
+            raise BulkWriteError({"writeErrors": [
+                {"index": index, "code": 121, "errmsg": "Document failed validation"}
+                for index, document in enumerate(documents) if document["image_type"] == failing_type
+            ]})
+
+        generated = ImageSave("a cat", "FLUX2_KLEIN_4B", b"generated", "testuser", "generation")
+        with patch.object(mongomock.collection.Collection, "insert_many", partly_failing_insert_many):
+            ids = write_and_wait(async_db, [edit(0), generated])
+
+        assert ids[0] is None
+        assert ids[1] == str(generated.image_id)
+        assert [record["_id"] for record in mock_db.images.find()] == [generated.image_id]
+        assert mock_db.image_blobs.count_documents({}) == 1
+
+class TestHistoryWriter:
+    """Tests for the write-behind queue"""
+
+    def test_stop_drains_queue_in_batches(self, mock_db, async_db, insert_calls):
+        batches_before = write_batch_size.get()
+
+        async def run():
+            writer = HistoryWriter()
+            await writer.start()
+            # Nothing is written until the writer gets to run
+            ids = [await writer.submit(async_db, edit(i)) for i in range(5)]
+            assert mock_db.images.count_documents({}) == 0
+            await writer.stop()
+            await thumbnail_pipeline.stop()
+            return ids
+
+        ids = asyncio.run(run())
+
+        assert write_batch_size.get() == batches_before + 1
+        assert len(insert_calls) == 1
+        assert {str(r["_id"]) for r in mock_db.images.find({"image_type": "edited"})} == set(ids)
+
+    def test_writes_right_away_when_not_started(self, mock_db, async_db):
+        image_id = asyncio.run(HistoryWriter().submit(async_db, edit(0)))
+
+        assert str(mock_db.images.find_one({"image_type": "edited"})["_id"]) == image_id
+
+    def test_generated_image_saved_after_response(self, mock_db, client, app_lifespan, upstream_image):
+        with client:
+            response = client.post("/images/generate", json={"prompt": "a cat", "model": "FLUX2_KLEIN_4B"})
+        # Shutting down wrote the queued image
+
+        assert response.status_code == 200
+        assert response.content == upstream_image
+        assert mock_db.images.count_documents({"prompt": "a cat"}) == 1
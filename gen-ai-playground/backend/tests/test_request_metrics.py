@@ -0,0 +1,102 @@
+import base64
+import pytest
+import httpx
+from unittest.mock import patch
+
+from app.database import operation_duration
+from app.request_metrics import request_duration, requests_in_flight
+from app.result_cache import cache_hit_ratio, result_cache
+from app.routers.images import decoded_image_size, upstream_latency
+
+IMAGE = b"\x89PNG\r\n\x1a\nmetrics image"
+
+
+@pytest.fixture
+def upstream_status():
+    """Status code the fake Verda upstream answers with"""
+    return {"code": 200}
+
+
+@pytest.fixture
+def upstream_handler(upstream_status):
+    """Fake Verda upstream answering with IMAGE, or with upstream_status"""
+    def handler(request: httpx.Request) -> httpx.Response:
+        if upstream_status["code"] != 200:
+            return httpx.Response(upstream_status["code"], text="prompt rejected")
+        return httpx.Response(200, json={"image": base64.b64encode(IMAGE).decode()})
+
+    return handler
+
+
+class TestRequestMetrics:
+    """Tests for the per-route request metrics"""
+
+    def test_labelled_by_route_template(self, client):
+        route = "/images/{image_id}"
+        before = request_duration.get(method="GET", route=route, status="404")
+
+        response = client.get("/images/000000000000000000000000")
+
+        assert response.status_code == 404
+        assert request_duration.get(method="GET", route=route, status="404") == before + 1
+        assert requests_in_flight.get(method="GET") == 0
+
+    def test_unknown_path_is_unmatched(self, client):
+        before = request_duration.get(method="GET", route="unmatched", status="404")
+
+        client.get("/no/such/path")
+
+        assert request_duration.get(method="GET", route="unmatched", status="404") == before + 1
+
+    def test_history_query_is_timed(self, client):
+        before = operation_duration.get(operation="history_page")
+
+        client.get("/images/history")
+
+        assert operation_duration.get(operation="history_page") == before + 1
+
+    def test_metrics_endpoint_renders_families(self, client):
+        client.get("/images/history")
+
+        text = client.get("/metrics").text
+
+        for family in ("http_request_duration_seconds", "http_requests_in_flight",
+                       "mongo_operation_seconds", "upstream_request_duration_seconds",
+                       "generated_image_bytes", "result_cache_hit_ratio", "auth_cache_hit_ratio"):
+            assert f"# TYPE {family} " in text
+        assert 'http_request_duration_seconds_count{method="GET",route="/images/history",status="200"}' in text
+
+
+class TestUpstreamMetrics:
+    """Tests for the metrics of model calls"""
+
+    def test_upstream_latency_and_image_size(self, client):
+        labels = {"model": "FLUX2_KLEIN_4B", "status": "200"}
+        before = upstream_latency.get(**labels)
+        sizes_before = decoded_image_size.get_sum(model="FLUX2_KLEIN_4B")
+
+        response = client.post("/images/generate", json={"prompt": "a cat", "model": "FLUX2_KLEIN_4B"})
+
+        assert response.status_code == 200
+        assert upstream_latency.get(**labels) == before + 1
+        assert decoded_image_size.get_sum(model="FLUX2_KLEIN_4B") == sizes_before + len(IMAGE)
+
+    def test_upstream_error_status(self, client, upstream_status):
+        upstream_status["code"] = 400
+        before = upstream_latency.get(model="FLUX2_KLEIN_4B", status="400")
+
+        response = client.post("/images/generate", json={"prompt": "a cat", "model": "FLUX2_KLEIN_4B"})
+
+        assert response.status_code == 400
+        assert upstream_latency.get(model="FLUX2_KLEIN_4B", status="400") == before + 1
+
+    def test_result_cache_hit_ratio(self, client):
+        body = {"prompt": "a cached cat", "model": "FLUX2_KLEIN_4B", "seed": 42}
+        with patch("app.config.settings.RESULT_CACHE_ENABLED", True):
+            client.post("/images/generate", json=body)
+            lookups, hits = result_cache._lookups, result_cache._hits
+            response = client.post("/images/generate", json=body)
+
+        assert response.headers["x-cache"] == "HIT"
+        assert (result_cache._lookups, result_cache._hits) == (lookups + 1, hits + 1)
+        assert cache_hit_ratio.get() == result_cache.hit_ratio() > 0
@@ -0,0 +1,177 @@
+import asyncio
+import base64
+import pytest
+import httpx
+from unittest.mock import patch
+
+from app.resilience import CircuitBreaker, backoff_delay, upstream_policy
+
+
+@pytest.fixture
+def upstream_script():
+    """
+    Outcomes the fake Verda upstream answers with, one per call.
+    Each outcome is a status code, or an exception to raise for that call.
+    """
+    return []
+
+
+@pytest.fixture
+def upstream_handler(upstream_script, upstream_requests):
+    """Fake Verda upstream answering from upstream_script, and with 200 once it ran out"""
+    def handler(request: httpx.Request) -> httpx.Response:
+        upstream_requests.append(request)
+        outcome = upstream_script.pop(0) if upstream_script else 200
+        if isinstance(outcome, Exception):
+            raise outcome
+        if outcome != 200:
+            return httpx.Response(outcome, text="upstream trouble")
+        image = base64.b64encode(b"fake image").decode("utf-8")
+        return httpx.Response(200, json={"image": image})
+
+    return handler
+
+
+@pytest.fixture
+def client(client):
+    """Test client authenticated as testuser, retrying without delay"""
+    with patch("app.config.settings.UPSTREAM_RETRY_BASE_DELAY", 0), \
+            patch("app.config.settings.UPSTREAM_BREAKER_FAILURE_THRESHOLD", 3):
+        yield client
+
+
+def generate(client, prompt="A beautiful sunset"):
+    return client.post("/images/generate", json={"prompt": prompt, "model": "FLUX2_KLEIN_4B"})
+
+
+class TestRetries:
+    """Tests for retrying failures that are safe to repeat"""
+
+    def test_retries_overload_until_success(self, client, upstream_script, upstream_requests):
+        upstream_script.extend([503, 429])
+
+        response = generate(client)
+
+        assert response.status_code == 200
+        assert len(upstream_requests) == 3
+
+    def test_retries_refused_connection(self, client, upstream_script, upstream_requests):
+        upstream_script.append(httpx.ConnectError("connection refused"))
+
+        response = generate(client)
+
+        assert response.status_code == 200
+        assert len(upstream_requests) == 2
+
+    def test_reset_after_sending_is_not_retried(self, client, upstream_script, upstream_requests):
+        upstream_script.append(httpx.ReadError("connection reset by peer"))
+
+        response = generate(client)
+
+        assert response.status_code == 502
+        assert len(upstream_requests) == 1
+
+    def test_gives_up_after_last_attempt(self, client, upstream_script, upstream_requests):
+        upstream_script.extend([502, 502, 502])
+
+        response = generate(client)
+
+        assert response.status_code == 502
+        assert len(upstream_requests) == 3
+
+    def test_client_errors_are_not_retried(self, client, upstream_script, upstream_requests):
+        upstream_script.append(400)
+
+        response = generate(client)
+
+        assert response.status_code == 400
+        assert len(upstream_requests) == 1
+
+    def test_read_timeout_is_not_retried(self, client, upstream_script, upstream_requests):
+        upstream_script.append(httpx.ReadTimeout("model is slow"))
+
+        response = generate(client)
+
+        assert response.status_code == 504
+        assert len(upstream_requests) == 1
+
+    def test_model_read_deadline_override(self):
+        with patch("app.config.settings.UPSTREAM_MODEL_READ_TIMEOUT_OVERRIDES", "FLUX1_KREA_DEV=180"):
+            assert upstream_policy.timeout_for("FLUX1_KREA_DEV").read == 180
+            assert upstream_policy.timeout_for("FLUX2_KLEIN_4B").read == 120
+
+    def test_backoff_is_capped_and_honours_retry_after(self):
+        with patch("app.config.settings.UPSTREAM_RETRY_BASE_DELAY", 1), \
+                patch("app.config.settings.UPSTREAM_RETRY_MAX_DELAY", 4):
+            assert all(0 <= backoff_delay(10) <= 4 for _ in range(20))
+            assert backoff_delay(0, "2") == 2
+            assert backoff_delay(0, "60") == 4
+
+
+class TestCircuitBreaker:
+    """Tests for failing fast while a model is unhealthy"""
+
+    def test_opens_after_consecutive_failures(self, client, upstream_script, upstream_requests):
+        upstream_script.extend([500, 500, 500])
+
+        for _ in range(3):
+            assert generate(client).status_code == 500
+        response = generate(client)
+
+        assert response.status_code == 503
+        assert int(response.headers["retry-after"]) >= 1
+        assert len(upstream_requests) == 3
+
+        status = client.get("/upstream/status").json()["models"]["FLUX2_KLEIN_4B"]
+        assert status["state"] == "open"
+        assert status["consecutive_failures"] == 3
+
+    def test_half_open_trial_closes_breaker(self):
+        breaker = CircuitBreaker("M", failure_threshold=1, reset_seconds=0)
+        breaker.record_failure()
+
+        assert breaker.allow()
+        assert breaker.state == "half_open"
+        # Only one trial call at a time
+        assert not breaker.allow()
+        breaker.record_success()
+        assert breaker.state == "closed"
+
+    def test_failed_trial_opens_again(self):
+        breaker = CircuitBreaker("M", failure_threshold=5, reset_seconds=60)
+        for _ in range(5):
+            breaker.record_failure()
+        breaker.opened_at -= 60
+
+        assert breaker.allow()
+        breaker.record_failure()
+
+        assert breaker.state == "open"
+        assert not breaker.allow()
+
+    def test_cancelled_trial_frees_breaker(self):
+        breaker = CircuitBreaker("M", failure_threshold=1, reset_seconds=0)
+        breaker.record_failure()
+
+        async def send():
+            await asyncio.sleep(1)
+
+        async def run():
+            upstream_policy._breakers["M"] = breaker
+            task = asyncio.ensure_future(upstream_policy.call("M", send))
+            await asyncio.sleep(0)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        try:
+            asyncio.run(run())
+        finally:
+            upstream_policy.reset()
+
+        assert breaker.allow()
+
+    def test_status_lists_every_model(self, client):
+        models = client.get("/upstream/status").json()["models"]
+
+        assert set(models) == {"FLUX1_KONTEXT_DEV", "FLUX1_KREA_DEV", "FLUX2_KLEIN_9B", "FLUX2_KLEIN_4B"}
+        assert models["FLUX2_KLEIN_9B"]["state"] == "closed"
@@ -0,0 +1,127 @@
+import asyncio
+import base64
+import json
+import pytest
+import httpx
+
+from app.result_cache import ResultCache, cache_key, result_cache
+
+
+@pytest.fixture
+def upstream_calls():
+    """Request bodies the fake Verda upstream received"""
+    return []
+
+
+@pytest.fixture
+def upstream_handler(upstream_calls):
+    """Fake Verda upstream answering with an image naming the prompt"""
+    def handler(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        upstream_calls.append(body)
+        image = base64.b64encode(f"image for {body['prompt']}".encode()).decode("utf-8")
+        return httpx.Response(200, json={"image": image})
+
+    return handler
+
+
+@pytest.fixture
+def result_cache_enabled():
+    """Serve seeded generations from the cache under test"""
+    return True
+
+
+class TestResultCacheEndpoint:
+    """Tests for the result cache in front of /images/generate"""
+
+    def test_seeded_request_hits_cache(self, client, upstream_calls, mock_db):
+        body = {"prompt": "A beautiful sunset", "model": "FLUX2_KLEIN_4B", "seed": 42}
+
+        first = client.post("/images/generate", json=body)
+        second = client.post("/images/generate", json=body)
+
+        assert first.headers["x-cache"] == "MISS"
+        assert second.headers["x-cache"] == "HIT"
+        assert first.content == second.content
+        assert len(upstream_calls) == 1
+        assert upstream_calls[0]["seed"] == 42
+        # Each request still shows up in the user's history
+        assert mock_db.images.count_documents({"username": "testuser"}) == 2
+
+    def test_unseeded_requests_bypass_cache(self, client, upstream_calls):
+        body = {"prompt": "A beautiful sunset", "model": "FLUX2_KLEIN_4B"}
+
+        first = client.post("/images/generate", json=body)
+        second = client.post("/images/generate", json=body)
+
+        assert first.headers["x-cache"] == "BYPASS"
+        assert second.headers["x-cache"] == "BYPASS"
+        assert len(upstream_calls) == 2
+        assert "seed" not in upstream_calls[0]
+
+    def test_different_seed_misses(self, client, upstream_calls):
+        client.post("/images/generate", json={"prompt": "p", "model": "FLUX2_KLEIN_4B", "seed": 1})
+        response = client.post("/images/generate", json={"prompt": "p", "model": "FLUX2_KLEIN_4B", "seed": 2})
+
+        assert response.headers["x-cache"] == "MISS"
+        assert len(upstream_calls) == 2
+
+    def test_mongo_tier_survives_memory_eviction(self, client, upstream_calls):
+        body = {"prompt": "A beautiful sunset", "model": "FLUX2_KLEIN_4B", "seed": 7}
+        client.post("/images/generate", json=body)
+        result_cache.clear()
+
+        response = client.post("/images/generate", json=body)
+
+        assert response.headers["x-cache"] == "HIT"
+        assert len(upstream_calls) == 1
+
+    def test_edit_key_includes_input_image(self, client, upstream_calls):
+        first_image = base64.b64encode(b"first source").decode("utf-8")
+        second_image = base64.b64encode(b"second source").decode("utf-8")
+        body = {"prompt": "make it blue", "model": "FLUX2_KLEIN_4B", "seed": 3}
+
+        client.post("/images/edit-image", json={**body, "image": first_image})
+        hit = client.post("/images/edit-image", json={**body, "image": first_image})
+        miss = client.post("/images/edit-image", json={**body, "image": second_image})
+
+        assert hit.headers["x-cache"] == "HIT"
+        assert miss.headers["x-cache"] == "MISS"
+        assert len(upstream_calls) == 2
+
+    def test_hits_show_up_in_metrics(self, client):
+        body = {"prompt": "metrics", "model": "FLUX2_KLEIN_4B", "seed": 5}
+        client.post("/images/generate", json=body)
+        client.post("/images/generate", json=body)
+
+        text = client.get("/metrics").text
+        assert 'result_cache_requests_total{tier="memory",result="hit"}' in text
+
+
+class TestResultCacheMemoryTier:
+    """Tests for the bounded LRU tier"""
+
+    def test_evicts_least_recently_used(self, async_db):
+        cache = ResultCache(max_entries=2, max_bytes=1024, ttl_seconds=60)
+        cache._remember("a", b"1")
+        cache._remember("b", b"2")
+        asyncio.run(cache.get(async_db, "a"))
+        cache._remember("c", b"3")
+
+        assert list(cache._memory) == ["a", "c"]
+
+    def test_bounded_by_bytes(self):
+        cache = ResultCache(max_entries=10, max_bytes=10, ttl_seconds=60)
+        cache._remember("a", b"123456")
+        cache._remember("b", b"123456")
+
+        assert list(cache._memory) == ["b"]
+        assert cache._memory_bytes == 6
+
+    def test_key_depends_on_every_field(self):
+        base = cache_key("M", "p", 1, None)
+        assert base == cache_key("M", "p", 1, None)
+        assert base != cache_key("N", "p", 1, None)
+        assert base != cache_key("M", "q", 1, None)
+        assert base != cache_key("M", "p", 2, None)
+        assert base != cache_key("M", "p", 1, "hash")
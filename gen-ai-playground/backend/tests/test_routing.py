@@ -0,0 +1,136 @@
+import time
+import pytest
+
+from app.admission import admission
+from app.resilience import upstream_policy
+from app.routing import LatencyTracker, ModelRouter, model_router, percentile
+
+
+@pytest.fixture
+def router():
+    """Router with an empty latency window"""
+    return ModelRouter(LatencyTracker(window_size=10))
+
+
+@pytest.fixture
+def client(client):
+    """Test client authenticated as testuser with fresh routing state"""
+    model_router.tracker.clear()
+    yield client
+    model_router.tracker.clear()
+
+
+class TestModelRouter:
+    """Tests for choosing a variant"""
+
+    def test_percentile_is_nearest_rank(self):
+        samples = [5, 1, 4, 2, 3, 6, 7, 8, 9, 10]
+        assert percentile(samples, 50) == 5
+        assert percentile(samples, 90) == 9
+        assert percentile(samples, 100) == 10
+        assert percentile([3], 99) == 3
+
+    def test_window_is_rolling(self):
+        tracker = LatencyTracker(window_size=2)
+        for seconds in (100, 1, 2):
+            tracker.observe("M", seconds)
+
+        assert tracker.percentile("M", 100) == 2
+
+    def test_single_model_without_budget_is_kept(self, router):
+        router.tracker.observe("FLUX2_KLEIN_9B", 60)
+
+        assert router.choose("FLUX2_KLEIN_9B") == "FLUX2_KLEIN_9B"
+
+    def test_family_prefers_unobserved_variants_in_order(self, router):
+        assert router.choose("FLUX2_KLEIN") == "FLUX2_KLEIN_9B"
+
+    def test_family_picks_fastest_variant(self, router):
+        router.tracker.observe("FLUX2_KLEIN_9B", 8)
+        router.tracker.observe("FLUX2_KLEIN_4B", 2)
+
+        assert router.choose("FLUX2_KLEIN") == "FLUX2_KLEIN_4B"
+
+    def test_budget_keeps_preferred_variant_when_it_fits(self, router):
+        router.tracker.observe("FLUX2_KLEIN_9B", 3)
+        router.tracker.observe("FLUX2_KLEIN_4B", 1)
+
+        assert router.choose("FLUX2_KLEIN", budget_ms=5000) == "FLUX2_KLEIN_9B"
+
+    def test_budget_falls_back_from_9b_to_4b(self, router):
+        router.tracker.observe("FLUX2_KLEIN_9B", 12)
+        router.tracker.observe("FLUX2_KLEIN_4B", 2)
+
+        assert router.choose("FLUX2_KLEIN_9B", budget_ms=5000) == "FLUX2_KLEIN_4B"
+
+    def test_queue_counts_towards_predicted_latency(self, router):
+        router.tracker.observe("FLUX2_KLEIN_9B", 4.5)
+        router.tracker.observe("FLUX2_KLEIN_4B", 2)
+        gate = admission.gate("FLUX2_KLEIN_9B")
+        try:
+            gate._active = gate.limit
+            # All slots busy, so the new call has to wait for one
+            assert router.predicted_latency("FLUX2_KLEIN_9B") > 5
+            assert router.choose("FLUX2_KLEIN", budget_ms=5000) == "FLUX2_KLEIN_4B"
+        finally:
+            admission.reset()
+
+    def test_open_breaker_is_avoided(self, router):
+        breaker = upstream_policy.breaker("FLUX2_KLEIN_9B")
+        try:
+            for _ in range(breaker.failure_threshold):
+                breaker.record_failure()
+            assert router.choose("FLUX2_KLEIN") == "FLUX2_KLEIN_4B"
+        finally:
+            upstream_policy.reset()
+
+    def test_unknown_model_is_rejected(self, router):
+        with pytest.raises(Exception) as exc:
+            router.choose("FLUX3")
+
+        assert exc.value.status_code == 400
+
+
+class TestRoutedGeneration:
+    """Tests for routing in /images/generate"""
+
+    def test_family_request_records_chosen_model(self, client, mock_db, upstream_requests):
+        model_router.tracker.observe("FLUX2_KLEIN_9B", 20)
+        model_router.tracker.observe("FLUX2_KLEIN_4B", 1)
+
+        response = client.post(
+            "/images/generate",
+            json={"prompt": "A beautiful sunset", "model": "FLUX2_KLEIN", "latency_budget_ms": 5000}
+        )
+
+        assert response.status_code == 200
+        assert response.headers["x-model"] == "FLUX2_KLEIN_4B"
+        assert [request.url.path for request in upstream_requests] == ["/flux2-klein-4b/generate"]
+        assert mock_db.images.find_one()["model"] == "FLUX2_KLEIN_4B"
+        history = client.get("/images/history").json()["history"]
+        assert history[0]["model"] == "FLUX2_KLEIN_4B"
+
+    def test_upstream_calls_are_observed(self, client):
+        client.post("/images/generate", json={"prompt": "p", "model": "FLUX2_KLEIN_4B"})
+
+        status = client.get("/upstream/status").json()
+        assert status["models"]["FLUX2_KLEIN_4B"]["latency_p50_ms"] is not None
+        assert status["families"]["FLUX2_KLEIN"] == ["FLUX2_KLEIN_9B", "FLUX2_KLEIN_4B"]
+
+    def test_async_job_reports_chosen_model(self, client, app_lifespan):
+        model_router.tracker.observe("FLUX2_KLEIN_9B", 20)
+        model_router.tracker.observe("FLUX2_KLEIN_4B", 1)
+
+        with client:
+            response = client.post(
+                "/images/generate?mode=async",
+                json={"prompt": "p", "model": "FLUX2_KLEIN", "latency_budget_ms": 5000}
+            )
+            assert response.status_code == 202
+            for _ in range(200):
+                job = client.get(response.json()["status_url"]).json()
+                if job["status"] == "completed":
+                    break
+                time.sleep(0.02)
+
+        assert job["model"] == "FLUX2_KLEIN_4B"
@@ -0,0 +1,113 @@
+import asyncio
+import base64
+import pytest
+import httpx
+
+from server import app
+from app.dependencies import get_current_user
+from app.models import UserInfo
+from app.singleflight import SingleFlight
+
+
+class TestSingleFlight:
+    """Tests for the coalescer itself"""
+
+    def test_concurrent_calls_share_one_run(self):
+        flights = SingleFlight()
+        runs = []
+
+        async def work():
+            runs.append(1)
+            await asyncio.sleep(0.05)
+            return "result"
+
+        async def run():
+            return await asyncio.gather(*[flights.do("key", work) for _ in range(4)])
+
+        results = asyncio.run(run())
+
+        assert len(runs) == 1
+        assert [r for r, _ in results] == ["result"] * 4
+        assert [shared for _, shared in results] == [False, True, True, True]
+        assert flights.in_flight() == 0
+
+    def test_different_keys_run_separately(self):
+        flights = SingleFlight()
+
+        async def run():
+            return await asyncio.gather(
+                flights.do("a", lambda: asyncio.sleep(0.01, result="a")),
+                flights.do("b", lambda: asyncio.sleep(0.01, result="b"))
+            )
+
+        assert [r for r, _ in asyncio.run(run())] == ["a", "b"]
+
+    def test_errors_reach_every_waiter(self):
+        flights = SingleFlight()
+
+        async def failing():
+            await asyncio.sleep(0.01)
+            raise ValueError("upstream failed")
+
+        async def run():
+            return await asyncio.gather(
+                flights.do("key", failing), flights.do("key", failing),
+                return_exceptions=True
+            )
+
+        results = asyncio.run(run())
+        assert all(isinstance(r, ValueError) for r in results)
+
+    def test_cancelled_leader_does_not_cancel_waiters(self):
+        flights = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.05)
+            return "result"
+
+        async def run():
+            leader = asyncio.ensure_future(flights.do("key", work))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(flights.do("key", work))
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            return await follower
+
+        assert asyncio.run(run()) == ("result", True)
+
+
+@pytest.fixture
+def upstream_handler(upstream_requests):
+    """Fake Verda upstream taking its time to answer"""
+    async def slow_handler(request: httpx.Request) -> httpx.Response:
+        upstream_requests.append(request)
+        await asyncio.sleep(0.2)
+        image = base64.b64encode(b"shared image").decode("utf-8")
+        return httpx.Response(200, json={"image": image})
+
+    return slow_handler
+
+
+class TestCoalescedGeneration:
+    """Tests for coalescing in /images/generate"""
+
+    def test_identical_requests_make_one_upstream_call(self, mock_db, overrides, fake_upstream,
+                                                       upstream_requests):
+        users = iter(["alice", "bob", "carol", "dave"])
+        app.dependency_overrides[get_current_user] = lambda: UserInfo(username=next(users))
+
+        async def run():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                body = {"prompt": "class demo", "model": "FLUX2_KLEIN_4B"}
+                return await asyncio.gather(*[
+                    client.post("/images/generate", json=body) for _ in range(4)
+                ])
+
+        responses = asyncio.run(run())
+
+        assert len(upstream_requests) == 1
+        assert all(r.status_code == 200 for r in responses)
+        assert all(r.content == b"shared image" for r in responses)
+        # Every user still gets their own history record
+        assert sorted(mock_db.images.distinct("username")) == ["alice", "bob", "carol", "dave"]
@@ -0,0 +1,195 @@
+import asyncio
+import pytest
+from datetime import datetime, timezone
+from unittest.mock import patch
+import base64
+
+from app.blobs import image_source
+from app.migrate_storage import migrate_images
+from app.models import UserInfo
+from app.routers.images import save_image_to_db
+from app.storage import FilesystemStorage, GridFSStorage, ImageStorage, InlineStorage, load_image
+from app.thumbnails import thumbnail_pipeline
+
+
+@pytest.fixture
+def image_bytes():
+    return b"fake_image_data_for_testing"
+
+
+@pytest.fixture(params=["inline", "gridfs", "filesystem"])
+def backend(request, tmp_path):
+    """Every storage backend, with the filesystem one rooted in a temp dir"""
+    if request.param == "inline":
+        return InlineStorage()
+    if request.param == "gridfs":
+        return GridFSStorage()
+    return FilesystemStorage(str(tmp_path))
+
+
+class TestStorageBackends:
+    """Tests shared by all storage backends"""
+
+    def test_round_trip(self, backend, async_db, image_bytes):
+        """Test that saved bytes can be loaded back"""
+        record = asyncio.run(backend.save(async_db, image_bytes))
+
+        assert record["storage"] == backend.name
+        assert asyncio.run(backend.load(async_db, record)) == image_bytes
+
+    def test_stream_in_chunks(self, backend, async_db, image_bytes):
+        async def run():
+            record = await backend.save(async_db, image_bytes)
+            return [chunk async for chunk in backend.stream(async_db, record, chunk_size=10)]
+
+        chunks = asyncio.run(run())
+        assert b"".join(chunks) == image_bytes
+        assert len(chunks) == 3
+
+    def test_load_image_dispatches_on_record(self, backend, async_db, image_bytes, tmp_path):
+        """Test that a record is read from the backend that wrote it"""
+        record = asyncio.run(backend.save(async_db, image_bytes))
+
+        with patch("app.config.settings.IMAGE_STORAGE_PATH", str(tmp_path)):
+            assert asyncio.run(load_image(async_db, record)) == image_bytes
+
+    def test_legacy_record_is_inline(self, async_db, image_bytes):
+        """Test that records without a storage field are read as inline"""
+        record = {"image_data": base64.b64encode(image_bytes).decode("utf-8")}
+
+        assert asyncio.run(load_image(async_db, record)) == image_bytes
+
+    def test_incomplete_backend_cannot_be_created(self):
+        """Test that a backend missing an operation fails when created, not when used"""
+        class WriteOnlyStorage(ImageStorage):
+            async def save(self, db, image_bytes):
+                return {}
+
+        with pytest.raises(TypeError):
+            WriteOnlyStorage()
+
+
+class TestFilesystemStorage:
+    """Tests for the content-addressed directory backend"""
+
+    def test_identical_images_share_a_file(self, async_db, image_bytes, tmp_path):
+        storage = FilesystemStorage(str(tmp_path))
+        first = asyncio.run(storage.save(async_db, image_bytes))
+        second = asyncio.run(storage.save(async_db, image_bytes))
+
+        assert first["storage_ref"] == second["storage_ref"]
+        assert len([p for p in tmp_path.rglob("*") if p.is_file()]) == 1
+
+    def test_delete_keeps_shared_file(self, mock_db, async_db, image_bytes, tmp_path):
+        storage = FilesystemStorage(str(tmp_path))
+        ref = asyncio.run(storage.save(async_db, image_bytes))
+        first_id = mock_db.images.insert_one(dict(ref)).inserted_id
+        mock_db.images.insert_one(dict(ref))
+
+        asyncio.run(storage.delete(async_db, {"_id": first_id, **ref}))
+
+        assert asyncio.run(storage.load(async_db, ref)) == image_bytes
+
+
+def load_record(db, record) -> bytes:
+    """Read the image of a record through its blob"""
+    async def run():
+        return await load_image(db, await image_source(db, record))
+    return asyncio.run(run())
+
+
+class TestSaveImageToDb:
+    """Tests for how save_image_to_db uses the storage backend"""
+
+    def test_records_hold_only_a_reference(self, mock_db, async_db, image_bytes, tmp_path):
+        """Test that non-inline backends keep image bytes out of the database"""
+        async def save():
+            await save_image_to_db(async_db, "prompt", "FLUX2_KLEIN_4B", image_bytes,
+                                   UserInfo(username="testuser"), "edited", b"original_image")
+            await thumbnail_pipeline.stop()
+
+        with patch("app.config.settings.IMAGE_STORAGE_BACKEND", "filesystem"), \
+                patch("app.config.settings.IMAGE_STORAGE_PATH", str(tmp_path)):
+            asyncio.run(save())
+
+            original = mock_db.images.find_one({"image_type": "original"})
+            edited = mock_db.images.find_one({"image_type": "edited"})
+
+            assert "image_data" not in original
+            assert "image_data" not in edited
+            assert mock_db.image_blobs.count_documents({"image_data": {"$exists": True}}) == 0
+            assert edited["parent_image_id"] == original["_id"]
+            assert edited["image_size"] == len(image_bytes)
+            assert load_record(async_db, edited) == image_bytes
+            assert load_record(async_db, original) == b"original_image"
+
+
+class TestMigration:
+    """Tests for moving existing records between backends"""
+
+    def insert_legacy_records(self, db, image_bytes, count=3):
+        for i in range(count):
+            db.images.insert_one({
+                "prompt": f"Test prompt {i}",
+                "model": "FLUX1_KONTEXT_DEV",
+                "timestamp": datetime.now(timezone.utc),
+                "image_size": len(image_bytes),
+                "image_data": base64.b64encode(image_bytes).decode("utf-8"),
+                "username": "testuser",
+                "image_type": "generated"
+            })
+
+    def test_migrate_inline_to_filesystem(self, mock_db, async_db, image_bytes, tmp_path):
+        self.insert_legacy_records(mock_db, image_bytes)
+
+        with patch("app.config.settings.IMAGE_STORAGE_PATH", str(tmp_path)):
+            assert asyncio.run(migrate_images(async_db, "filesystem")) == 3
+
+            for record in mock_db.images.find():
+                assert "image_data" not in record
+                assert "storage" not in record
+                assert load_record(async_db, record) == image_bytes
+
+            # Identical legacy images collapse into one blob
+            blob = mock_db.image_blobs.find_one()
+            assert mock_db.image_blobs.count_documents({}) == 1
+            assert blob["storage"] == "filesystem"
+            assert blob["refcount"] == 3
+
+            # Running again has nothing left to move
+            assert asyncio.run(migrate_images(async_db, "filesystem")) == 0
+
+    def test_migrate_legacy_filesystem_records_keep_shared_file(self, mock_db, async_db,
+                                                                image_bytes, tmp_path):
+        """Test that converting filesystem records does not delete the blob's file"""
+        with patch("app.config.settings.IMAGE_STORAGE_PATH", str(tmp_path)):
+            storage = FilesystemStorage(str(tmp_path))
+            for i in range(2):
+                mock_db.images.insert_one({
+                    "prompt": f"Test prompt {i}",
+                    "username": "testuser",
+                    **asyncio.run(storage.save(async_db, image_bytes))
+                })
+
+            assert asyncio.run(migrate_images(async_db, "filesystem")) == 2
+            for record in mock_db.images.find():
+                assert load_record(async_db, record) == image_bytes
+
+    def test_migrate_gridfs_back_to_inline(self, mock_db, async_db, image_bytes):
+        self.insert_legacy_records(mock_db, image_bytes, count=2)
+        asyncio.run(migrate_images(async_db, "gridfs"))
+
+        assert asyncio.run(migrate_images(async_db, "inline")) == 1
+        blob = mock_db.image_blobs.find_one()
+        assert blob["storage"] == "inline"
+        assert "storage_ref" not in blob
+        for record in mock_db.images.find():
+            assert load_record(async_db, record) == image_bytes
+        assert mock_db.image_files.files.count_documents({}) == 0
+
+    def test_dry_run_changes_nothing(self, mock_db, async_db, image_bytes):
+        self.insert_legacy_records(mock_db, image_bytes)
+
+        assert asyncio.run(migrate_images(async_db, "gridfs", dry_run=True)) == 3
+        assert mock_db.image_blobs.count_documents({}) == 0
+        assert mock_db.images.count_documents({"content_hash": {"$exists": True}}) == 0
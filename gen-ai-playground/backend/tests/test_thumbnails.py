@@ -0,0 +1,94 @@
+import asyncio
+import io
+import pytest
+from datetime import datetime, timedelta
+from PIL import Image
+
+from app.models import UserInfo
+from app.routers.images import save_image_to_db
+from app.thumbnails import make_thumbnail, process_thumbnail, thumbnail_pipeline
+
+
+@pytest.fixture
+def png_bytes():
+    """A real 640x480 PNG image"""
+    buffer = io.BytesIO()
+    Image.new("RGB", (640, 480), (200, 80, 40)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class TestMakeThumbnail:
+    """Tests for the preview builder"""
+
+    def test_dimensions_and_formats(self, png_bytes):
+        preview = make_thumbnail(png_bytes)
+
+        assert (preview["width"], preview["height"]) == (640, 480)
+        assert preview["placeholder"].startswith("data:image/webp;base64,")
+        assert len(preview["placeholder"]) < 500
+        with Image.open(io.BytesIO(preview["thumbnail"])) as thumbnail:
+            assert thumbnail.format == "WEBP"
+            assert max(thumbnail.size) == 256
+
+    def test_invalid_image_is_skipped(self, mock_db, async_db):
+        """Test that undecodable bytes leave the blob untouched"""
+        mock_db.image_blobs.insert_one({"_id": "abc", "refcount": 1})
+
+        asyncio.run(process_thumbnail(async_db, "abc", b"not an image"))
+
+        assert "thumbnail" not in mock_db.image_blobs.find_one({"_id": "abc"})
+
+
+def save_and_wait(db, *args):
+    """Save an image and wait for its thumbnail"""
+    async def run():
+        await save_image_to_db(db, *args)
+        await thumbnail_pipeline.stop()
+    asyncio.run(run())
+
+
+class TestThumbnailPipeline:
+    """Tests for thumbnails created when images are saved"""
+
+    def test_save_creates_thumbnail_in_background(self, mock_db, async_db, png_bytes):
+        save_and_wait(async_db, "prompt", "FLUX2_KLEIN_4B", png_bytes,
+                      UserInfo(username="testuser"), "edited", png_bytes)
+
+        # The original and the result have the same bytes and share one blob
+        blob = mock_db.image_blobs.find_one()
+        assert mock_db.image_blobs.count_documents({}) == 1
+        assert blob["width"] == 640
+        assert blob["height"] == 480
+        assert blob["placeholder"].startswith("data:image/webp")
+        assert blob["thumbnail"]["storage"] == "inline"
+
+    def test_history_points_at_cacheable_thumbnail(self, client, mock_db, async_db, png_bytes):
+        save_and_wait(async_db, "prompt", "FLUX2_KLEIN_4B", png_bytes,
+                      UserInfo(username="testuser"), "generated")
+
+        item = client.get("/images/history").json()["history"][0]
+        assert item["width"] == 640
+        assert item["placeholder"].startswith("data:image/webp")
+        digest = mock_db.images.find_one()["content_hash"]
+        assert item["thumbnail_url"] == f"/images/blobs/{digest}/thumbnail"
+
+        response = client.get(item["thumbnail_url"])
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/webp"
+        assert "immutable" in response.headers["cache-control"]
+
+    def test_history_without_thumbnail(self, client, mock_db):
+        """Test that records saved before the pipeline still list"""
+        mock_db.images.insert_one({
+            "prompt": "old",
+            "model": "FLUX1_KONTEXT_DEV",
+            "timestamp": datetime.utcnow() - timedelta(days=1),
+            "image_size": 3,
+            "image_data": "YWJj",
+            "username": "testuser",
+            "image_type": "generated"
+        })
+
+        item = client.get("/images/history").json()["history"][0]
+        assert item["thumbnail_url"] is None
+        assert client.get(f"/images/{item['id']}/thumbnail").status_code == 404
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import pytest
+import httpx
+from unittest.mock import patch
+
+from app.persistence import ImageSave, write_images
+from app.tracing import SpanContext, parse_traceparent, tracer
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+GENERATE = {"prompt": "a cat", "model": "FLUX2_KLEIN_4B"}
+
+
+@pytest.fixture
+def read_spans(tmp_path):
+    """Export spans to a file; calling the fixture stops tracing and returns the spans by name"""
+    trace_file = tmp_path / "traces.jsonl"
+    with patch("app.config.settings.TRACE_EXPORTER", "file"), \
+            patch("app.config.settings.TRACE_FILE", str(trace_file)):
+        tracer.start()
+
+        def read() -> dict:
+            tracer.stop()
+            if not trace_file.exists():
+                return {}
+            spans = {}
+            for line in trace_file.read_text().splitlines():
+                for span in json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]:
+                    spans[span["name"]] = span
+            return spans
+
+        yield read
+        tracer.stop()
+
+
+def attributes(span: dict) -> dict:
+    return {attribute["key"]: list(attribute["value"].values())[0] for attribute in span["attributes"]}
+
+
+class TestTraceparent:
+    """Tests for parsing W3C trace context"""
+
+    def test_valid(self):
+        context = parse_traceparent(f"00-{TRACE_ID}-{PARENT_ID}-01")
+
+        assert context == SpanContext(TRACE_ID, PARENT_ID, True)
+        assert context.traceparent() == f"00-{TRACE_ID}-{PARENT_ID}-01"
+
+    @pytest.mark.parametrize("value", [
+        None, "", "garbage", f"ff-{TRACE_ID}-{PARENT_ID}-01",
+        f"00-{'0' * 32}-{PARENT_ID}-01", f"00-{TRACE_ID}-{'0' * 16}-01", f"00-{TRACE_ID}-{PARENT_ID}"
+    ])
+    def test_invalid(self, value):
+        assert parse_traceparent(value) is None
+
+
+class TestRequestTraces:
+    """Tests for the spans of a generation request"""
+
+    def test_phases_are_spans_of_one_trace(self, client, read_spans):
+        response = client.post("/images/generate", json=GENERATE, headers={"X-Request-ID": "trace-1"})
+
+        spans = read_spans()
+        assert response.status_code == 200
+        server = spans["POST /images/generate"]
+        assert {"build_request_data", "upstream POST", "decode"} <= set(spans)
+        assert {span["traceId"] for span in spans.values()} == {server["traceId"]}
+        assert "parentSpanId" not in server
+        assert spans["upstream POST"]["parentSpanId"] == server["spanId"]
+        assert attributes(server)["http.response.status_code"] == "200"
+        assert attributes(server)["request_id"] == "trace-1"
+        assert attributes(spans["upstream POST"])["model"] == "FLUX2_KLEIN_4B"
+
+    def test_continues_incoming_trace_upstream(self, client, upstream_requests, read_spans):
+        client.post("/images/generate", json=GENERATE, headers={"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-01"})
+
+        spans = read_spans()
+        assert spans["POST /images/generate"]["traceId"] == TRACE_ID
+        assert spans["POST /images/generate"]["parentSpanId"] == PARENT_ID
+        sent = parse_traceparent(upstream_requests[0].headers["traceparent"])
+        assert sent == SpanContext(TRACE_ID, spans["upstream POST"]["spanId"], True)
+
+    def test_unsampled_trace_propagates_without_export(self, client, upstream_requests, read_spans):
+        client.post("/images/generate", json=GENERATE, headers={"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-00"})
+
+        assert read_spans() == {}
+        sent = parse_traceparent(upstream_requests[0].headers["traceparent"])
+        assert sent.trace_id == TRACE_ID and not sent.sampled
+
+    def test_sample_rate_for_new_traces(self, client, read_spans):
+        with patch("app.config.settings.TRACE_SAMPLE_RATE", 0.0):
+            client.post("/images/generate", json=GENERATE)
+
+        assert read_spans() == {}
+
+    def test_upstream_failure_marks_span(self, client, upstream_requests, read_spans):
+        with patch("app.routers.images.upstream_client.post", side_effect=httpx.ConnectError("refused")):
+            response = client.post("/images/generate", json=GENERATE)
+
+        spans = read_spans()
+        assert response.status_code == 502
+        assert spans["upstream POST"]["status"]["code"] == 2
+        assert spans["POST /images/generate"]["status"]["code"] == 2
+
+    def test_disabled_sends_no_traceparent(self, client, upstream_requests):
+        client.post("/images/generate", json=GENERATE)
+
+        assert "traceparent" not in upstream_requests[0].headers
+
+
+class TestBackgroundSaves:
+    """Tests for the spans of images saved outside a request"""
+
+    def test_save_links_to_requests(self, async_db, read_spans):
+        origin = SpanContext(TRACE_ID, PARENT_ID, True)
+        save = ImageSave(prompt="a cat", model="FLUX2_KLEIN_4B", image_bytes=b"\x89PNG\r\n\x1a\nsave",
+                         username="testuser", image_type="generation", trace_context=origin)
+
+        asyncio.run(write_images(async_db, [save]))
+
+        span = read_spans()["save_image_to_db"]
+        assert span["traceId"] != TRACE_ID
+        assert span["links"] == [{"traceId": TRACE_ID, "spanId": PARENT_ID}]
+        assert attributes(span)["images"] == "1"
+
+    def test_untraced_save_has_no_span(self, async_db, read_spans):
+        save = ImageSave(prompt="a cat", model="FLUX2_KLEIN_4B", image_bytes=b"\x89PNG\r\n\x1a\nsave",
+                         username="testuser", image_type="generation")
+
+        asyncio.run(write_images(async_db, [save]))
+
+        assert save.trace_context is None
+        assert read_spans() == {}
@@ -0,0 +1,104 @@
+import base64
+import json
+import pytest
+from unittest.mock import patch
+
+
+SOURCE_IMAGE = b"\x89PNG\r\n\x1a\nsource image"
+EDITED_IMAGE = b"\x89PNG\r\n\x1a\nedited image"
+
+
+@pytest.fixture
+def upstream_image():
+    """The fake model answers with the edited image"""
+    return EDITED_IMAGE
+
+
+def multipart_body(boundary: str, image: bytes) -> bytes:
+    return (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="prompt"\r\n\r\nmake it blue\r\n'
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="model"\r\n\r\nFLUX2_KLEIN_4B\r\n'
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="image"; filename="source.png"\r\n'
+        "Content-Type: image/png\r\n\r\n"
+    ).encode() + image + f"\r\n--{boundary}--\r\n".encode()
+
+
+class TestEditImageUpload:
+    """Tests for the two body formats of /images/edit-image"""
+
+    def test_multipart_upload(self, client, mock_db, upstream_requests):
+        response = client.post(
+            "/images/edit-image",
+            data={"prompt": "make it blue", "model": "FLUX2_KLEIN_4B", "seed": ""},
+            files={"image": ("source.png", SOURCE_IMAGE, "image/png")}
+        )
+
+        assert response.status_code == 200
+        assert response.content == EDITED_IMAGE
+        sent = json.loads(upstream_requests[0].content)
+        assert base64.b64decode(sent["input_images"][0]) == SOURCE_IMAGE
+        original = mock_db.images.find_one({"image_type": "original"})
+        assert original["image_size"] == len(SOURCE_IMAGE)
+
+    def test_json_body_still_accepted(self, client):
+        response = client.post("/images/edit-image", json={
+            "prompt": "make it blue",
+            "model": "FLUX2_KLEIN_4B",
+            "image": "data:image/png;base64," + base64.b64encode(SOURCE_IMAGE).decode()
+        })
+
+        assert response.status_code == 200
+        assert response.content == EDITED_IMAGE
+
+    def test_multipart_without_image(self, client):
+        response = client.post("/images/edit-image",
+                               data={"prompt": "make it blue", "model": "FLUX2_KLEIN_4B"},
+                               files={"other": ("x.txt", b"x", "text/plain")})
+
+        assert response.status_code == 400
+
+    def test_multipart_missing_field_is_422(self, client):
+        response = client.post("/images/edit-image", data={"model": "FLUX2_KLEIN_4B"},
+                               files={"image": ("source.png", SOURCE_IMAGE, "image/png")})
+
+        assert response.status_code == 422
+        assert response.json()["detail"][0]["loc"] == ["prompt"]
+
+    def test_declared_length_over_limit(self, client, upstream_requests):
+        with patch("app.config.settings.EDIT_IMAGE_MAX_BYTES", 1024):
+            response = client.post("/images/edit-image",
+                                   data={"prompt": "make it blue", "model": "FLUX2_KLEIN_4B"},
+                                   files={"image": ("big.png", b"x" * 200_000, "image/png")})
+
+        assert response.status_code == 413
+        assert upstream_requests == []
+
+    def test_streamed_image_over_limit(self, client, upstream_requests):
+        """Test that a chunked upload without Content-Length is cut off at the limit"""
+        body = multipart_body("limit-test", b"x" * 4096)
+
+        def chunks():
+            for i in range(0, len(body), 512):
+                yield body[i:i + 512]
+
+        with patch("app.config.settings.EDIT_IMAGE_MAX_BYTES", 1024):
+            response = client.post(
+                "/images/edit-image", content=chunks(),
+                headers={"Content-Type": "multipart/form-data; boundary=limit-test"}
+            )
+
+        assert response.status_code == 413
+        assert upstream_requests == []
+
+    def test_json_over_limit(self, client):
+        image = base64.b64encode(b"x" * 200_000).decode()
+
+        with patch("app.config.settings.EDIT_IMAGE_MAX_BYTES", 1024):
+            response = client.post("/images/edit-image", json={
+                "prompt": "make it blue", "model": "FLUX2_KLEIN_4B", "image": image
+            })
+
+        assert response.status_code == 413
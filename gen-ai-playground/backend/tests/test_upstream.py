@@ -0,0 +1,101 @@
+import asyncio
+import base64
+import time
+import pytest
+import httpx
+from unittest.mock import patch
+
+from server import app
+from app.upstream import UpstreamClient
+
+
+def klein_response(request: httpx.Request) -> httpx.Response:
+    """Fake Verda reply in the FLUX2_KLEIN shape"""
+    image = base64.b64encode(b"fake_image_data_for_testing").decode("utf-8")
+    return httpx.Response(200, json={"image": image})
+
+
+DELAY = 0.3
+
+
+async def slow_handler(request: httpx.Request) -> httpx.Response:
+    await asyncio.sleep(DELAY)
+    return klein_response(request)
+
+
+def timeout_handler(request: httpx.Request) -> httpx.Response:
+    raise httpx.ReadTimeout("timed out", request=request)
+
+
+def refused_handler(request: httpx.Request) -> httpx.Response:
+    raise httpx.ConnectError("connection refused", request=request)
+
+
+class TestUpstreamClient:
+    """Tests for the pooled upstream client"""
+
+    def test_one_pool_per_host(self):
+        """Test that URLs on the same host share one client"""
+        upstream = UpstreamClient()
+        first = upstream.client_for("https://inference.test/flux-a/predict")
+        second = upstream.client_for("https://inference.test/flux-b/generate")
+        other = upstream.client_for("https://other.test/generate")
+
+        assert first is second
+        assert first is not other
+
+    def test_start_opens_pool_for_model_hosts(self):
+        """Test that startup creates pools for the configured model hosts"""
+        upstream = UpstreamClient()
+        with patch("app.config.settings.MODEL_URLS", {
+            "A": "https://one.test/a",
+            "B": "https://one.test/b",
+            "C": "https://two.test/c"
+        }):
+            asyncio.run(upstream.start())
+
+        assert len(upstream._clients) == 2
+        asyncio.run(upstream.close())
+        assert upstream._clients == {}
+
+
+class TestGenerateUsesPool:
+    """Tests that the image routes go through the pooled client"""
+
+    @pytest.mark.parametrize("upstream_handler", [slow_handler], indirect=True)
+    def test_concurrent_generations_do_not_block(self, overrides, fake_upstream):
+        """Test that slow upstream calls run concurrently on one event loop"""
+        async def run():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                body = {"prompt": "A beautiful sunset", "model": "FLUX2_KLEIN_4B"}
+                started = time.perf_counter()
+                responses = await asyncio.gather(*[
+                    client.post("/images/generate", json=body) for _ in range(5)
+                ])
+                return responses, time.perf_counter() - started
+
+        responses, elapsed = asyncio.run(run())
+
+        assert all(r.status_code == 200 for r in responses)
+        assert elapsed < DELAY * 3
+
+    @pytest.mark.parametrize("upstream_handler", [timeout_handler], indirect=True)
+    def test_upstream_timeout_returns_504(self, client):
+        """Test that an upstream timeout is reported as a gateway timeout"""
+        response = client.post(
+            "/images/generate",
+            json={"prompt": "A beautiful sunset", "model": "FLUX2_KLEIN_4B"}
+        )
+
+        assert response.status_code == 504
+
+    @pytest.mark.parametrize("upstream_handler", [refused_handler], indirect=True)
+    def test_upstream_connection_error_returns_502(self, client):
+        """Test that an unreachable upstream is reported as a bad gateway"""
+        response = client.post(
+            "/images/generate",
+            json={"prompt": "A beautiful sunset", "model": "FLUX2_KLEIN_4B"}
+        )
+
+        assert response.status_code == 502
@@ -0,0 +1,126 @@
+import asyncio
+import io
+import pytest
+from unittest.mock import patch
+from PIL import Image
+
+from app.imaging import sniff_content_type
+from app.models import UserInfo
+from app.routers.images import save_image_to_db
+from app.thumbnails import thumbnail_pipeline
+from app.variants import negotiate_format, transcode, transcodes
+
+
+@pytest.fixture
+def png_bytes():
+    """A real 320x240 PNG image"""
+    buffer = io.BytesIO()
+    Image.effect_mandelbrot((320, 240), (-2, -1.5, 1, 1.5), 50).convert("RGB").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def upstream_image(png_bytes):
+    """The fake model generates the PNG"""
+    return png_bytes
+
+
+@pytest.fixture
+def stored(client, async_db, png_bytes):
+    """The history item of a saved PNG"""
+    async def run():
+        await save_image_to_db(async_db, "prompt", "FLUX2_KLEIN_4B", png_bytes,
+                               UserInfo(username="testuser"), "generated")
+        await thumbnail_pipeline.stop()
+    asyncio.run(run())
+    return client.get("/images/history").json()["history"][0]
+
+
+class TestNegotiation:
+    """Tests for choosing the format to send"""
+
+    @pytest.mark.parametrize("accept, requested, expected", [
+        (None, None, None),
+        ("*/*", None, None),
+        ("image/*", None, None),
+        ("image/avif,image/webp,*/*;q=0.8", None, "image/webp"),
+        ("image/avif", None, "image/avif"),
+        ("image/webp;q=0.5, image/avif", None, "image/avif"),
+        ("image/png, image/webp;q=0.5", None, None),
+        ("image/webp;q=0", None, None),
+        ("image/webp", "original", None),
+        (None, "avif", "image/avif"),
+        ("image/avif", "webp", "image/webp")
+    ])
+    def test_negotiate_format(self, accept, requested, expected):
+        assert negotiate_format(accept, requested, "image/png") == expected
+
+    def test_preference_order_from_settings(self):
+        with patch("app.config.settings.IMAGE_FORMAT_PREFERENCE", "avif,webp"):
+            assert negotiate_format("image/webp,image/avif", None, "image/png") == "image/avif"
+
+    @pytest.mark.parametrize("media_type", ["image/webp", "image/avif"])
+    def test_transcode(self, png_bytes, media_type):
+        converted = transcode(png_bytes, media_type)
+
+        assert sniff_content_type(converted) == media_type
+        assert len(converted) < len(png_bytes)
+
+
+class TestStoredVariants:
+    """Tests for variants of stored images"""
+
+    def test_variant_converted_once(self, client, mock_db, stored):
+        before = transcodes.get(format="webp")
+
+        first = client.get(stored["image_url"], headers={"Accept": "image/webp"})
+        second = client.get(stored["image_url"], headers={"Accept": "image/webp"})
+
+        assert first.status_code == second.status_code == 200
+        assert first.headers["content-type"] == "image/webp"
+        assert "Accept" in first.headers["vary"]
+        assert first.headers["etag"].endswith('.webp_q80"')
+        assert second.content == first.content
+        assert transcodes.get(format="webp") == before + 1
+        blob = mock_db.image_blobs.find_one()
+        assert blob["variants"]["webp_q80"]["size"] == len(first.content)
+
+    def test_variant_revalidation_skips_conversion(self, client, stored):
+        before = transcodes.get(format="avif")
+        etag = client.get(stored["image_url"], params={"format": "avif"}).headers["etag"]
+
+        response = client.get(stored["image_url"], params={"format": "avif"},
+                              headers={"If-None-Match": etag})
+
+        assert response.status_code == 304
+        assert transcodes.get(format="avif") == before + 1
+
+    def test_original_by_default(self, client, stored, png_bytes):
+        response = client.get(f"/images/{stored['id']}", headers={"Accept": "*/*"})
+
+        assert response.content == png_bytes
+        assert response.headers["content-type"] == "image/png"
+
+    def test_invalid_format(self, client, stored):
+        assert client.get(stored["image_url"], params={"format": "gif"}).status_code == 422
+
+
+class TestGeneratedVariants:
+    """Tests for converting freshly generated images"""
+
+    def test_generate_as_webp_keeps_variant(self, client, mock_db, png_bytes):
+        response = client.post("/images/generate", params={"format": "webp"},
+                               json={"prompt": "a fractal", "model": "FLUX2_KLEIN_4B"})
+        asyncio.run(thumbnail_pipeline.stop())
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/webp"
+        record = mock_db.images.find_one({"prompt": "a fractal"})
+        assert record["image_size"] == len(png_bytes)
+        blob = mock_db.image_blobs.find_one({"_id": record["content_hash"]})
+        assert blob["variants"]["webp_q80"]["size"] == len(response.content)
+
+        before = transcodes.get(format="webp")
+        fetched = client.get(f"/images/blobs/{record['content_hash']}", params={"format": "webp"})
+        assert fetched.content == response.content
+        assert transcodes.get(format="webp") == before
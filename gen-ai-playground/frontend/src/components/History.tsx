@@ -2,11 +2,18 @@ import { useEffect, useState } from "react";
 
 
 interface ImageRecord {
+  id: string
   prompt: string
   model: string
   timestamp: string
-  image_data: string
+  image_size: number
   image_type: string | null | undefined
+  parent_image_id?: string | null
+  width?: number | null
+  height?: number | null
+  placeholder?: string | null
+  image_url?: string | null
+  thumbnail_url?: string | null
 }
 
 interface PromtGroup {
@@ -15,29 +22,79 @@ interface PromtGroup {
 }
 const backendUrl = import.meta.env.VITE_API_URL
 
+function authHeaders() {
+  return {
+    Authorization: `Bearer ${localStorage.getItem("token")}`,
+  }
+}
+
+/**
+ * Loads the thumbnail of a history image once it is rendered, falling back to the full image.
+ * Both URLs name the content and are cached by the browser, so reopening the history refetches
+ * nothing. The blurred placeholder from the history listing is shown meanwhile.
+ */
+function HistoryImage({ item }: { item: ImageRecord }) {
+  const [src, setSrc] = useState<string | null>(null)
+  const path = item.thumbnail_url || item.image_url || `/images/${item.id}`
+
+  useEffect(() => {
+    let objectUrl: string | null = null
+    let cancelled = false
+    fetch(`${backendUrl}${path}`, { headers: authHeaders() })
+      .then(res => res.blob())
+      .then(blob => {
+        if (cancelled) return
+        objectUrl = URL.createObjectURL(blob)
+        setSrc(objectUrl)
+      })
+      .catch(err => console.error("Failed to fetch image:", err))
+    return () => {
+      cancelled = true
+      if (objectUrl) URL.revokeObjectURL(objectUrl)
+    }
+  }, [path])
+
+  const style = { width: "200px", height: "200px", objectFit: "contain" as const }
+  if (src) return <img src={src} alt={item.prompt} style={style} />
+  if (item.placeholder) {
+    return <img src={item.placeholder} alt={item.prompt} style={{ ...style, filter: "blur(8px)" }} />
+  }
+  return <div style={{ ...style, background: "#eee" }} />
+}
+
+function groupByPrompt(records: ImageRecord[]): PromtGroup[] {
+  const groups: { [prompt: string]: ImageRecord[] } = {};
+  records.forEach(item => {
+    if (!groups[item.prompt]) groups[item.prompt] = []
+    groups[item.prompt].push(item)
+  });
+  return Object.keys(groups).map(prompt => ({
+    prompt,
+    images: groups[prompt],
+  }));
+}
+
+interface HistoryPage {
+  history?: ImageRecord[]
+  next_cursor?: string | null
+}
+
+function fetchHistoryPage(cursor: string | null): Promise<HistoryPage> {
+  const params = cursor ? `?cursor=${encodeURIComponent(cursor)}` : ""
+  return fetch(`${backendUrl}/images/history${params}`, { headers: authHeaders() })
+    .then(res => res.json())
+}
+
 export default function History() {
-  const [history, setHistory] = useState<PromtGroup[]>([]);
+  const [records, setRecords] = useState<ImageRecord[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
   const [loading, setLoading] = useState(true);
 
   useEffect(() => {
-    fetch(`${backendUrl}/images/history`, {
-      headers: {
-        Authorization: `Bearer ${localStorage.getItem("token")}`,
-        "Content-Type": "application/json"
-      }
-    })
-      .then(res => res.json())
+    fetchHistoryPage(null)
       .then(data => {
-        const groups: { [prompt: string]: ImageRecord[] } = {};
-        (data.history || []).forEach((item: ImageRecord) => {
-          if (!groups[item.prompt]) groups[item.prompt] = []
-          groups[item.prompt].push(item)
-        });
-        const grouped = Object.keys(groups).map(prompt => ({
-          prompt,
-          images: groups[prompt],
-        }));
-        setHistory(grouped);
+        setRecords(data.history || []);
+        setNextCursor(data.next_cursor || null);
         setLoading(false);
       })
       .catch(err => {
@@ -46,9 +103,25 @@ export default function History() {
       });
   }, []);
 
+  function loadMore() {
+    setLoading(true)
+    fetchHistoryPage(nextCursor)
+      .then(data => {
+        setRecords(prev => [...prev, ...(data.history || [])]);
+        setNextCursor(data.next_cursor || null);
+        setLoading(false);
+      })
+      .catch(err => {
+        console.error("Failed to fetch history:", err)
+        setLoading(false);
+      });
+  }
+
+
+  if (loading && records.length === 0) return <p>Loading history...</p>
+  if (records.length === 0) return <p>No history to show.</p>
 
-  if (loading) return <p>Loading history...</p>
-  if (history.length === 0) return <p>No history to show.</p>
+  const history = groupByPrompt(records)
 
   return (
     <div>
@@ -57,13 +130,9 @@ export default function History() {
         <div key={idx} style={{ marginBottom: "2rem" }}>
           <h3>{group.prompt}</h3>
           <div style={{ display: "flex", gap: "1rem", flexWrap: "wrap" }}>
-            {group.images.map((item, i) => (
-              <div key={i} style={{ display: "flex", flexDirection: "column", alignItems: "center" }}>
-                <img
-                  src={`data:image/png;base64,${item.image_data}`}
-                  alt={item.prompt}
-                  style={{ maxWidth: "200px", maxHeight: "200px", objectFit: "contain" }}
-                />
+            {group.images.map(item => (
+              <div key={item.id} style={{ display: "flex", flexDirection: "column", alignItems: "center" }}>
+                <HistoryImage item={item} />
                 <p>Model: {item.model}</p>
                 <p>Time: {new Date(item.timestamp).toLocaleString()}</p>
                 <p>Type: {item.image_type} </p>
@@ -72,6 +141,11 @@ export default function History() {
           </div>
         </div>
       ))}
+      {nextCursor && (
+        <button onClick={loadMore} disabled={loading}>
+          {loading ? "Loading..." : "Load more"}
+        </button>
+      )}
     </div>
   );
 }
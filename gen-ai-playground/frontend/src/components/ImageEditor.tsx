@@ -59,19 +59,18 @@ export default function ImageEditor() {
         }
         setIsLoading(true)
         try {
-            const base64Image = await imageToBase64(userImage)
-            console.log(base64Image)
             const promises = []
             if (selectedModels[0]) {
+                // The image goes as a binary file part instead of a base64 string
+                const form = new FormData()
+                form.append("image", userImage)
+                form.append("prompt", prompt)
+                form.append("model", selectedModels[0])
                 promises.push(
-                    axios.post(`${backendUrl}/images/edit-image`, {
-                        image: base64Image,
-                        prompt: prompt,
-                        model: selectedModels[0]
-                    }, {
+                    axios.post(`${backendUrl}/images/edit-image`, form, {
                         headers: {
                             Authorization: `Bearer ${localStorage.getItem("token")}`,
-                            "Content-Type": "application/json"
+                            Accept: "image/webp"
                         },
                         responseType: 'blob'
                     })
@@ -97,22 +96,6 @@ export default function ImageEditor() {
         }
     }
 
-    //convert users image file to base64
-    const imageToBase64 = (file: File): Promise<string> => {
-        return new Promise((resolve, reject) => {
-            if (!file) return reject("No file provided")
-            const reader = new FileReader()
-            reader.onloadend = () => {
-                if (reader.result) {
-                    resolve(reader.result as string)
-                } else {
-                    reject("Failed to convert")
-                }
-            }
-            reader.onerror = () => reject("Failed to read file")
-            reader.readAsDataURL(file)
-        })
-    }
     return (
         <>
             <div style={{ display: "flex", flexDirection: "column", justifyContent: "center", width: "100%", alignItems: "center", margin: "10px" }}>
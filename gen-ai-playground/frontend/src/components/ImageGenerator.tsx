@@ -1,6 +1,5 @@
 import { useState } from "react"
 import { PromptTextBox } from "./PromtTextBox"
-import axios from "axios"
 import { useAuth } from "../context/AuthContext"
 import {
   Loader,
@@ -70,50 +69,39 @@ export default function ImageGenerator() {
     try {
       console.log("Fetching generated images for prompt:", prompt)
 
-      const promises = []
-
-      if (selectedModels[0]) {
-        promises.push(
-          axios.post(`${backendUrl}/images/generate`, {
-            prompt: prompt,
-            model: selectedModels[0]
-          }, {
-            headers: {
-              Authorization: `Bearer ${localStorage.getItem("token")}`,
-              "Content-Type": "application/json"
-            },
-            responseType: 'blob'
-          })
-        )
-      }
-
-      if (selectedModels[1]) {
-        promises.push(
-          axios.post(`${backendUrl}/images/generate`, {
-            prompt: prompt,
-            model: selectedModels[1]
-          }, {
-            headers: {
-              Authorization: `Bearer ${localStorage.getItem("token")}`,
-              "Content-Type": "application/json"
-            },
-            responseType: 'blob'
-          })
-        )
+      // One batch request for both models, each image is shown as soon as it is ready
+      const response = await fetch(`${backendUrl}/images/generate/batch?format=webp`, {
+        method: "POST",
+        headers: {
+          Authorization: `Bearer ${localStorage.getItem("token")}`,
+          "Content-Type": "application/json"
+        },
+        body: JSON.stringify({
+          items: selectedModels.slice(0, 2).map((model) => ({ prompt: prompt, model: model }))
+        })
+      })
+      if (!response.ok || !response.body) {
+        throw new Error(`Batch generation failed with status ${response.status}`)
       }
 
-      const results = await Promise.all(promises)
-
-      let resultIndex = 0
-      if (selectedModels[0]) {
-        const image = URL.createObjectURL(results[resultIndex].data)
-        setImageUrl(image)
-        resultIndex++
-      }
-
-      if (selectedModels[1]) {
-        const image = URL.createObjectURL(results[resultIndex].data)
-        setImageUrl2(image)
+      const setters = [setImageUrl, setImageUrl2]
+      const reader = response.body.pipeThrough(new TextDecoderStream()).getReader()
+      let buffered = ""
+      while (true) {
+        const { value, done } = await reader.read()
+        if (done) break
+        buffered += value
+        const lines = buffered.split("\n")
+        buffered = lines.pop() ?? ""
+        for (const line of lines) {
+          if (!line) continue
+          const result = JSON.parse(line)
+          if (result.status === "completed") {
+            setters[result.index](`data:${result.content_type};base64,${result.image}`)
+          } else if (result.status === "failed") {
+            console.error("Error generating image:", result.error)
+          }
+        }
       }
 
     } catch (error) {